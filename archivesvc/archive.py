@@ -13,7 +13,46 @@ from trpycore.timezone import tz
 from trsvcscore.db.job import DatabaseJobQueue, QueueEmpty, QueueStopped, JobOwned
 from trsvcscore.db.models import ChatArchiveJob
 
-from stream import ArchiveStreamType
+from governor import ResourceAccount, accounting
+from layout import ArchiveLayout
+from stream import ArchiveStream, ArchiveStreamType
+
+
+class ArchiveJobTiming(object):
+    """Timing record of a single archive job.
+
+    Records the wall time of each job stage, the resource
+    usage of the ffmpeg and sox processes started by the job,
+    and the sizes of the job's input and output files.
+    """
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.started = time.time()
+        self.stages = []
+        self.account = ResourceAccount()
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def stage(self, name, started):
+        """Record stage which started at time started."""
+        self.stages.append((name, time.time() - started))
+
+    def to_dict(self):
+        return {
+            "chat_id": self.chat_id,
+            "duration": time.time() - self.started,
+            "stages": dict(self.stages),
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "processes": self.account.to_dict(),
+            "process_usages": [u.to_dict() for u in self.account.usages]
+        }
+
+    def __repr__(self):
+        return "%s(chat_id=%r, stages=%s, input_bytes=%r, output_bytes=%r, account=%r)" % (\
+                self.__class__.__name__, self.chat_id,
+                ", ".join(["%s=%.2fs" % stage for stage in self.stages]),
+                self.input_bytes, self.output_bytes, self.account)
 
 
 class ArchiverThreadPool(ThreadPool):
@@ -32,7 +71,12 @@ class ArchiverThreadPool(ThreadPool):
             waveform_generator_pool,
             persister_pool,
             job_retry_seconds,
-            timestamp_filenames=False):
+            timestamp_filenames=False,
+            delete_sweeper=None,
+            scratch=None,
+            layout=None,
+            local_storage_pool=None,
+            governor=None):
         """Archive threadpool constructor.
 
         Arguments:
@@ -49,6 +93,21 @@ class ArchiverThreadPool(ThreadPool):
             timestamp_filenames: optional boolean indicating that epoch
                 timestamps should be used in filenames to guarantee
                 uniqueness. This is useful for non-prod environments.
+            delete_sweeper: optional ArchiveDeleteSweeper object. If
+                provided, vendor-side deletes will be scheduled with
+                the sweeper instead of being executed by the worker.
+            scratch: optional ScratchSpace object shared with the
+                stitcher and waveform generator. The job's scratch
+                space is finished when the job completes.
+            layout: optional ArchiveLayout object used to name
+                archive files. Defaults to a flat layout.
+            local_storage_pool: optional Pool of the local Storage
+                objects fetched and stitched streams are written to.
+                If provided, the job's local files are removed once
+                they've been persisted.
+            governor: optional ResourceGovernor object the stitcher
+                and waveform generator start processes through,
+                used to cancel jobs.
         """
         self.db_session_factory = db_session_factory
         self.fetcher_pool = fetcher_pool
@@ -57,18 +116,54 @@ class ArchiverThreadPool(ThreadPool):
         self.persister_pool = persister_pool
         self.job_retry_seconds = job_retry_seconds
         self.timestamp_filenames = timestamp_filenames
+        self.delete_sweeper = delete_sweeper
+        self.scratch = scratch
+        self.layout = layout or ArchiveLayout()
+        self.local_storage_pool = local_storage_pool
+        self.governor = governor
+        #chat_id to ResourceAccount of running jobs
+        self.running_jobs = {}
+        self.running_jobs_lock = threading.Lock()
         super(ArchiverThreadPool, self).__init__(num_threads)
 
         self.log = logging.getLogger("%s.%s" \
                 % (__name__, self.__class__.__name__))
 
-    def _retry_job(self, job):
+    def _stream_key(self, archive_stream, output_filename):
+        """Get key identifying a fetched stream across job attempts.
+
+        Fetched stream filenames are the job's output_filename,
+        which may contain a per-attempt timestamp, followed by
+        a fetcher specific suffix, i.e. '-<call_sid>.mp3'.
+
+        Returns:
+            filename suffix, or the filename if the stream was
+            not named after output_filename.
+        """
+        filename = archive_stream.filename
+        if filename.startswith(output_filename):
+            return filename[len(output_filename):]
+        return filename
+
+    def _retry_job(self, job, archive_manifest=None, output_filename=None,
+            timing=None):
         """Create a ChatArchiveJob to retry a failed job.
 
         This method will create a new ChatArchiveJob, which
         will be delayed by job_retry_seconds, as long as 
         the number of retries_remaining on the failed
         job is greather than 1.
+
+        Args:
+            job: failed ChatArchiveJob
+            archive_manifest: optional ArchiveStreamManifest of the
+                fetched streams. Media metadata computed for these
+                streams is saved with the retry job so that it
+                does not need to be recomputed.
+            output_filename: base output filename of the failed
+                attempt, required with archive_manifest.
+            timing: optional ArchiveJobTiming of the failed attempt,
+                which is saved with the retry job.
         """
         try:
             db_session = self.db_session_factory()
@@ -78,12 +173,26 @@ class ArchiverThreadPool(ThreadPool):
                 
                 self.log.info("Creating retry job for chat_id=%s at %s" \
                         % (job.chat_id, not_before))
+                
+                chat_session = json.loads(job.data)
+                if archive_manifest is not None:
+                    #only per-stream metadata is saved, since job
+                    #data is also copied into the delete journal.
+                    archive_metadata = {}
+                    for stream in archive_manifest.archive_streams:
+                        key = self._stream_key(stream, output_filename)
+                        archive_metadata[key] = stream.metadata()
+                    chat_session["archive_metadata"] = archive_metadata
+                if timing is not None:
+                    chat_session.setdefault("archive_timings", []).append(
+                            timing.to_dict())
+                data = json.dumps(chat_session)
 
                 retry = ChatArchiveJob(
                         chat_id=job.chat_id,
                         created=func.current_timestamp(),
                         not_before=not_before,
-                        data=job.data,
+                        data=data,
                         retries_remaining=job.retries_remaining-1)
                 db_session.add(retry)
                 db_session.commit()
@@ -99,6 +208,38 @@ class ArchiverThreadPool(ThreadPool):
             if db_session:
                 db_session.close()
     
+    def _restore_metadata(self, archive_manifest, chat_session,
+            output_filename):
+        """Restore stream media metadata saved by a failed attempt.
+
+        Streams are matched by their filename less the attempt's
+        output_filename, since timestamped filenames change with
+        each attempt. Metadata is only restored for streams whose
+        size matches the saved stream, so metadata is never applied
+        to media which has been re-fetched with different content.
+
+        Args:
+            archive_manifest: ArchiveStreamManifest of fetched streams
+            chat_session: session data from chat
+            output_filename: base output filename of this attempt
+        """
+        archive_metadata = chat_session.get("archive_metadata")
+        if not archive_metadata:
+            return
+
+        for stream in archive_manifest.archive_streams:
+            metadata = archive_metadata.get(
+                    self._stream_key(stream, output_filename))
+            if metadata is not None \
+                    and stream.size is not None \
+                    and stream.size == metadata.get("size"):
+                saved_stream = ArchiveStream(
+                        filename=stream.filename,
+                        type=stream.type,
+                        length=stream.length,
+                        **dict((str(k), v) for k, v in metadata.items()))
+                stream.update_metadata(saved_stream)
+
     def _fetch_archives(self, chat_id, chat_session, output_filename):
         """Fetch and download single-user media streams.
         
@@ -229,16 +370,54 @@ class ArchiverThreadPool(ThreadPool):
         self.log.info("Done persisting archives for chat_id=%s" \
                 % chat_id)
 
+    def _remove_local_streams(self, chat_id, archive_streams):
+        """Remove persisted streams from local storage.
+
+        Removes the files of archive_streams, and their waveform
+        files, from self.local_storage_pool. Failures are logged,
+        since the streams have already been persisted.
+
+        Args:
+            chat_id: chat id
+            archive_streams: list of persisted ArchiveStream objects
+        """
+        if self.local_storage_pool is None:
+            return
+
+        filenames = set()
+        for stream in archive_streams:
+            filenames.add(stream.filename)
+            if stream.waveform_filename:
+                filenames.add(stream.waveform_filename)
+
+        with self.local_storage_pool.get() as storage_backend:
+            for filename in filenames:
+                try:
+                    if storage_backend.exists(filename):
+                        storage_backend.delete(filename)
+                except Exception as error:
+                    self.log.warning("Unable to remove %s for chat_id=%s: %s" \
+                            % (filename, chat_id, error))
+
     def _delete_fetcher_streams(self, chat_id, chat_session):
         """Delete media streams from fetcher.
         
         Deletes media streams stored at fetcher location.
+        If a delete sweeper is configured the delete is only
+        recorded here and executed later in the background.
 
         Args:
             chat_id: chat_id
+            chat_session: session data from chat
         Raises:
-            ArchiveFetcherException
+            ArchiveFetcherException, ArchiveDeleteException
         """
+        if self.delete_sweeper is not None:
+            self.log.info("Scheduling delete of archives for chat_id=%s" \
+                    % chat_id)
+            self.delete_sweeper.schedule(chat_id, chat_session)
+            return
+
         self.log.info("Deleting archives for chat_id=%s" \
                 % chat_id)
 
@@ -248,6 +427,30 @@ class ArchiverThreadPool(ThreadPool):
         self.log.info("Done deleting archives for chat_id=%s" \
                 % chat_id)
 
+    def cancel(self, chat_id=None):
+        """Cancel running job, or all running jobs.
+
+        The job's media processes are killed, and it fails with a
+        transient error, so it's retried. Other jobs are unaffected.
+
+        Args:
+            chat_id: chat id of the job to cancel, or None to
+                cancel all running jobs.
+        Returns:
+            number of jobs cancelled.
+        """
+        if self.governor is None:
+            return 0
+        with self.running_jobs_lock:
+            if chat_id is None:
+                accounts = list(self.running_jobs.values())
+            else:
+                accounts = [self.running_jobs[chat_id]] \
+                        if chat_id in self.running_jobs else []
+        for account in accounts:
+            self.governor.cancel(account)
+        return len(accounts)
+
     def process(self, database_job):
         """Worker thread process method.
 
@@ -260,48 +463,86 @@ class ArchiverThreadPool(ThreadPool):
         """
         try:
             job = None
+            archive_manifest = None
+            timing = None
+            output_filename = None
+            success = False
             with database_job as job:
                 chat_id = job.chat_id
                 encoded_chat_id = basic_encode(chat_id)
                 chat_session = json.loads(job.data)
-                output_filename = "archive/%s" % encoded_chat_id
+                base_filename = self.layout.filename(encoded_chat_id)
+                output_filename = base_filename
                 if self.timestamp_filenames:
                     output_filename += "-%s" % time.time()
+                if self.scratch is not None:
+                    #retries find the intermediates of failed attempts
+                    #under the untimestamped filename.
+                    self.scratch.job(output_filename, key=base_filename)
 
                 self.log.info("Creating archive for chat_id=%s (%s)" \
                         % (chat_id, encoded_chat_id))
+                timing = ArchiveJobTiming(chat_id)
+                with self.running_jobs_lock:
+                    self.running_jobs[chat_id] = timing.account
                 
                 #fetch archive streams
+                started = time.time()
                 archive_manifest = self._fetch_archives(
                         chat_id=chat_id,
                         chat_session=chat_session,
                         output_filename=output_filename)
+                timing.stage("fetch", started)
                 if archive_manifest is None \
                         or not archive_manifest.archive_streams:
                     self.log.info("No archives for chat_id=%s" \
                             % chat_id)
+                    success = True
                     return
+                timing.input_bytes = sum([s.size or 0 \
+                        for s in archive_manifest.archive_streams])
+                self._restore_metadata(archive_manifest, chat_session,
+                        output_filename)
     
-                #stitch streams
-                stitched_archive_streams = self._stitch_archives(
-                        chat_id=chat_id,
-                        archive_manifest=archive_manifest,
-                        output_filename=output_filename)
-                
-                #generate waveform
-                stitched_archive_streams = self._generate_waveform(
-                        chat_id=chat_id,
-                        archive_streams=stitched_archive_streams,
-                        output_filename=output_filename)
+                with accounting(timing.account):
+                    #stitch streams
+                    started = time.time()
+                    stitched_archive_streams = self._stitch_archives(
+                            chat_id=chat_id,
+                            archive_manifest=archive_manifest,
+                            output_filename=output_filename)
+                    timing.stage("stitch", started)
+                    
+                    #generate waveform
+                    started = time.time()
+                    stitched_archive_streams = self._generate_waveform(
+                            chat_id=chat_id,
+                            archive_streams=stitched_archive_streams,
+                            output_filename=output_filename)
+                    timing.stage("waveform", started)
+                timing.output_bytes = sum([s.size or 0 \
+                        for s in stitched_archive_streams])
                 
                 #persist streams
+                started = time.time()
                 self._persist_archives(
                         chat_id=chat_id,
                         archive_manifest=archive_manifest,
                         stitched_archive_streams=stitched_archive_streams)
+                timing.stage("persist", started)
+
+                #remove local copies of the persisted streams
+                self._remove_local_streams(chat_id,
+                        archive_manifest.archive_streams + stitched_archive_streams)
                 
                 #delete fetcher streams
                 self._delete_fetcher_streams(chat_id, chat_session)
+                success = True
+
+                #record timing with the job, committed on exit
+                chat_session.setdefault("archive_timings", []).append(
+                        timing.to_dict())
+                job.data = json.dumps(chat_session)
 
                 self.log.info("Done with archive for chat_id=%s (%s)" \
                         % (chat_id, encoded_chat_id))
@@ -314,10 +555,25 @@ class ArchiverThreadPool(ThreadPool):
                 self.log.error("Job for chat_id=%s failed." \
                         % (job.chat_id))
                 self.log.exception(error)
-                self._retry_job(job)
+                if getattr(error, "permanent", False):
+                    self.log.error("Job for chat_id=%s failed permanently, "
+                            "not retrying." % (job.chat_id))
+                else:
+                    self._retry_job(job, archive_manifest, output_filename,
+                            timing)
             else:
                 self.log.error("Job failed but is empty ...")
                 self.log.exception(error)
+        finally:
+            if timing is not None:
+                with self.running_jobs_lock:
+                    self.running_jobs.pop(timing.chat_id, None)
+            #remove job intermediates, or keep them for the retry
+            if self.scratch is not None and output_filename is not None:
+                self.scratch.finish(output_filename, success)
+            if timing is not None:
+                self.log.info("Job timing for chat_id=%s: %r" \
+                        % (timing.chat_id, timing))
 
 
 
@@ -334,7 +590,14 @@ class Archiver(object):
             num_threads,
             poll_seconds=60,
             job_retry_seconds=300,
-            timestamp_filenames=False):
+            timestamp_filenames=False,
+            delete_sweeper=None,
+            prefetcher=None,
+            scratch=None,
+            scratch_collector=None,
+            layout=None,
+            local_storage_pool=None,
+            governor=None):
         """Constructor.
 
         Arguments:
@@ -351,6 +614,23 @@ class Archiver(object):
             timestamp_filenames: optional boolean indicating that epoch
                 timestamps should be used in filenames to guarantee
                 uniqueness. This is useful for non-prod environments.
+            delete_sweeper: optional ArchiveDeleteSweeper object used
+                to delete media streams from the fetcher in the
+                background. If None, deletes are executed synchronously
+                by worker threads.
+            prefetcher: optional ArchivePrefetcher object used to
+                download media streams for queued jobs ahead of time.
+            scratch: optional ScratchSpace object shared with the
+                stitcher and waveform generator.
+            scratch_collector: optional ScratchCollector object used
+                to remove expired scratch space in the background.
+            layout: optional ArchiveLayout object used to name
+                archive files. Defaults to a flat layout.
+            local_storage_pool: optional Pool of the local Storage
+                objects fetched and stitched streams are written to.
+                If provided, they're removed once persisted.
+            governor: optional ResourceGovernor object used to
+                cancel running jobs' media processes.
         """
         self.db_session_factory = db_session_factory
         self.fetcher_pool = fetcher_pool
@@ -361,6 +641,10 @@ class Archiver(object):
         self.poll_seconds = poll_seconds
         self.job_retry_seconds = job_retry_seconds
         self.timestamp_filenames = timestamp_filenames
+        self.delete_sweeper = delete_sweeper
+        self.prefetcher = prefetcher
+        self.scratch = scratch
+        self.scratch_collector = scratch_collector
         self.thread = None
 
         self.threadpool = ArchiverThreadPool(
@@ -371,7 +655,12 @@ class Archiver(object):
                 waveform_generator_pool=waveform_generator_pool,
                 persister_pool=persister_pool,
                 job_retry_seconds=job_retry_seconds,
-                timestamp_filenames=timestamp_filenames)
+                timestamp_filenames=timestamp_filenames,
+                delete_sweeper=delete_sweeper,
+                scratch=scratch,
+                layout=layout,
+                local_storage_pool=local_storage_pool,
+                governor=governor)
 
         self.db_job_queue = DatabaseJobQueue(
                 owner="archivesvc",
@@ -389,6 +678,12 @@ class Archiver(object):
         if not self.running:
             self.running = True
             self.threadpool.start()
+            if self.delete_sweeper is not None:
+                self.delete_sweeper.start()
+            if self.prefetcher is not None:
+                self.prefetcher.start()
+            if self.scratch_collector is not None:
+                self.scratch_collector.start()
             self.db_job_queue.start()
             self.thread = threading.Thread(target=self.run)
             self.thread.start()
@@ -411,16 +706,41 @@ class Archiver(object):
         
         self.running = False
 
+    def cancel(self, chat_id):
+        """Cancel running job for chat_id.
+
+        Returns:
+            True if a running job was cancelled, False otherwise.
+        """
+        return self.threadpool.cancel(chat_id) > 0
+
     def stop(self):
-        """Stop archiver."""
+        """Stop archiver.
+
+        Running jobs are cancelled, so they fail and are retried
+        instead of delaying shutdown.
+        """
         if self.running:
             self.running = False
             self.db_job_queue.stop()
+            self.threadpool.cancel()
             self.threadpool.stop()
+            if self.delete_sweeper is not None:
+                self.delete_sweeper.stop()
+            if self.prefetcher is not None:
+                self.prefetcher.stop()
+            if self.scratch_collector is not None:
+                self.scratch_collector.stop()
     
     def join(self, timeout):
         """Join archiverer."""
         threads = [self.threadpool, self.db_job_queue]
+        if self.delete_sweeper is not None:
+            threads.append(self.delete_sweeper)
+        if self.prefetcher is not None:
+            threads.append(self.prefetcher)
+        if self.scratch_collector is not None:
+            threads.append(self.scratch_collector)
         if self.thread is not None:
             threads.append(self.thread)
         join(threads, timeout)
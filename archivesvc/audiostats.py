@@ -0,0 +1,281 @@
+import collections
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+import numpy as np
+
+from governor import ResourceGovernor
+
+class AudioStatsException(Exception):
+    """Audio stats exception."""
+    pass
+
+
+class AudioStats(object):
+    """Audio stream statistics.
+
+    Sample values are normalized to [-1, 1].
+    """
+    def __init__(self,
+            samples,
+            sample_rate,
+            channels,
+            maximum,
+            minimum,
+            rms):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.maximum = maximum
+        self.minimum = minimum
+        self.rms = rms
+
+    @property
+    def length(self):
+        """Length in seconds."""
+        if not self.sample_rate or not self.channels:
+            return 0.0
+        return float(self.samples) / self.channels / self.sample_rate
+
+    @property
+    def peak(self):
+        """Peak absolute amplitude."""
+        return max(abs(self.maximum), abs(self.minimum))
+
+    @property
+    def volume_adjustment(self):
+        """Factor the volume can be raised by without clipping."""
+        if not self.peak:
+            return float("inf")
+        return 1.0 / self.peak
+
+    @classmethod
+    def from_samples(cls, samples, sample_rate, channels):
+        """Compute stats from an interleaved numpy sample array."""
+        accumulator = AudioStatsAccumulator(sample_rate, channels)
+        accumulator.update(samples)
+        return accumulator.stats()
+
+    def to_dict(self):
+        """Get stats as dict using 'sox <file> -n stat' key names."""
+        return {
+            "Samples read": self.samples,
+            "Length (seconds)": self.length,
+            "Maximum amplitude": self.maximum,
+            "Minimum amplitude": self.minimum,
+            "RMS amplitude": self.rms,
+            "Volume adjustment": self.volume_adjustment
+        }
+
+    def __repr__(self):
+        return "%s(length=%r, peak=%r, rms=%r)" % (\
+                self.__class__.__name__,
+                self.length, self.peak, self.rms)
+
+
+class AudioStatsAccumulator(object):
+    """Streaming, vectorized audio stats accumulator."""
+    def __init__(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.samples = 0
+        self.maximum = 0.0
+        self.minimum = 0.0
+        self.sum_squares = 0.0
+
+    def update(self, samples):
+        """Accumulate numpy array of interleaved samples."""
+        if not len(samples):
+            return
+        self.samples += len(samples)
+        self.maximum = max(self.maximum, float(samples.max()))
+        self.minimum = min(self.minimum, float(samples.min()))
+        samples = samples.astype(np.float64)
+        self.sum_squares += float(np.dot(samples, samples))
+
+    def stats(self):
+        rms = 0.0
+        if self.samples:
+            rms = (self.sum_squares / self.samples) ** 0.5
+        return AudioStats(
+                samples=self.samples,
+                sample_rate=self.sample_rate,
+                channels=self.channels,
+                maximum=self.maximum,
+                minimum=self.minimum,
+                rms=rms)
+
+
+class AudioStatsCache(object):
+    """Thread-safe LRU cache of AudioStats.
+
+    Entries are keyed by path, size and mtime so that a file
+    which is rewritten is never served stale stats.
+    """
+    def __init__(self, size=1024):
+        """AudioStatsCache constructor.
+
+        Args:
+            size: maximum number of entries
+        """
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+    def get(self, path):
+        """Get cached AudioStats for path or None."""
+        key = self._key(path)
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = result
+            return result
+
+    def put(self, path, stats):
+        """Cache AudioStats for path."""
+        key = self._key(path)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = stats
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class FFMpegAudioStatsEngine(object):
+    """In-process audio stats engine.
+
+    Decodes the stream once with ffmpeg to 32-bit float pcm
+    on a pipe and computes length, peak and RMS in a single
+    streaming numpy pass. Results are memoized in an
+    AudioStatsCache which may be shared between components.
+    """
+
+    def __init__(self, ffmpeg_path, cache=None, chunk_size=1024*1024, governor=None):
+        """FFMpegAudioStatsEngine constructor.
+
+        Args:
+            ffmpeg_path: absolute path to ffmpeg executable
+            cache: optional AudioStatsCache object
+            chunk_size: number of bytes to read from ffmpeg at a time.
+            governor: optional ResourceGovernor object used to start
+                ffmpeg processes.
+        """
+        self.ffmpeg_path = ffmpeg_path
+        self.cache = cache if cache is not None else AudioStatsCache()
+        self.chunk_size = chunk_size
+        self.governor = governor or ResourceGovernor()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _read_exactly(self, stream, size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise AudioStatsException("unexpected end of wav header")
+        return data
+
+    def _read_wav_header(self, stream):
+        """Read wav header from stream up to the start of sample data.
+
+        Returns:
+            (sample_rate, channels) tuple
+        """
+        riff, unused, wave = struct.unpack("<4sI4s", self._read_exactly(stream, 12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise AudioStatsException("invalid wav header")
+
+        sample_rate = channels = None
+        while True:
+            chunk_id, chunk_size = struct.unpack("<4sI", self._read_exactly(stream, 8))
+            if chunk_id == b"data":
+                break
+            chunk = self._read_exactly(stream, chunk_size + (chunk_size % 2))
+            if chunk_id == b"fmt ":
+                unused, channels, sample_rate = struct.unpack("<HHI", chunk[:8])
+
+        if not sample_rate or not channels:
+            raise AudioStatsException("missing wav fmt chunk")
+        return sample_rate, channels
+
+    def _compute(self, path):
+        ffmpeg_arguments = [
+                self.ffmpeg_path,
+                "-v",
+                "error",
+                "-i",
+                path,
+                "-vn",
+                "-map_metadata",
+                "-1",
+                "-acodec",
+                "pcm_f32le",
+                "-f",
+                "wav",
+                "-"
+                ]
+
+        process = self.governor.popen(
+                ffmpeg_arguments,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        accumulator = None
+        read = 0
+        try:
+            sample_rate, channels = self._read_wav_header(process.stdout)
+            accumulator = AudioStatsAccumulator(sample_rate, channels)
+
+            #keep reads aligned to whole float samples
+            remainder = b""
+            while True:
+                data = process.stdout.read(self.chunk_size)
+                if not data:
+                    break
+                read += len(data)
+                data = remainder + data
+                aligned = len(data) - (len(data) % 4)
+                remainder = data[aligned:]
+                accumulator.update(np.frombuffer(data[:aligned], dtype="<f4"))
+        except AudioStatsException:
+            #a decode failure surfaces as a truncated header,
+            #prefer reporting ffmpeg's error if there is one.
+            pass
+        finally:
+            process.stdout.close()
+            error_output = process.stderr.read()
+            process.wait()
+            self.governor.record_pipe(read_bytes=read)
+
+        self.governor.check_process(process, ffmpeg_arguments, error_output)
+        if accumulator is None:
+            raise AudioStatsException("unable to read audio from %s" % path)
+
+        return accumulator.stats()
+
+    def stats(self, path):
+        """Get AudioStats for the audio file at path.
+
+        Args:
+            path: local filesystem path of audio file.
+        Returns:
+            AudioStats object
+        Raises:
+            subprocess.CalledProcessError, AudioStatsException
+        """
+        result = self.cache.get(path)
+        if result is None:
+            self.log.info("Computing audio stats for %s" % path)
+            result = self._compute(path)
+            self.cache.put(path, result)
+        return result
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from trpycore.thread.util import join
+
+class ArchiveDeleteException(Exception):
+    """Archive delete exception."""
+    pass
+
+
+class ArchiveDeleteRecord(object):
+    """Pending vendor-side delete for a single chat."""
+    def __init__(self,
+            chat_id,
+            chat_session,
+            created=None,
+            not_before=None,
+            attempts=0):
+        self.chat_id = chat_id
+        self.chat_session = chat_session
+        self.created = created or time.time()
+        self.not_before = not_before or self.created
+        self.attempts = attempts
+
+    def to_dict(self):
+        return {
+            "chat_id": self.chat_id,
+            "chat_session": self.chat_session,
+            "created": self.created,
+            "not_before": self.not_before,
+            "attempts": self.attempts
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __repr__(self):
+        return "%s(chat_id=%r, attempts=%r, not_before=%r)" % (\
+                self.__class__.__name__,
+                self.chat_id, self.attempts, self.not_before)
+
+
+class ArchiveDeleteJournal(object):
+    """Durable journal of pending vendor-side deletes.
+
+    Each pending delete is stored as a single json file in
+    directory, so that deletes survive service restarts.
+    Files are written to a temporary file and renamed into
+    place so a crash never leaves a partial record behind.
+    """
+
+    def __init__(self, directory):
+        """ArchiveDeleteJournal constructor.
+
+        Args:
+            directory: directory in which to store pending
+                delete records. It will be created if needed.
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _record_path(self, chat_id):
+        """Get the journal path for the given chat id."""
+        return os.path.join(self.directory, "%s.json" % chat_id)
+
+    def _write(self, record):
+        """Atomically write record to the journal."""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as temp_file:
+                json.dump(record.to_dict(), temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.rename(temp_path, self._record_path(record.chat_id))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add(self, chat_id, chat_session):
+        """Record a pending delete for the given chat.
+
+        Args:
+            chat_id: chat id
+            chat_session: session data from chat
+        Returns:
+            ArchiveDeleteRecord object
+        """
+        record = ArchiveDeleteRecord(
+                chat_id=chat_id,
+                chat_session=chat_session)
+        with self.lock:
+            self._write(record)
+        return record
+
+    def update(self, record):
+        """Update the stored record (attempts / not_before)."""
+        with self.lock:
+            self._write(record)
+
+    def remove(self, record):
+        """Remove the record from the journal."""
+        with self.lock:
+            path = self._record_path(record.chat_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def pending(self, limit=None, now=None):
+        """Get pending records which are ready to be deleted.
+
+        Args:
+            limit: optional maximum number of records to return
+            now: optional epoch timestamp, defaults to time.time()
+        Returns:
+            list of ArchiveDeleteRecord objects ordered by not_before.
+        """
+        now = now or time.time()
+        results = []
+
+        with self.lock:
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    with open(path, "r") as record_file:
+                        record = ArchiveDeleteRecord.from_dict(
+                                json.load(record_file))
+                except (IOError, OSError, ValueError, TypeError):
+                    continue
+                if record.not_before <= now:
+                    results.append(record)
+
+        results.sort(key=lambda record: record.not_before)
+        if limit is not None:
+            results = results[:limit]
+        return results
+
+
+class ArchiveDeleteSweeper(object):
+    """Background sweeper for vendor-side deletes.
+
+    Deletes are scheduled by archiver worker threads once an
+    archive has been persisted, and executed by the sweeper's
+    own thread in rate limited batches. Failed deletes are
+    retried with exponential backoff independently of the
+    archive job which scheduled them.
+    """
+
+    def __init__(self,
+            fetcher_pool,
+            journal,
+            batch_size=10,
+            deletes_per_second=1.0,
+            poll_seconds=30,
+            retry_seconds=300,
+            max_attempts=10):
+        """ArchiveDeleteSweeper constructor.
+
+        Args:
+            fetcher_pool: Pool object returning a Fetcher object.
+            journal: ArchiveDeleteJournal object
+            batch_size: maximum number of deletes to execute per sweep.
+            deletes_per_second: maximum rate at which deletes
+                will be issued to the vendor.
+            poll_seconds: number of seconds between sweeps.
+            retry_seconds: base number of seconds to wait before
+                retrying a failed delete. Doubled on each attempt.
+            max_attempts: number of attempts before a delete
+                is abandoned.
+        """
+        self.fetcher_pool = fetcher_pool
+        self.journal = journal
+        self.batch_size = batch_size
+        self.deletes_per_second = deletes_per_second
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.thread = None
+        self.running = False
+        self.wakeup = threading.Event()
+        self.last_delete = 0
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def schedule(self, chat_id, chat_session):
+        """Schedule vendor-side delete for the given chat.
+
+        Args:
+            chat_id: chat id
+            chat_session: session data from chat
+        Raises:
+            ArchiveDeleteException
+        """
+        try:
+            self.journal.add(chat_id, chat_session)
+        except Exception as error:
+            self.log.exception(error)
+            raise ArchiveDeleteException(str(error))
+
+    def _throttle(self):
+        """Block until the next delete is allowed by the rate limit."""
+        if not self.deletes_per_second:
+            return
+        interval = 1.0 / self.deletes_per_second
+        delay = self.last_delete + interval - time.time()
+        if delay > 0:
+            self.wakeup.wait(delay)
+        self.last_delete = time.time()
+
+    def _delete(self, fetcher, record):
+        """Execute a single delete, rescheduling it on failure."""
+        try:
+            self.log.info("Deleting archives for chat_id=%s" \
+                    % record.chat_id)
+            fetcher.delete(record.chat_id, record.chat_session)
+            self.journal.remove(record)
+            self.log.info("Done deleting archives for chat_id=%s" \
+                    % record.chat_id)
+        except Exception as error:
+            self.log.exception(error)
+            record.attempts += 1
+            if record.attempts >= self.max_attempts:
+                self.log.error("Abandoning delete for chat_id=%s after %s attempts" \
+                        % (record.chat_id, record.attempts))
+                self.journal.remove(record)
+            else:
+                delay = self.retry_seconds * 2 ** (record.attempts - 1)
+                record.not_before = time.time() + delay
+                self.journal.update(record)
+
+    def sweep(self):
+        """Execute a single batch of pending deletes.
+
+        Returns:
+            number of deletes attempted.
+        """
+        records = self.journal.pending(limit=self.batch_size)
+        if not records:
+            return 0
+
+        with self.fetcher_pool.get() as fetcher:
+            for record in records:
+                if not self.running:
+                    break
+                self._throttle()
+                self._delete(fetcher, record)
+        return len(records)
+
+    def start(self):
+        """Start sweeper."""
+        if not self.running:
+            self.running = True
+            self.wakeup.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+
+    def run(self):
+        """Run sweeper.
+
+        This method is invoked in the context of self.thread
+        """
+        while self.running:
+            try:
+                count = self.sweep()
+            except Exception as error:
+                self.log.exception(error)
+                count = 0
+
+            #only wait if the last sweep did not fill a full batch,
+            #otherwise there may be more deletes ready to go.
+            if self.running and count < self.batch_size:
+                self.wakeup.wait(self.poll_seconds)
+
+        self.running = False
+
+    def stop(self):
+        """Stop sweeper."""
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+
+    def join(self, timeout):
+        """Join sweeper."""
+        if self.thread is not None:
+            join([self.thread], timeout)
@@ -0,0 +1,217 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+#errors leaving a pooled client's connection or authentication
+#in an unknown state. socket errors and timeouts are
+#EnvironmentErrors, and broken responses HTTPExceptions.
+CONNECTION_ERRORS = (EnvironmentError, httplib.HTTPException)
+
+class ElasticPoolException(Exception):
+    """Elastic pool exception."""
+    pass
+
+
+class ElasticPool(object):
+    """Pool which grows and shrinks with demand.
+
+    Objects are created with factory when all pooled objects are
+    in use, up to max_size, and removed once they've been idle for
+    idle_seconds, down to min_size. The most recently released
+    object is reused first, so a few warm objects, i.e. clients
+    with authenticated connections, serve most requests while idle
+    ones expire.
+
+    The pool records how long callers waited to acquire an object
+    and how busy pooled objects were, so an undersized pool shows
+    up in counters.
+    """
+
+    def __init__(self,
+            factory,
+            min_size=1,
+            max_size=4,
+            idle_seconds=300,
+            discard_errors=CONNECTION_ERRORS):
+        """ElasticPool constructor.
+
+        Args:
+            factory: Factory object used to create pooled objects
+            min_size: number of objects kept when idle
+            max_size: maximum number of objects
+            idle_seconds: number of seconds after which idle
+                objects beyond min_size are removed.
+            discard_errors: tuple of exception classes which cause
+                the object in use to be discarded instead of reused,
+                i.e. connection and authentication errors.
+        """
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.idle_seconds = idle_seconds
+        self.discard_errors = discard_errors
+        self.idle = collections.deque()
+        self.size = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquires = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.created = 0
+        self.discarded = 0
+        self.started = time.time()
+        self.condition = threading.Condition()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    @contextlib.contextmanager
+    def get(self, timeout=None):
+        """Get pooled object as a context manager.
+
+        The object is discarded, instead of returned to the pool,
+        if the block raises one of self.discard_errors, so a broken
+        connection isn't reused. Other errors, i.e. a missing file,
+        leave the object usable, so it's returned to the pool.
+
+        Args:
+            timeout: optional number of seconds to wait for an object
+        Raises:
+            ElasticPoolException if no object is available in time.
+        """
+        obj = self.acquire(timeout)
+        acquired = time.time()
+        try:
+            yield obj
+        except self.discard_errors:
+            self.release(obj, acquired, discard=True)
+            raise
+        except Exception:
+            self.release(obj, acquired)
+            raise
+        else:
+            self.release(obj, acquired)
+
+    def acquire(self, timeout=None):
+        """Acquire pooled object, creating one if needed and allowed.
+
+        Args:
+            timeout: optional number of seconds to wait for an object
+        Returns:
+            pooled object
+        Raises:
+            ElasticPoolException if no object is available in time.
+        """
+        start = time.time()
+        create = False
+        obj = None
+        with self.condition:
+            while True:
+                if self.idle:
+                    obj, released = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    create = True
+                    break
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise ElasticPoolException(
+                                "no pooled object available in %ss" % timeout)
+                self.condition.wait(remaining)
+
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquires += 1
+            wait = time.time() - start
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            if wait > 0.001:
+                self.waits += 1
+
+        if create:
+            try:
+                obj = self.factory.create()
+            except Exception as error:
+                with self.condition:
+                    self.size -= 1
+                    self.in_use -= 1
+                    self.condition.notify()
+                raise ElasticPoolException(str(error))
+            with self.condition:
+                self.created += 1
+            self.log.info("Grew pool to %s objects" % self.size)
+        return obj
+
+    def release(self, obj, acquired=None, discard=False):
+        """Return object to the pool.
+
+        Args:
+            obj: object returned by acquire()
+            acquired: optional time obj was acquired, used to
+                record utilization.
+            discard: if True, obj is dropped instead of reused
+        """
+        now = time.time()
+        with self.condition:
+            self.in_use -= 1
+            if acquired is not None:
+                self.busy_seconds += now - acquired
+            if discard:
+                self.size -= 1
+                self.discarded += 1
+            else:
+                self.idle.append((obj, now))
+            self._shrink(now)
+            self.condition.notify()
+
+    def _shrink(self, now):
+        """Remove expired idle objects, oldest first.
+
+        This method must be called with self.condition held.
+        """
+        while self.idle and self.size > self.min_size:
+            obj, released = self.idle[0]
+            if now - released < self.idle_seconds:
+                break
+            self.idle.popleft()
+            self.size -= 1
+            self.log.info("Shrunk pool to %s objects" % self.size)
+
+    def counters(self, prefix="pool"):
+        """Get dict of pool counters.
+
+        Args:
+            prefix: counter name prefix
+        Returns:
+            dict of counter name to value. Utilization is the
+            percentage of max_size object-time spent in use since
+            the pool was created.
+        """
+        with self.condition:
+            self._shrink(time.time())
+            elapsed = max(time.time() - self.started, 0.001)
+            return {
+                "%s_size" % prefix: self.size,
+                "%s_in_use" % prefix: self.in_use,
+                "%s_peak_in_use" % prefix: self.peak_in_use,
+                "%s_created" % prefix: self.created,
+                "%s_discarded" % prefix: self.discarded,
+                "%s_acquires" % prefix: self.acquires,
+                "%s_waits" % prefix: self.waits,
+                "%s_wait_ms" % prefix: int(self.wait_seconds * 1000),
+                "%s_max_wait_ms" % prefix: int(self.max_wait_seconds * 1000),
+                "%s_utilization" % prefix: int(100 * self.busy_seconds \
+                        / (elapsed * self.max_size))
+            }
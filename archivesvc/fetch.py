@@ -1,5 +1,7 @@
 import abc
 import logging
+import os
+import time
 import urllib2
 
 from twilio.rest import TwilioRestClient
@@ -11,6 +13,51 @@ class ArchiveFetcherException(Exception):
     pass
 
 
+class LimitedReader(object):
+    """File-like object limiting the number of bytes read.
+
+    Reads from the wrapped file fail once more than max_bytes
+    have been read, so downloads without a Content-Length
+    can't exceed their budget.
+    """
+
+    def __init__(self, file, max_bytes):
+        """LimitedReader constructor.
+
+        Args:
+            file: file-like object to read from
+            max_bytes: maximum number of bytes to read
+        """
+        self.file = file
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.exceeded = False
+
+    def read(self, size=-1):
+        """Read up to size bytes, or until EOF if size is negative.
+
+        Raises:
+            ArchiveFetcherException if more than max_bytes are read.
+        """
+        if size is None or size < 0:
+            #read no more than one byte past the limit
+            size = self.max_bytes - self.bytes_read + 1
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            self.exceeded = True
+            raise ArchiveFetcherException(
+                    "download exceeded %s bytes" % self.max_bytes)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                break
+            yield data
+
+
 class ArchiveFetcher(object):
     """Archive fetcher abstract base class.
 
@@ -58,7 +105,9 @@ class TwilioFetcher(ArchiveFetcher):
             storage_pool,
             twilio_account_sid,
             twilio_auth_token,
-            twilio_application_sid):
+            twilio_application_sid,
+            twilio_base_url="https://api.twilio.com",
+            prefetch_prefix="prefetch"):
         """Twilio fetcher constructor.
 
         Args:
@@ -68,18 +117,26 @@ class TwilioFetcher(ArchiveFetcher):
             twilio_account_sid: Twilio account sid
             twilio_auth_token: Twilio auth token
             twilio_application_sid: Twilio applicatoin sid
+            twilio_base_url: Twilio REST API base url. This can be
+                pointed at a local stand-in server for testing.
+            prefetch_prefix: filename prefix under which recordings
+                downloaded ahead of time by prefetch() are stored.
         """
         self.db_session_factory = db_session_factory
         self.twilio_account_sid = twilio_account_sid
         self.twilio_auth_token = twilio_auth_token
         self.twilio_application_sid = twilio_application_sid
+        self.twilio_base_url = twilio_base_url
         self.storage_pool = storage_pool
+        self.prefetch_prefix = prefetch_prefix
         self.log = logging.getLogger("%s.%s" \
                 % (__name__, self.__class__.__name__))
 
         #create twilio client
         self.twilio_client = TwilioRestClient(
-                self.twilio_account_sid, self.twilio_auth_token)
+                self.twilio_account_sid,
+                self.twilio_auth_token,
+                base=self.twilio_base_url)
     
    
     def _get_call_sids(self, chat_session):
@@ -114,30 +171,189 @@ class TwilioFetcher(ArchiveFetcher):
             result = twilio_recordings[0]
         return result
 
+    def _prefetch_filename(self, call_sid):
+        """Get filename used to store prefetched recording for call."""
+        return "%s/%s.mp3" % (self.prefetch_prefix, call_sid)
+
+    def _download_recording(self, storage_backend, call_sid, output_filename,
+            max_bytes=None):
+        """Download Twilio recording for given call.
+
+        The recording is downloaded to a temporary file which is
+        moved into place once complete, so a partially downloaded
+        recording is never visible as output_filename.
+
+        Args:
+            storage_backend: Storage object, accessible on local
+                filesystem, in which to store the recording.
+            call_sid: Twilio call_sid
+            output_filename: filename to store recording as.
+            max_bytes: optional maximum size of recording to
+                download. Larger recordings will be skipped, and
+                partial downloads of them deleted.
+        Returns:
+            number of bytes downloaded.
+        Raises:
+            urllib2.HTTPError, StorageException, ArchiveFetcherException
+        """
+        recording = self._get_recording(call_sid)
+        if recording is None:
+            msg = "no recording for call %s" % call_sid
+            raise ArchiveFetcherException(msg)
+        url = recording.formats["mp3"]
+
+        request = urllib2.Request(url)
+        result = urllib2.urlopen(request)
+        try:
+            content_length = result.info().get("Content-Length")
+            if max_bytes is not None and content_length \
+                    and int(content_length) > max_bytes:
+                return 0
+
+            self.log.info("Downloading recording from %s" % url)
+            partial_filename = "%s.part" % output_filename
+            if storage_backend.exists(partial_filename):
+                storage_backend.delete(partial_filename)
+
+            #Content-Length may be missing, so also count the bytes
+            #as they're streamed and abandon the download once it
+            #exceeds max_bytes.
+            reader = result
+            if max_bytes is not None:
+                reader = LimitedReader(result, max_bytes)
+            try:
+                storage_backend.save(partial_filename, reader)
+            except Exception:
+                if reader is result or not reader.exceeded:
+                    raise
+                self.log.info("Skipping recording larger than %s bytes from %s" \
+                        % (max_bytes, url))
+                if storage_backend.exists(partial_filename):
+                    storage_backend.delete(partial_filename)
+                return 0
+        finally:
+            result.close()
+
+        partial_path = storage_backend.path(partial_filename)
+        os.rename(partial_path, storage_backend.path(output_filename))
+        return os.path.getsize(storage_backend.path(output_filename))
+
     def _fetch_recording(self, call_sid, output_filename):
         """Fetch Twilio recording for given call.
         
         Fetches the Twilio audio stream file and stores it in
-        self.storage_pool as output_filename.
+        self.storage_pool as output_filename. If the recording
+        has already been prefetched it will be moved into
+        place instead of being downloaded.
 
         Args:
             call_sid: Twilio call_sid
+        Returns:
+            size of the fetched recording in bytes.
         Raises:
             urllib2.HTTPError, StorageException, ArchiveFetcherException
         """
 
         with self.storage_pool.get() as storage_backend:
             if not storage_backend.exists(output_filename):
-                recording = self._get_recording(call_sid)
-                if recording is None:
-                    msg = "no recording for call %s" % call_sid
-                    raise ArchiveFetcherException(msg)
-                url = recording.formats["mp3"]
-                self.log.info("Downloading recording from %s" % url)
+                prefetch_filename = self._prefetch_filename(call_sid)
+                if storage_backend.exists(prefetch_filename):
+                    self.log.info("Using prefetched recording for call %s" \
+                            % call_sid)
+                    output_path = storage_backend.path(output_filename)
+                    self._ensure_directory(output_path)
+                    os.rename(storage_backend.path(prefetch_filename),
+                            output_path)
+                else:
+                    self._download_recording(
+                            storage_backend,
+                            call_sid,
+                            output_filename)
+            return os.path.getsize(storage_backend.path(output_filename))
 
-                request = urllib2.Request(url)
-                result = urllib2.urlopen(request)
-                storage_backend.save(output_filename, result)
+    def _ensure_directory(self, path):
+        """Ensure directory at path exists."""
+        directory, filename = os.path.split(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def prefetched_bytes(self, expire_seconds=None):
+        """Get number of bytes used by prefetched recordings.
+
+        Args:
+            expire_seconds: optional number of seconds after which
+                prefetched recordings which were never claimed by
+                fetch() are removed.
+        Returns:
+            number of bytes used by prefetched recordings.
+        Raises:
+            StorageException
+        """
+        result = 0
+        now = time.time()
+        with self.storage_pool.get() as storage_backend:
+            directory = storage_backend.path(self.prefetch_prefix)
+            if not os.path.exists(directory):
+                return result
+
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                    if expire_seconds is not None \
+                            and now - stat.st_mtime > expire_seconds:
+                        self.log.info("Removing expired prefetch %s" % path)
+                        os.remove(path)
+                    else:
+                        result += stat.st_size
+                except OSError:
+                    #file was claimed by fetch() in the meantime
+                    continue
+        return result
+
+    def prefetch(self, chat_id, chat_session, max_bytes=None):
+        """Prefetch recordings for the specified chat id.
+
+        Downloads recordings ahead of fetch() so that the fetch
+        for a queued job finds its recordings already present
+        in local storage.
+
+        Args:
+            chat_id: chat id
+            chat_session: Session data for the chat which must contain
+                the twilio_data
+            max_bytes: optional maximum number of bytes to download.
+        Returns:
+            number of bytes downloaded.
+        Raises:
+            ArchiveFetcherException
+        """
+        result = 0
+        try:
+            with self.storage_pool.get() as storage_backend:
+                for call_sid in self._get_call_sids(chat_session):
+                    if max_bytes is not None and result >= max_bytes:
+                        break
+
+                    prefetch_filename = self._prefetch_filename(call_sid)
+                    if storage_backend.exists(prefetch_filename):
+                        continue
+
+                    remaining = None
+                    if max_bytes is not None:
+                        remaining = max_bytes - result
+                    result += self._download_recording(
+                            storage_backend,
+                            call_sid,
+                            prefetch_filename,
+                            max_bytes=remaining)
+            return result
+
+        except ArchiveFetcherException as error:
+            raise
+        except Exception as error:
+            self.log.exception(error)
+            raise ArchiveFetcherException(str(error))
 
     def fetch(self, chat_id, chat_session, output_filename):
         """Fetch Tokbox media streams for the specified chat id.
@@ -165,13 +381,14 @@ class TwilioFetcher(ArchiveFetcher):
             call_sids = self._get_call_sids(chat_session)
             for call_sid in call_sids:
                 audio_filename = "%s-%s.mp3" % (output_filename, call_sid)
-                self._fetch_recording(call_sid, audio_filename)
+                size = self._fetch_recording(call_sid, audio_filename)
                 stream = ArchiveStream(
                         filename=audio_filename,
                         type=ArchiveStreamType.USERS_AUDIO_STREAM,
                         length=None,
                         users=[],
-                        offset=0)
+                        offset=0,
+                        size=size)
                 archive_streams.append(stream)
             archive_streams.sort(key=lambda stream: stream.offset)
 
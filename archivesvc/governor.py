@@ -0,0 +1,806 @@
+import contextlib
+import errno
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#current thread's ResourceAccount
+_local = threading.local()
+
+#ffmpeg / sox output identifying inputs which can't be processed.
+#Failures reporting these are permanent. All other failures are
+#transient, and retried up to the job's retries_remaining.
+INVALID_INPUT_ERRORS = [
+    b"Invalid data found when processing input",
+    b"could not find codec parameters",
+    b"moov atom not found",
+    b"does not contain any stream",
+    b"no handler for detected file type",
+    b"no handler for file extension",
+    b"RIFF header not found"
+]
+
+#ffmpeg options which take no value
+FFMPEG_FLAGS = frozenset([
+    "-y", "-n", "-vn", "-an", "-sn", "-dn", "-nostdin", "-stats",
+    "-nostats", "-hide_banner", "-shortest", "-re", "-copyts"])
+
+def ffmpeg_outputs(arguments):
+    """Get indexes of the output paths in ffmpeg arguments.
+
+    Outputs are the arguments which are neither options nor
+    option values, since inputs are always given by -i.
+
+    Args:
+        arguments: ffmpeg command arguments
+    Returns:
+        list of output argument indexes
+    """
+    results = []
+    index = 1
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument.startswith("-") and argument != "-":
+            if argument not in FFMPEG_FLAGS:
+                index += 1
+        else:
+            results.append(index)
+        index += 1
+    return results
+
+def current_account():
+    """Get the current thread's ResourceAccount, or None."""
+    return getattr(_local, "account", None)
+
+@contextlib.contextmanager
+def accounting(account):
+    """Record usage of governed processes started by this thread.
+
+    Usage:
+        with accounting(ResourceAccount()) as account:
+            ...
+
+    Args:
+        account: ResourceAccount to record usage in
+    """
+    previous = current_account()
+    _local.account = account
+    try:
+        yield account
+    finally:
+        _local.account = previous
+
+def bind_account(function):
+    """Bind function to the current thread's account.
+
+    Processes started by function, when it is called from another
+    thread, i.e. a ThreadPool worker, are recorded in the account
+    of the thread calling bind_account().
+    """
+    account = current_account()
+    def run(*args, **kwargs):
+        with accounting(account):
+            return function(*args, **kwargs)
+    return run
+
+
+class ResourceGovernorException(Exception):
+    """Resource governor exception."""
+    pass
+
+
+class ProcessError(subprocess.CalledProcessError):
+    """Governed child process error.
+
+    Errors are either transient, and the job may succeed if
+    retried, or permanent, i.e. the input can not be processed.
+    """
+    permanent = True
+
+    def __init__(self, returncode, cmd, output=None, reason=None):
+        super(ProcessError, self).__init__(returncode, cmd, output)
+        self.reason = reason
+
+    def __str__(self):
+        result = super(ProcessError, self).__str__()
+        if self.reason:
+            result = "%s (%s)" % (result, self.reason)
+        if self.output:
+            result = "%s: %s" % (result, self.output[-1024:])
+        return result
+
+
+class TransientProcessError(ProcessError):
+    """Transient child process error."""
+    permanent = False
+
+
+class PermanentProcessError(ProcessError):
+    """Permanent child process error."""
+    permanent = True
+
+
+class ProcessUsage(object):
+    """Resource usage of a single child process.
+
+    Cpu times and peak rss are taken from the rusage returned by
+    wait4(). Bytes read and written are block device I/O, so data
+    passed through pipes, or served by the page cache, is not
+    included. Pipe I/O is recorded by ResourceGovernor.record_pipe().
+    """
+    def __init__(self,
+            command,
+            returncode,
+            wall_time,
+            user_time=0.0,
+            system_time=0.0,
+            max_rss=0,
+            read_bytes=0,
+            write_bytes=0):
+        """ProcessUsage constructor.
+
+        Args:
+            command: executable name, i.e. 'ffmpeg'
+            returncode: process return code
+            wall_time: wall time in seconds
+            user_time: user cpu time in seconds
+            system_time: system cpu time in seconds
+            max_rss: peak resident set size in kilobytes
+            read_bytes: bytes read from the filesystem
+            write_bytes: bytes written to the filesystem
+        """
+        self.command = command
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @classmethod
+    def from_rusage(cls, command, returncode, wall_time, rusage):
+        """Create ProcessUsage from a resource.struct_rusage, or None."""
+        if rusage is None:
+            return cls(command, returncode, wall_time)
+        return cls(command=command,
+                returncode=returncode,
+                wall_time=wall_time,
+                user_time=rusage.ru_utime,
+                system_time=rusage.ru_stime,
+                max_rss=rusage.ru_maxrss,
+                read_bytes=rusage.ru_inblock * 512,
+                write_bytes=rusage.ru_oublock * 512)
+
+    def to_dict(self):
+        return {
+            "command": self.command,
+            "returncode": self.returncode,
+            "wall_time": self.wall_time,
+            "user_time": self.user_time,
+            "system_time": self.system_time,
+            "max_rss": self.max_rss,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes
+        }
+
+    def __repr__(self):
+        return "%s(command=%r, wall_time=%.2f, user_time=%.2f, system_time=%.2f, max_rss=%r)" % (\
+                self.__class__.__name__, self.command, self.wall_time,
+                self.user_time, self.system_time, self.max_rss)
+
+
+class ResourceAccount(object):
+    """Aggregated resource usage of a set of child processes.
+
+    The governor keeps a service wide account, and an account
+    may be opened for each job with accounting(). A job's
+    processes are cancelled with ResourceGovernor.cancel(account).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.usages = []
+        self.processes = 0
+        self.failures = 0
+        self.wall_time = 0.0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.pipe_read_bytes = 0
+        self.pipe_write_bytes = 0
+
+    def record(self, usage, keep=True):
+        """Record ProcessUsage.
+
+        Args:
+            usage: ProcessUsage object
+            keep: if True, usage is also kept in self.usages.
+        """
+        with self.lock:
+            if keep:
+                self.usages.append(usage)
+            self.processes += 1
+            if usage.returncode:
+                self.failures += 1
+            self.wall_time += usage.wall_time
+            self.user_time += usage.user_time
+            self.system_time += usage.system_time
+            self.max_rss = max(self.max_rss, usage.max_rss)
+            self.read_bytes += usage.read_bytes
+            self.write_bytes += usage.write_bytes
+
+    def record_pipe(self, read_bytes=0, write_bytes=0):
+        """Record bytes read from and written to child process pipes."""
+        with self.lock:
+            self.pipe_read_bytes += read_bytes
+            self.pipe_write_bytes += write_bytes
+
+    def to_dict(self):
+        """Get dict of totals, with cpu and wall times in seconds."""
+        with self.lock:
+            return {
+                "processes": self.processes,
+                "failures": self.failures,
+                "wall_time": self.wall_time,
+                "user_time": self.user_time,
+                "system_time": self.system_time,
+                "max_rss": self.max_rss,
+                "read_bytes": self.read_bytes,
+                "write_bytes": self.write_bytes,
+                "pipe_read_bytes": self.pipe_read_bytes,
+                "pipe_write_bytes": self.pipe_write_bytes
+            }
+
+    def __repr__(self):
+        return "%s(processes=%r, wall_time=%.2f, user_time=%.2f, system_time=%.2f, max_rss=%r, read_bytes=%r, write_bytes=%r, pipe_read_bytes=%r, pipe_write_bytes=%r)" % (\
+                self.__class__.__name__, self.processes, self.wall_time,
+                self.user_time, self.system_time, self.max_rss,
+                self.read_bytes, self.write_bytes,
+                self.pipe_read_bytes, self.pipe_write_bytes)
+
+
+class ProcessAllocation(object):
+    """Cpu allocation of a single child process."""
+    def __init__(self, threads, cpus=None):
+        """ProcessAllocation constructor.
+
+        Args:
+            threads: number of threads the process may use
+            cpus: optional list of cpu ids the process is pinned to
+        """
+        self.threads = threads
+        self.cpus = cpus or []
+
+    def __repr__(self):
+        return "%s(threads=%r, cpus=%r)" % (\
+                self.__class__.__name__, self.threads, self.cpus)
+
+
+class GovernedPopen(subprocess.Popen):
+    """Popen which releases its allocation when the process exits.
+
+    The process is started in its own process group, so that it
+    can be killed along with any children, i.e. sox input pipes,
+    on timeout or cancellation. The process is reaped with wait4()
+    so its resource usage can be recorded.
+    """
+
+    def __init__(self, governor, allocation, timeout, account, command,
+            *args, **kwargs):
+        self.governor = governor
+        self.allocation = allocation
+        self.timeout = timeout
+        self.account = account
+        self.command = command
+        self.started = time.time()
+        self.ended = None
+        self.rusage = None
+        self.timed_out = False
+        self.cancelled = False
+        self.timer = None
+        try:
+            super(GovernedPopen, self).__init__(*args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+
+        if timeout:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    @property
+    def elapsed(self):
+        """Wall time in seconds the process ran, or has been running."""
+        return (self.ended or time.time()) - self.started
+
+    def kill_group(self):
+        """Kill process group."""
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def expire(self):
+        """Kill process group on timeout."""
+        if self.returncode is None:
+            self.timed_out = True
+            self.governor.log.warning("Killing %s after %ss timeout" \
+                    % (self.pid, self.timeout))
+            self.kill_group()
+
+    def cancel(self):
+        """Kill process group on cancellation."""
+        if self.returncode is None:
+            self.cancelled = True
+            self.kill_group()
+
+    def usage(self):
+        """Get ProcessUsage of the exited process."""
+        return ProcessUsage.from_rusage(
+                command=self.command,
+                returncode=self.returncode,
+                wall_time=self.elapsed,
+                rusage=self.rusage)
+
+    def _wait4(self, options):
+        """Reap process with wait4(), recording its rusage.
+
+        Any failure is left for Popen's own waitpid() to handle.
+        """
+        while self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, options)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                return
+            if pid == self.pid:
+                self.ended = time.time()
+                self.rusage = rusage
+                self._handle_exitstatus(status)
+            return
+
+    def _release(self):
+        if self.ended is None:
+            self.ended = time.time()
+        if self.timer is not None:
+            self.timer.cancel()
+        allocation, self.allocation = self.allocation, None
+        if allocation is not None:
+            self.governor.release(allocation, self)
+
+    def poll(self, *args, **kwargs):
+        if self.returncode is None:
+            self._wait4(os.WNOHANG)
+        result = super(GovernedPopen, self).poll(*args, **kwargs)
+        if result is not None:
+            self._release()
+        return result
+
+    def wait(self, *args, **kwargs):
+        #blocking wait, wait(timeout) is left to Popen
+        if self.returncode is None and not args and not kwargs:
+            self._wait4(0)
+        result = super(GovernedPopen, self).wait(*args, **kwargs)
+        self._release()
+        return result
+
+
+class ResourceGovernor(object):
+    """Cpu budget and limits governor for ffmpeg / sox child processes.
+
+    All ffmpeg and sox processes are started through the governor,
+    which assigns each process a thread count from a global core
+    budget, shared by all archiver threads, and optionally pins it
+    to the least used cpus and lowers its priority.
+
+    The governor never blocks process creation, since stitching
+    pipelines need several processes running at once. When the
+    budget is exhausted, or the system load exceeds the budget,
+    processes are started single threaded.
+
+    Each process runs under a deadline, proportional to the
+    duration of the media it processes, and optional memory and
+    cpu rlimits. On timeout or cancel() the process group is
+    killed and a TransientProcessError is raised.
+
+    The resource usage of each process is recorded in a service
+    wide ResourceAccount, and in the current thread's account
+    (see accounting()).
+
+    A governor without a core budget passes commands through
+    unmodified.
+    """
+
+    def __init__(self,
+            cores=None,
+            max_threads=None,
+            affinity=False,
+            nice=None,
+            load_aware=False,
+            taskset_path="taskset",
+            timeout=3600,
+            timeout_factor=None,
+            max_memory=None,
+            cpu_limit_factor=None):
+        """ResourceGovernor constructor.
+
+        Args:
+            cores: core budget shared by all child processes,
+                or None for no budget.
+            max_threads: maximum number of threads per process.
+                Defaults to cores.
+            affinity: if True, processes are pinned to cpus
+                0 to cores-1, using taskset.
+            nice: optional niceness increment for child processes
+            load_aware: if True, the system load average is
+                subtracted from the budget when assigning threads.
+            taskset_path: path to taskset executable
+            timeout: timeout in seconds for processes with unknown
+                media duration, and the minimum timeout otherwise.
+            timeout_factor: optional number of seconds allowed per
+                second of media. If None, timeout is always used.
+            max_memory: optional address space limit in bytes
+            cpu_limit_factor: optional cpu time limit, as a multiple
+                of the process's timeout.
+        """
+        self.cores = cores
+        self.max_threads = max_threads or cores
+        self.affinity = affinity
+        self.nice = nice
+        self.load_aware = load_aware
+        self.taskset_path = taskset_path
+        self.default_timeout = timeout
+        self.timeout_factor = timeout_factor
+        self.max_memory = max_memory
+        self.cpu_limit_factor = cpu_limit_factor
+
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.cpu_usage = dict((cpu, 0) for cpu in range(cores or 0))
+        self.processes = set()
+        self.cancelled = False
+        self.timeouts = 0
+        self.cancellations = 0
+        self.total_account = ResourceAccount()
+
+        if affinity and not cores:
+            raise ResourceGovernorException("affinity requires a core budget")
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _idle_cores(self):
+        """Get number of cores not in use according to the load average."""
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            return self.cores
+        #load includes our own allocated processes
+        return self.cores - max(0, load - self.allocated)
+
+    def timeout(self, length=None):
+        """Get process timeout for media of the given length.
+
+        Args:
+            length: media length in milliseconds, or None
+        Returns:
+            timeout in seconds
+        """
+        if length is None or self.timeout_factor is None:
+            return self.default_timeout
+        return max(self.default_timeout,
+                self.timeout_factor * length / 1000.0)
+
+    def allocate(self):
+        """Allocate cpu resources for a new child process.
+
+        Returns:
+            ProcessAllocation object, which must be released
+            with release().
+        """
+        if not self.cores:
+            return ProcessAllocation(threads=None)
+
+        with self.lock:
+            available = self.cores - self.allocated
+            if self.load_aware:
+                available = min(available, int(self._idle_cores()) - self.allocated)
+            threads = max(1, min(self.max_threads, available))
+            self.allocated += threads
+
+            cpus = None
+            if self.affinity:
+                cpus = sorted(self.cpu_usage,
+                        key=lambda cpu: (self.cpu_usage[cpu], cpu))[:threads]
+                for cpu in cpus:
+                    self.cpu_usage[cpu] += 1
+
+        return ProcessAllocation(threads=threads, cpus=cpus)
+
+    def release(self, allocation, process=None):
+        """Release allocation returned by allocate().
+
+        Args:
+            allocation: ProcessAllocation object
+            process: optional GovernedPopen object holding allocation
+        """
+        with self.lock:
+            self.processes.discard(process)
+            if allocation.threads is not None:
+                self.allocated -= allocation.threads
+                for cpu in allocation.cpus:
+                    self.cpu_usage[cpu] -= 1
+
+        if process is not None and process.returncode is not None:
+            usage = process.usage()
+            self.total_account.record(usage, keep=False)
+            if process.account is not None:
+                process.account.record(usage)
+
+    def arguments(self, arguments, allocation):
+        """Apply allocation to command arguments.
+
+        Args:
+            arguments: command arguments
+            allocation: ProcessAllocation object
+        Returns:
+            list of command arguments
+        """
+        arguments = list(arguments)
+        if allocation.threads is None:
+            return arguments
+
+        executable = os.path.basename(arguments[0])
+        if executable.startswith("ffmpeg"):
+            #-threads is a per output option, so it's given for
+            #each output, immediately before the output path.
+            for index in reversed(ffmpeg_outputs(arguments) or [1]):
+                arguments[index:index] = ["-threads", "%s" % allocation.threads]
+        elif executable.startswith("sox"):
+            if allocation.threads > 1:
+                arguments.insert(1, "--multi-threaded")
+            else:
+                arguments.insert(1, "--single-threaded")
+
+        if allocation.cpus:
+            arguments[0:0] = [self.taskset_path, "-c",
+                    ",".join(["%s" % cpu for cpu in allocation.cpus])]
+        return arguments
+
+    def record_pipe(self, read_bytes=0, write_bytes=0):
+        """Record bytes passed through child process pipes in-process.
+
+        Pipe I/O isn't included in process rusage, so it's recorded
+        by the loops reading from and writing to child processes,
+        in the service wide account and the current thread's account.
+
+        Args:
+            read_bytes: bytes read from child process stdout
+            write_bytes: bytes written to child process stdin
+        """
+        self.total_account.record_pipe(read_bytes, write_bytes)
+        account = current_account()
+        if account is not None:
+            account.record_pipe(read_bytes, write_bytes)
+
+    def pipe_arguments(self, arguments):
+        """Apply a single threaded allocation to pipe command arguments.
+
+        Commands started by another process, i.e. sox '|command'
+        inputs, aren't started by the governor, so they can't be
+        given their own allocation or deadline. They inherit the
+        starting process's cpu affinity, niceness, rlimits and
+        process group, and are limited to a single thread, since
+        a mix runs one per input.
+
+        Args:
+            arguments: command arguments
+        Returns:
+            list of command arguments
+        """
+        if not self.cores:
+            return list(arguments)
+        return self.arguments(arguments, ProcessAllocation(threads=1))
+
+    def _preexec_fn(self, timeout, preexec_fn=None):
+        """Get child process setup function.
+
+        Runs in the child after fork. Starts a new process group and
+        applies niceness and rlimits.
+        """
+        def run():
+            os.setsid()
+            if self.nice is not None:
+                os.nice(self.nice)
+            if resource is not None:
+                if self.max_memory:
+                    resource.setrlimit(resource.RLIMIT_AS,
+                            (self.max_memory, self.max_memory))
+                if self.cpu_limit_factor and timeout:
+                    limit = int(self.cpu_limit_factor * timeout) + 1
+                    resource.setrlimit(resource.RLIMIT_CPU, (limit, limit + 5))
+            if preexec_fn is not None:
+                preexec_fn()
+        return run
+
+    def popen(self, arguments, timeout=None, **kwargs):
+        """Start governed child process.
+
+        Takes the same keyword arguments as subprocess.Popen.
+
+        Args:
+            arguments: command arguments
+            timeout: timeout in seconds, defaults to timeout()
+        Returns:
+            GovernedPopen object
+        Raises:
+            TransientProcessError if the governor or the current
+            thread's account was cancelled.
+        """
+        account = current_account()
+        if self.cancelled or (account is not None and account.cancelled):
+            raise TransientProcessError(-signal.SIGKILL, arguments,
+                    reason="cancelled")
+        timeout = timeout or self.timeout()
+        allocation = self.allocate()
+        kwargs["preexec_fn"] = self._preexec_fn(timeout, kwargs.get("preexec_fn"))
+        process = GovernedPopen(self, allocation, timeout, account,
+                os.path.basename(arguments[0]),
+                self.arguments(arguments, allocation), **kwargs)
+        with self.lock:
+            if process.allocation is not None:
+                self.processes.add(process)
+            cancelled = account is not None and account.cancelled
+        if cancelled:
+            #cancelled while starting
+            process.cancel()
+        return process
+
+    def _invalid_input(self, output):
+        """Check if process output reports an invalid input."""
+        if not output:
+            return False
+        if not isinstance(output, bytes):
+            output = output.encode("utf-8", "replace")
+        return any([error in output for error in INVALID_INPUT_ERRORS])
+
+    def check_process(self, process, arguments, output=None):
+        """Raise ProcessError if process failed.
+
+        Failures are transient, and the job is retried, unless the
+        process output reports an INVALID_INPUT_ERRORS input error,
+        or the process exceeded its cpu limit, which are permanent.
+
+        Args:
+            process: exited GovernedPopen object
+            arguments: command arguments, for the error
+            output: optional process output, for the error
+        Raises:
+            TransientProcessError, PermanentProcessError
+        """
+        returncode = process.returncode
+        if not returncode:
+            return
+
+        if process.timed_out:
+            with self.lock:
+                self.timeouts += 1
+            error = TransientProcessError(returncode, arguments, output,
+                    reason="timed out after %ss" % process.timeout)
+        elif process.cancelled:
+            error = TransientProcessError(returncode, arguments, output,
+                    reason="cancelled")
+        elif returncode == -signal.SIGXCPU:
+            error = PermanentProcessError(returncode, arguments, output,
+                    reason="cpu limit exceeded")
+        elif returncode < 0:
+            error = TransientProcessError(returncode, arguments, output,
+                    reason="killed by signal %s" % -returncode)
+        elif self._invalid_input(output):
+            error = PermanentProcessError(returncode, arguments, output,
+                    reason="invalid input")
+        else:
+            error = TransientProcessError(returncode, arguments, output)
+
+        self.log.error("%s failed after %.1fs (permanent=%s)" \
+                % (os.path.basename(arguments[0]), process.elapsed,
+                    error.permanent))
+        raise error
+
+    def check_pipeline(self, processes):
+        """Raise ProcessError if any process in a pipeline failed.
+
+        When one process in a pipeline times out or is cancelled,
+        the others typically fail with a broken pipe, so timed out
+        and cancelled processes are reported first. Otherwise the
+        first failed process is reported.
+
+        Args:
+            processes: list of (process, arguments, output) tuples
+                in pipeline order.
+        Raises:
+            TransientProcessError, PermanentProcessError
+        """
+        processes = sorted(processes, key=lambda entry: \
+                not (entry[0].timed_out or entry[0].cancelled))
+        for process, arguments, output in processes:
+            self.check_process(process, arguments, output)
+
+    def check_output(self, arguments, timeout=None, **kwargs):
+        """Run governed child process and return its output.
+
+        Takes the same keyword arguments as subprocess.check_output.
+
+        Args:
+            arguments: command arguments
+            timeout: timeout in seconds, defaults to timeout()
+        Raises:
+            TransientProcessError, PermanentProcessError
+        """
+        process = self.popen(arguments, timeout=timeout,
+                stdout=subprocess.PIPE, **kwargs)
+        output, unused = process.communicate()
+        self.check_process(process, arguments, output)
+        return output
+
+    def cancel(self, account=None):
+        """Kill running child processes of a job, or of all jobs.
+
+        Processes which are cancelled, and any processes started
+        after cancellation, fail with a TransientProcessError.
+
+        Args:
+            account: optional ResourceAccount of the job to cancel,
+                see accounting(). Only processes recorded in account
+                are killed, and only account's further processes are
+                refused. If None, all processes are killed and no
+                further processes can be started, i.e. on shutdown.
+        """
+        with self.lock:
+            if account is None:
+                self.cancelled = True
+                processes = list(self.processes)
+            else:
+                account.cancelled = True
+                processes = [process for process in self.processes
+                        if process.account is account]
+            self.cancellations += len(processes)
+        for process in processes:
+            process.cancel()
+
+    def counters(self):
+        """Get dict of governor counters.
+
+        Times are in milliseconds and max rss in kilobytes.
+        """
+        totals = self.total_account.to_dict()
+        with self.lock:
+            return {
+                "governor_allocated_threads": self.allocated,
+                "governor_processes": len(self.processes),
+                "governor_timeouts": self.timeouts,
+                "governor_cancellations": self.cancellations,
+                "governor_completed_processes": totals["processes"],
+                "governor_failed_processes": totals["failures"],
+                "governor_wall_ms": int(totals["wall_time"] * 1000),
+                "governor_user_ms": int(totals["user_time"] * 1000),
+                "governor_system_ms": int(totals["system_time"] * 1000),
+                "governor_max_rss_kb": totals["max_rss"],
+                "governor_read_bytes": totals["read_bytes"],
+                "governor_write_bytes": totals["write_bytes"],
+                "governor_pipe_read_bytes": totals["pipe_read_bytes"],
+                "governor_pipe_write_bytes": totals["pipe_write_bytes"]
+            }
@@ -4,16 +4,25 @@ from trpycore.factory.base import Factory
 from trpycore.pool.queue import QueuePool
 from trpycore.thread.util import join
 from trsvcscore.service.handler.service import ServiceHandler
-from trsvcscore.storage.cloudfiles import CloudfilesStoragePool
 from trsvcscore.storage.filesystem import FileSystemStorage
 from trrackspace.services.cloudfiles.factory import CloudfilesClientFactory
 from trarchivesvc.gen import TArchiveService
 
 import settings
 from archive import Archiver
+from audiostats import AudioStatsCache, FFMpegAudioStatsEngine
+from delete import ArchiveDeleteJournal, ArchiveDeleteSweeper
+from elastic import CONNECTION_ERRORS, ElasticPool
 from fetch import TwilioFetcher
-from persist import DefaultPersister
+from governor import ResourceGovernor
+from layout import ArchiveLayout
+from lookup import LookupCache
+from prefetch import ArchivePrefetcher
+from scratch import ScratchCollector, ScratchSpace
+from persist import ContainerIndex, DefaultPersister
+from segment import SegmentedEncoder
 from stitch import FFMpegSoxStitcher
+from storage import ManifestCloudfilesStorage, StorageConnectionException
 from waveform import FFMpegWaveformGenerator
 
 
@@ -44,19 +53,28 @@ class ArchiveServiceHandler(TArchiveService.Iface, ServiceHandler):
                 timeout=settings.CLOUDFILES_TIMEOUT,
                 debug_level=settings.CLOUDFILES_DEBUG_LEVEL)
 
+        def cloudfiles_storage_pool(container_name):
+            def cloudfiles_storage_factory():
+                return ManifestCloudfilesStorage(
+                        cloudfiles_client=self.cloudfiles_client_factory.create(),
+                        container_name=container_name)
+            return ElasticPool(
+                    factory=Factory(cloudfiles_storage_factory),
+                    min_size=settings.CLOUDFILES_STORAGE_POOL_MIN_SIZE,
+                    max_size=settings.CLOUDFILES_STORAGE_POOL_MAX_SIZE,
+                    idle_seconds=settings.CLOUDFILES_STORAGE_POOL_IDLE_SECONDS,
+                    discard_errors=CONNECTION_ERRORS + (StorageConnectionException,))
+
         #public cloudfiles storage pool for storing archives
-        #on public cdn.
-        self.cloudfiles_public_storage_pool = CloudfilesStoragePool(
-                cloudfiles_client_factory=self.cloudfiles_client_factory,
-                container_name=settings.CLOUDFILES_PUBLIC_CONTAINER_NAME,
-                size=settings.CLOUDFILES_STORAGE_POOL_SIZE)
+        #on public cdn. Pools grow with concurrent persisters
+        #and uploads and shrink when idle.
+        self.cloudfiles_public_storage_pool = cloudfiles_storage_pool(
+                settings.CLOUDFILES_PUBLIC_CONTAINER_NAME)
         
         #private cloudfiles storage pool for storing archives
         #which should not be accessible on cdb.
-        self.cloudfiles_private_storage_pool = CloudfilesStoragePool(
-                cloudfiles_client_factory=self.cloudfiles_client_factory,
-                container_name=settings.CLOUDFILES_PRIVATE_CONTAINER_NAME,
-                size=settings.CLOUDFILES_STORAGE_POOL_SIZE)
+        self.cloudfiles_private_storage_pool = cloudfiles_storage_pool(
+                settings.CLOUDFILES_PRIVATE_CONTAINER_NAME)
         
         def filesystem_storage_factory():
             return FileSystemStorage(
@@ -65,23 +83,72 @@ class ArchiveServiceHandler(TArchiveService.Iface, ServiceHandler):
                 size=settings.ARCHIVER_THREADS,
                 factory=Factory(filesystem_storage_factory))
 
-        def fetcher_factory():
+        def fetcher_factory(storage_pool=None):
             return TwilioFetcher(
                     db_session_factory=self.get_database_session,
-                    storage_pool=self.filesystem_storage_pool,
+                    storage_pool=storage_pool or self.filesystem_storage_pool,
                     twilio_account_sid=settings.TWILIO_ACCOUNT_SID,
                     twilio_auth_token=settings.TWILIO_AUTH_TOKEN,
-                    twilio_application_sid=settings.TWILIO_APPLICATION_SID)
+                    twilio_application_sid=settings.TWILIO_APPLICATION_SID,
+                    twilio_base_url=settings.TWILIO_BASE_URL)
         self.fetcher_pool = QueuePool(
                 size=settings.ARCHIVER_THREADS,
                 factory=Factory(fetcher_factory))
         
+        #cpu budget shared by all ffmpeg / sox child processes
+        self.governor = ResourceGovernor(
+                cores=settings.GOVERNOR_CORES,
+                max_threads=settings.GOVERNOR_MAX_THREADS,
+                affinity=settings.GOVERNOR_AFFINITY,
+                nice=settings.GOVERNOR_NICE,
+                load_aware=settings.GOVERNOR_LOAD_AWARE,
+                timeout=settings.GOVERNOR_TIMEOUT,
+                timeout_factor=settings.GOVERNOR_TIMEOUT_FACTOR,
+                max_memory=settings.GOVERNOR_MAX_MEMORY,
+                cpu_limit_factor=settings.GOVERNOR_CPU_LIMIT_FACTOR)
+
+        #audio stats cache shared by stitchers and waveform generators
+        #so each file is decoded for stats at most once.
+        self.audio_stats_cache = AudioStatsCache(
+                size=settings.STITCH_STATS_CACHE_SIZE)
+
+        def stats_engine_factory():
+            return FFMpegAudioStatsEngine(
+                    ffmpeg_path=settings.STITCH_FFMPEG_PATH,
+                    cache=self.audio_stats_cache,
+                    governor=self.governor)
+
+        #per-job scratch space for stitching intermediates
+        self.scratch = ScratchSpace(
+                directory=settings.STITCH_SCRATCH_DIRECTORY,
+                memory_directory=settings.STITCH_SCRATCH_MEMORY_DIRECTORY,
+                memory_bytes=settings.STITCH_SCRATCH_MEMORY_BYTES,
+                ttl_seconds=settings.STITCH_SCRATCH_TTL_SECONDS,
+                max_bytes=settings.STITCH_SCRATCH_MAX_BYTES)
+
+        segment_encoder = None
+        if settings.STITCH_SEGMENT_THREADS > 1:
+            segment_encoder = SegmentedEncoder(
+                    ffmpeg_path=settings.STITCH_FFMPEG_PATH,
+                    threads=settings.STITCH_SEGMENT_THREADS,
+                    segment_seconds=settings.STITCH_SEGMENT_SECONDS,
+                    governor=self.governor)
+
         def stitcher_factory():
             return FFMpegSoxStitcher(
                     ffmpeg_path=settings.STITCH_FFMPEG_PATH,
                     sox_path=settings.STITCH_SOX_PATH,
                     storage_pool=self.filesystem_storage_pool,
-                    working_directory=settings.STITCH_WORKING_DIRECTORY)
+                    working_directory=settings.STITCH_WORKING_DIRECTORY,
+                    ffprobe_path=settings.STITCH_FFPROBE_PATH,
+                    stats_engine=stats_engine_factory(),
+                    intermediate_format=settings.STITCH_INTERMEDIATE_FORMAT,
+                    streaming=settings.STITCH_STREAMING,
+                    mix_fan_in=settings.STITCH_MIX_FAN_IN,
+                    mix_threads=settings.STITCH_MIX_THREADS,
+                    segment_encoder=segment_encoder,
+                    governor=self.governor,
+                    scratch=self.scratch)
         self.stitcher_pool = QueuePool(
                 size=settings.ARCHIVER_THREADS,
                 factory=Factory(stitcher_factory))
@@ -90,21 +157,74 @@ class ArchiveServiceHandler(TArchiveService.Iface, ServiceHandler):
             return FFMpegWaveformGenerator(
                     ffmpeg_path=settings.STITCH_FFMPEG_PATH,
                     storage_pool=self.filesystem_storage_pool,
-                    working_directory=settings.STITCH_WORKING_DIRECTORY)
+                    working_directory=settings.STITCH_WORKING_DIRECTORY,
+                    stats_engine=stats_engine_factory(),
+                    governor=self.governor,
+                    scratch=self.scratch)
         self.waveform_generator_pool = QueuePool(
                 size=settings.ARCHIVER_THREADS,
                 factory=Factory(waveform_generator_factory))
     
+        #process-wide lookup table cache, loaded on start
+        self.lookup_cache = LookupCache(
+                ttl_seconds=settings.LOOKUP_CACHE_TTL_SECONDS,
+                db_session_factory=self.get_database_session)
+
+        #remote container listings shared by all persisters
+        self.container_index = ContainerIndex(
+                ttl_seconds=settings.PERSISTER_INDEX_TTL_SECONDS)
+
         def persister_factory():
             return DefaultPersister(
                     db_session_factory=self.get_database_session,
                     local_storage_pool=self.filesystem_storage_pool,
                     public_storage_pool=self.cloudfiles_public_storage_pool,
-                    private_storage_pool=self.cloudfiles_private_storage_pool)
+                    private_storage_pool=self.cloudfiles_private_storage_pool,
+                    upload_threads=settings.PERSISTER_UPLOAD_THREADS,
+                    segment_bytes=settings.PERSISTER_SEGMENT_BYTES,
+                    container_index=self.container_index,
+                    lookup_cache=self.lookup_cache)
         self.persister_pool = QueuePool(
                 size=settings.ARCHIVER_THREADS,
                 factory=Factory(persister_factory))
         
+        #delete sweeper removes media streams from the vendor
+        #in the background once archives have been persisted.
+        #It uses its own fetcher so it never competes with
+        #archiver threads for the fetcher pool.
+        self.delete_sweeper = ArchiveDeleteSweeper(
+                fetcher_pool=QueuePool(
+                    size=1,
+                    factory=Factory(fetcher_factory)),
+                journal=ArchiveDeleteJournal(
+                    directory=settings.ARCHIVER_DELETE_DIRECTORY),
+                batch_size=settings.ARCHIVER_DELETE_BATCH_SIZE,
+                deletes_per_second=settings.ARCHIVER_DELETE_RATE,
+                poll_seconds=settings.ARCHIVER_DELETE_POLL_SECONDS,
+                retry_seconds=settings.ARCHIVER_DELETE_RETRY_SECONDS,
+                max_attempts=settings.ARCHIVER_DELETE_MAX_ATTEMPTS)
+
+        #prefetcher downloads media streams for queued jobs
+        #while archiver threads are busy stitching. It uses its
+        #own fetcher and filesystem storage, so it never holds
+        #objects archiver threads are waiting for.
+        self.prefetcher = None
+        if settings.ARCHIVER_PREFETCH_LOOKAHEAD:
+            prefetch_storage_pool = QueuePool(
+                    size=1,
+                    factory=Factory(filesystem_storage_factory))
+            self.prefetcher = ArchivePrefetcher(
+                    db_session_factory=self.get_database_session,
+                    fetcher_pool=QueuePool(
+                        size=1,
+                        factory=Factory(
+                            lambda: fetcher_factory(prefetch_storage_pool))),
+                    lookahead=settings.ARCHIVER_PREFETCH_LOOKAHEAD,
+                    max_bytes=settings.ARCHIVER_PREFETCH_MAX_BYTES,
+                    poll_seconds=settings.ARCHIVER_PREFETCH_POLL_SECONDS,
+                    expire_seconds=settings.ARCHIVER_PREFETCH_EXPIRE_SECONDS,
+                    horizon_seconds=settings.ARCHIVER_PREFETCH_HORIZON_SECONDS)
+
         #archiver coordinates creation of archives.
         self.archiver = Archiver(
                 db_session_factory=self.get_database_session,
@@ -115,11 +235,24 @@ class ArchiveServiceHandler(TArchiveService.Iface, ServiceHandler):
                 num_threads=settings.ARCHIVER_THREADS,
                 poll_seconds=settings.ARCHIVER_POLL_SECONDS,
                 job_retry_seconds=settings.ARCHIVER_JOB_RETRY_SECONDS,
-                timestamp_filenames=settings.ARCHIVER_TIMESTAMP_FILENAMES)
+                timestamp_filenames=settings.ARCHIVER_TIMESTAMP_FILENAMES,
+                delete_sweeper=self.delete_sweeper,
+                prefetcher=self.prefetcher,
+                scratch=self.scratch,
+                scratch_collector=ScratchCollector(
+                    scratch=self.scratch,
+                    poll_seconds=settings.STITCH_SCRATCH_COLLECT_SECONDS),
+                layout=ArchiveLayout(
+                    prefix=settings.ARCHIVER_LAYOUT_PREFIX,
+                    depth=settings.ARCHIVER_LAYOUT_DEPTH,
+                    width=settings.ARCHIVER_LAYOUT_WIDTH),
+                local_storage_pool=self.filesystem_storage_pool,
+                governor=self.governor)
     
     def start(self):
         """Start handler."""
         super(ArchiveServiceHandler, self).start()
+        self.lookup_cache.load(self.get_database_session)
         self.archiver.start()
 
     
@@ -133,5 +266,30 @@ class ArchiveServiceHandler(TArchiveService.Iface, ServiceHandler):
         join([self.archiver, super(ArchiveServiceHandler, self)], timeout)
 
     def reinitialize(self, requestContext):
-        """Reinitialize - nothing to do."""
-        pass
+        """Reinitialize - reload lookup table cache."""
+        self.lookup_cache.load(self.get_database_session)
+
+    def _counters(self):
+        """Get dict of archive counters."""
+        result = self.governor.counters()
+        result.update(self.scratch.counters())
+        result.update(self.cloudfiles_public_storage_pool.counters(
+            "cloudfiles_public_pool"))
+        result.update(self.cloudfiles_private_storage_pool.counters(
+            "cloudfiles_private_pool"))
+        result.update(self.container_index.counters())
+        result.update(self.lookup_cache.counters())
+        return result
+
+    def getCounters(self, requestContext):
+        """Get service counters, including media process usage."""
+        result = super(ArchiveServiceHandler, self).getCounters(requestContext)
+        result.update(self._counters())
+        return result
+
+    def getCounter(self, requestContext, key):
+        """Get service counter, including media process usage."""
+        counters = self._counters()
+        if key in counters:
+            return counters[key]
+        return super(ArchiveServiceHandler, self).getCounter(requestContext, key)
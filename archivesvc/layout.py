@@ -0,0 +1,87 @@
+import hashlib
+import os
+import re
+
+class ArchiveLayout(object):
+    """Storage layout of archive files.
+
+    Archive files are named after the encoded chat id, i.e.
+    archive/<encoded_chat_id>-<call_sid>.mp3, and are placed in
+    hash prefix subdirectories of prefix so that no single
+    directory holds the files of every chat, i.e.
+    archive/3f/a2/<encoded_chat_id>-<call_sid>.mp3 for depth=2.
+
+    The layout is applied to the base output filename of a job,
+    from which the fetcher, stitcher, waveform generator and
+    persister derive all of their filenames.
+    """
+
+    def __init__(self, prefix="archive", depth=0, width=2):
+        """ArchiveLayout constructor.
+
+        Args:
+            prefix: filename prefix of all archive files
+            depth: number of hash prefix subdirectories. 0 places
+                all files directly under prefix.
+            width: number of hex digits in each subdirectory name
+        """
+        self.prefix = prefix
+        self.depth = depth
+        self.width = width
+
+    def shard(self, key):
+        """Get hash prefix subdirectory path for key.
+
+        Args:
+            key: file key, i.e. encoded chat id
+        Returns:
+            subdirectory path relative to prefix, or "" if depth is 0.
+        """
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        parts = [digest[i * self.width:(i + 1) * self.width]
+                for i in range(self.depth)]
+        return "/".join(parts)
+
+    def directory(self, key):
+        """Get directory of files for key."""
+        shard = self.shard(key)
+        if shard:
+            return "%s/%s" % (self.prefix, shard)
+        return self.prefix
+
+    def filename(self, key):
+        """Get base output filename for key.
+
+        Args:
+            key: file key, i.e. encoded chat id
+        Returns:
+            base output filename to derive archive filenames from.
+        """
+        return "%s/%s" % (self.directory(key), key)
+
+    def key(self, filename):
+        """Get key of an archive filename in any layout.
+
+        Args:
+            filename: archive filename, i.e. archive/<key>-<call_sid>.mp3
+        Returns:
+            file key
+        """
+        return re.split(r"[-.]", os.path.basename(filename), 1)[0]
+
+    def relocate(self, filename):
+        """Get filename of an archive file in this layout.
+
+        Args:
+            filename: archive filename in any layout with the
+                same prefix.
+        Returns:
+            filename in this layout, which is filename itself if
+            it's already in this layout.
+        """
+        basename = os.path.basename(filename)
+        return "%s/%s" % (self.directory(self.key(filename)), basename)
+
+    def contains(self, filename):
+        """Check if filename is an archive filename under prefix."""
+        return filename.startswith("%s/" % self.prefix)
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+
+from trsvcscore.db.models import ChatArchiveType, MimeType
+
+class LookupCacheException(Exception):
+    """Lookup cache exception."""
+    pass
+
+
+class LookupCache(object):
+    """In-process cache of lookup table model ids.
+
+    Lookup tables, i.e. ChatArchiveType and MimeType, are small
+    and effectively static, so they're loaded in full with
+    preload() and shared process-wide. Ids missing from the cache
+    are queried through the caller's session (read-through). If
+    ttl_seconds and db_session_factory are set, the cache is
+    reloaded in its own session once it's older than ttl_seconds,
+    so a failed reload never aborts the caller's transaction.
+    """
+
+    def __init__(self, ttl_seconds=None, db_session_factory=None):
+        """LookupCache constructor.
+
+        Args:
+            ttl_seconds: optional number of seconds after which
+                cached ids are reloaded.
+            db_session_factory: optional callable returning
+                sqlalchemy Session object, used to reload cached
+                ids after ttl_seconds.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.db_session_factory = db_session_factory
+        self.ids = {}
+        self.loaded = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.lock = threading.Lock()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def get(self, db_session, model_class, attribute, value):
+        """Get id of model_class row with attribute equal to value.
+
+        Args:
+            db_session: sqlalchemy Session used on cache miss
+            model_class: lookup table model class
+            attribute: model attribute name
+            value: model attribute value
+        Returns:
+            model id
+        Raises:
+            LookupCacheException if no such row exists,
+            SQLAlchemy exceptions.
+        """
+        with self.lock:
+            expired = self.ttl_seconds is not None \
+                    and self.db_session_factory is not None \
+                    and time.time() - self.loaded > self.ttl_seconds
+            if expired:
+                #only one caller reloads
+                self.loaded = time.time()
+        if expired:
+            #failures are logged, stale ids are still valid
+            self.load(self.db_session_factory)
+
+        key = (model_class.__name__, attribute, value)
+        with self.lock:
+            if key in self.ids:
+                self.hits += 1
+                return self.ids[key]
+            self.misses += 1
+
+        model = db_session.query(model_class)\
+                .filter_by(**{attribute: value})\
+                .first()
+        if model is None:
+            raise LookupCacheException("no %s with %s=%r" \
+                    % (model_class.__name__, attribute, value))
+
+        with self.lock:
+            self.ids[key] = model.id
+        return model.id
+
+    def preload(self, db_session):
+        """Load all lookup table ids, replacing cached ids.
+
+        Args:
+            db_session: sqlalchemy Session object
+        Raises:
+            SQLAlchemy exceptions.
+        """
+        ids = {}
+        for model in db_session.query(ChatArchiveType).all():
+            ids[("ChatArchiveType", "name", model.name)] = model.id
+        for model in db_session.query(MimeType).all():
+            ids[("MimeType", "extension", model.extension)] = model.id
+
+        with self.lock:
+            self.ids = ids
+            self.loaded = time.time()
+            self.loads += 1
+        self.log.info("Loaded %s lookup ids" % len(ids))
+
+    def load(self, db_session_factory):
+        """Load all lookup table ids in a new session.
+
+        Failures are logged, not raised, since ids are
+        still read through on demand.
+
+        Args:
+            db_session_factory: callable returning sqlalchemy Session object
+        """
+        db_session = None
+        try:
+            db_session = db_session_factory()
+            self.preload(db_session)
+            db_session.commit()
+        except Exception as error:
+            self.log.exception(error)
+            if db_session:
+                db_session.rollback()
+        finally:
+            if db_session:
+                db_session.close()
+
+    def chat_archive_type_id(self, db_session, name):
+        """Get ChatArchiveType model id for type name."""
+        return self.get(db_session, ChatArchiveType, "name", name)
+
+    def mime_type_id(self, db_session, extension):
+        """Get MimeType model id for file extension, i.e. '.mp3'."""
+        return self.get(db_session, MimeType, "extension", extension)
+
+    def counters(self):
+        """Get dict of lookup cache counters."""
+        with self.lock:
+            return {
+                "lookup_cache_size": len(self.ids),
+                "lookup_cache_hits": self.hits,
+                "lookup_cache_misses": self.misses,
+                "lookup_cache_loads": self.loads
+            }
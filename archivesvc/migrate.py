@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import sys
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from trsvcscore.db.models import ChatArchive
+
+from layout import ArchiveLayout
+from transfer import copy_file
+
+class LayoutMigratorException(Exception):
+    """Layout migrator exception."""
+    pass
+
+
+class LayoutMigrator(object):
+    """Archive layout migrator.
+
+    Moves existing archive files into an ArchiveLayout and updates
+    the paths of ChatArchive models referencing them. Files are
+    copied in parallel, models are updated in batches after their
+    files have been copied, and originals are deleted once the
+    batch is committed, so models always reference an existing
+    file. Migration is idempotent and may be interrupted and rerun,
+    or rerun with a different layout.
+    """
+
+    def __init__(self,
+            db_session_factory,
+            layout,
+            local_storage_pool,
+            remote_storage_pools=None,
+            threads=4,
+            batch_size=100,
+            dry_run=False):
+        """LayoutMigrator constructor.
+
+        Args:
+            db_session_factory: callable returning sqlalchemy Session object
+            layout: ArchiveLayout object to migrate files to
+            local_storage_pool: Pool object containing Storage objects
+                accessible on the local filesystem.
+            remote_storage_pools: optional list of Pool objects
+                containing Storage objects archives were persisted to.
+            threads: number of files to move concurrently
+            batch_size: number of ChatArchive models updated per
+                transaction.
+            dry_run: if True, log moves without moving files
+                or updating models.
+        """
+        self.db_session_factory = db_session_factory
+        self.layout = layout
+        self.local_storage_pool = local_storage_pool
+        self.remote_storage_pools = remote_storage_pools or []
+        self.threads = threads
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.moved = 0
+        self.failed = 0
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _copy_local(self, filename, new_filename):
+        """Link file in local storage to new_filename, if present.
+
+        Both names are on the same filesystem, so the file is
+        hardlinked rather than copied, keeping its mode and using
+        no additional disk until the original is deleted.
+        """
+        with self.local_storage_pool.get() as storage_backend:
+            path = storage_backend.path(filename)
+            new_path = storage_backend.path(new_filename)
+            if os.path.exists(path) and not os.path.exists(new_path):
+                copy_file(path, new_path, link=True)
+
+    def _delete_local(self, filename):
+        """Delete file in local storage, if present."""
+        with self.local_storage_pool.get() as storage_backend:
+            path = storage_backend.path(filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _segments(self, storage_backend, filename):
+        """Get segment names of filename if it's a manifest object.
+
+        Returns:
+            list of segment names, or None if filename is a regular
+            object or the storage backend has no manifest objects.
+        """
+        segments = getattr(storage_backend, "segments", None)
+        if segments is None:
+            return None
+        return segments(filename)
+
+    def _copy_object(self, storage_backend, filename, new_filename):
+        """Copy object in remote storage, unless already copied."""
+        if not storage_backend.exists(new_filename):
+            with storage_backend.open(filename, "r") as file:
+                storage_backend.save(new_filename, file)
+
+    def _copy_remote(self, storage_pool, filename, new_filename):
+        """Copy file in remote storage, if present.
+
+        Segmented files are copied segment by segment, and made
+        visible under new_filename by a new manifest once all
+        segments are copied, so they stay segmented.
+        """
+        with storage_pool.get() as storage_backend:
+            if not storage_backend.exists(filename):
+                return
+            segments = self._segments(storage_backend, filename)
+            if segments is None:
+                self._copy_object(storage_backend, filename, new_filename)
+                return
+
+            new_segments = []
+            for segment in segments:
+                new_segment = new_filename + segment[len(filename):]
+                self._copy_object(storage_backend, segment, new_segment)
+                new_segments.append(new_segment)
+            if not storage_backend.exists(new_filename):
+                storage_backend.save_manifest(new_filename, new_segments)
+
+    def _delete_remote(self, storage_pool, filename):
+        """Delete file in remote storage, if present.
+
+        The manifest of a segmented file is deleted before its
+        segments, so it never references missing segments.
+        """
+        with storage_pool.get() as storage_backend:
+            if storage_backend.exists(filename):
+                segments = self._segments(storage_backend, filename)
+                storage_backend.delete(filename)
+                for segment in segments or []:
+                    storage_backend.delete(segment)
+
+    def _copy(self, move):
+        """Copy file everywhere it's stored.
+
+        This method is invoked in the context of a pool thread.
+
+        Args:
+            move: (filename, new_filename) tuple
+        Returns:
+            True if the file was copied, False otherwise.
+        """
+        filename, new_filename = move
+        if self.dry_run:
+            self.log.info("Would move '%s' to '%s'" % (filename, new_filename))
+            return True
+        try:
+            for storage_pool in self.remote_storage_pools:
+                self._copy_remote(storage_pool, filename, new_filename)
+            self._copy_local(filename, new_filename)
+            return True
+        except Exception as error:
+            self.log.error("Failed to copy '%s' to '%s': %s" \
+                    % (filename, new_filename, str(error)))
+            return False
+
+    def _delete(self, move):
+        """Delete original file everywhere it's stored.
+
+        This method is invoked in the context of a pool thread.
+
+        Args:
+            move: (filename, new_filename) tuple
+        Returns:
+            True if the file was deleted, False otherwise.
+        """
+        filename, new_filename = move
+        if self.dry_run:
+            return True
+        try:
+            for storage_pool in self.remote_storage_pools:
+                self._delete_remote(storage_pool, filename)
+            self._delete_local(filename)
+            return True
+        except Exception as error:
+            self.log.error("Failed to delete '%s' moved to '%s': %s" \
+                    % (filename, new_filename, str(error)))
+            return False
+
+    def _copy_all(self, pool, filenames):
+        """Copy filenames into self.layout concurrently.
+
+        Args:
+            pool: ThreadPool object
+            filenames: list of filenames to move into self.layout
+        Returns:
+            dict of copied filename to new filename.
+        """
+        moves = []
+        for filename in sorted(set(filenames)):
+            new_filename = self.layout.relocate(filename)
+            if new_filename != filename:
+                moves.append((filename, new_filename))
+
+        result = {}
+        for move, copied in zip(moves, pool.map(self._copy, moves)):
+            if copied:
+                result[move[0]] = move[1]
+            else:
+                self.failed += 1
+        return result
+
+    def _delete_all(self, pool, copied):
+        """Delete copied originals concurrently.
+
+        Originals must only be deleted once nothing references
+        them, i.e. after models referencing them are committed.
+
+        Args:
+            pool: ThreadPool object
+            copied: dict of copied filename to new filename
+        """
+        moves = sorted(copied.items())
+        for deleted in pool.map(self._delete, moves):
+            if deleted:
+                self.moved += 1
+            else:
+                self.failed += 1
+
+    def migrate_archives(self, pool):
+        """Move persisted archive files and update ChatArchive models.
+
+        Args:
+            pool: ThreadPool object
+        """
+        last_id = 0
+        while True:
+            db_session = None
+            try:
+                db_session = self.db_session_factory()
+                archives = db_session.query(ChatArchive)\
+                        .filter(ChatArchive.id > last_id)\
+                        .order_by(ChatArchive.id)\
+                        .limit(self.batch_size)\
+                        .all()
+                if not archives:
+                    break
+                last_id = archives[-1].id
+
+                filenames = []
+                for archive in archives:
+                    for filename in [archive.path, archive.waveform_path]:
+                        if filename and self.layout.contains(filename):
+                            filenames.append(filename)
+                copied = self._copy_all(pool, filenames)
+
+                for archive in archives:
+                    if archive.path in copied:
+                        archive.path = copied[archive.path]
+                    if archive.waveform_path in copied:
+                        archive.waveform_path = copied[archive.waveform_path]
+
+                if self.dry_run:
+                    db_session.rollback()
+                else:
+                    db_session.commit()
+
+                #originals are deleted only after models reference
+                #their copies, so an interruption at any point leaves
+                #every model referencing an existing file.
+                self._delete_all(pool, copied)
+                self.log.info("Migrated archives through id=%s" % last_id)
+            except Exception as error:
+                if db_session:
+                    db_session.rollback()
+                raise LayoutMigratorException(str(error))
+            finally:
+                if db_session:
+                    db_session.close()
+
+    def migrate_files(self, pool):
+        """Move remaining local archive files not referenced by models.
+
+        Args:
+            pool: ThreadPool object
+        """
+        with self.local_storage_pool.get() as storage_backend:
+            root = storage_backend.path(self.layout.prefix)
+
+        filenames = []
+        for directory, directories, names in os.walk(root):
+            for name in names:
+                relative_path = os.path.relpath(
+                        os.path.join(directory, name), root)
+                filenames.append("%s/%s" % (self.layout.prefix,
+                    relative_path.replace(os.sep, "/")))
+
+        for index in range(0, len(filenames), self.batch_size):
+            batch = filenames[index:index + self.batch_size]
+            self._delete_all(pool, self._copy_all(pool, batch))
+
+    def migrate(self):
+        """Migrate archive files and models to self.layout.
+
+        Raises:
+            LayoutMigratorException
+        """
+        pool = ThreadPool(self.threads)
+        try:
+            self.migrate_archives(pool)
+            self.migrate_files(pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.log.info("Moved %s files, %s failed" % (self.moved, self.failed))
+        if self.failed:
+            raise LayoutMigratorException(
+                    "failed to move %s files" % self.failed)
+
+
+def main(argv):
+
+    def parse_arguments():
+        parser = argparse.ArgumentParser(
+                description="migrate.py moves archive files into the configured layout",
+                epilog="""Examples:
+    migrate.py --env prod --dry-run    #Log moves for prod
+    migrate.py --env prod --threads 8  #Migrate prod
+""",
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument("-e", "--env", help="service environment")
+        parser.add_argument("-t", "--threads", default=4, type=int, help="Number of concurrent moves.")
+        parser.add_argument("-b", "--batch-size", default=100, type=int, help="Number of models updated per transaction.")
+        parser.add_argument("-d", "--depth", type=int, help="Layout depth (defaults to ARCHIVER_LAYOUT_DEPTH).")
+        parser.add_argument("-n", "--dry-run", action="store_true", help="Log moves without moving files.")
+        parser.add_argument("--local-only", action="store_true", help="Do not move files in cloudfiles containers.")
+        return parser.parse_args(argv[1:])
+
+    #configure logger
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setLevel(logging.INFO)
+    logger.addHandler(consoleHandler)
+
+    log = logging.getLogger("main")
+
+    args = parse_arguments()
+
+    #environment must be set prior to settings import
+    if args.env:
+        os.environ["SERVICE_ENV"] = args.env
+    import settings
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from trpycore.factory.base import Factory
+    from trpycore.pool.queue import QueuePool
+    from trsvcscore.storage.cloudfiles import CloudfilesStoragePool
+    from trsvcscore.storage.filesystem import FileSystemStorage
+    from trrackspace.services.cloudfiles.factory import CloudfilesClientFactory
+
+    def filesystem_storage_factory():
+        return FileSystemStorage(
+            location=settings.FILESYSTEM_STORAGE_LOCATION)
+    local_storage_pool = QueuePool(
+            size=args.threads,
+            factory=Factory(filesystem_storage_factory))
+
+    remote_storage_pools = []
+    if not args.local_only:
+        cloudfiles_client_factory = CloudfilesClientFactory(
+                username=settings.CLOUDFILES_USERNAME,
+                api_key=settings.CLOUDFILES_API_KEY,
+                password=settings.CLOUDFILES_PASSWORD,
+                servicenet=settings.CLOUDFILES_SERVICENET,
+                retries=settings.CLOUDFILES_RETRIES,
+                timeout=settings.CLOUDFILES_TIMEOUT,
+                debug_level=settings.CLOUDFILES_DEBUG_LEVEL)
+        for container_name in [settings.CLOUDFILES_PUBLIC_CONTAINER_NAME,
+                settings.CLOUDFILES_PRIVATE_CONTAINER_NAME]:
+            remote_storage_pools.append(CloudfilesStoragePool(
+                cloudfiles_client_factory=cloudfiles_client_factory,
+                container_name=container_name,
+                size=args.threads))
+
+    layout = ArchiveLayout(
+            prefix=settings.ARCHIVER_LAYOUT_PREFIX,
+            depth=settings.ARCHIVER_LAYOUT_DEPTH \
+                    if args.depth is None else args.depth,
+            width=settings.ARCHIVER_LAYOUT_WIDTH)
+
+    migrator = LayoutMigrator(
+            db_session_factory=sessionmaker(
+                bind=create_engine(settings.DATABASE_CONNECTION)),
+            layout=layout,
+            local_storage_pool=local_storage_pool,
+            remote_storage_pools=remote_storage_pools,
+            threads=args.threads,
+            batch_size=args.batch_size,
+            dry_run=args.dry_run)
+
+    try:
+        migrator.migrate()
+        return 0
+
+    except LayoutMigratorException as error:
+        log.error(str(error))
+        return 1
+
+    except KeyboardInterrupt:
+        return 2
+
+    except Exception as error:
+        log.error("Unhandled exception: %s" % str(error))
+        log.error(traceback.format_exc())
+        return 3
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
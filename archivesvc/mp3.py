@@ -0,0 +1,157 @@
+import struct
+
+#bitrates in kbps indexed by [version][layer][bitrate index]
+#version: 1 for MPEG-1, 2 for MPEG-2 / MPEG-2.5
+#layer: 1, 2, 3
+BITRATES = {
+    1: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+    },
+    2: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+    }
+}
+
+#sample rates in Hz indexed by raw version bits
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000], #MPEG-1
+    2: [22050, 24000, 16000], #MPEG-2
+    0: [11025, 12000, 8000]   #MPEG-2.5
+}
+
+
+class MP3FrameHeader(object):
+    """MPEG audio frame header."""
+    def __init__(self, version, layer, bitrate, sample_rate, padding, channels):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channels = channels
+
+    @property
+    def samples(self):
+        """Number of samples (per channel) in the frame."""
+        if self.layer == 1:
+            return 384
+        if self.layer == 3 and self.version != 1:
+            return 576
+        return 1152
+
+    @property
+    def size(self):
+        """Frame size in bytes, including the header."""
+        if self.layer == 1:
+            return (12 * self.bitrate * 1000 // self.sample_rate + self.padding) * 4
+        return self.samples // 8 * self.bitrate * 1000 // self.sample_rate + self.padding
+
+    def __repr__(self):
+        return "%s(version=%r, layer=%r, bitrate=%r, sample_rate=%r)" % (\
+                self.__class__.__name__,
+                self.version, self.layer, self.bitrate, self.sample_rate)
+
+
+def parse_frame_header(data, offset=0):
+    """Parse MPEG audio frame header at offset in data.
+
+    Args:
+        data: byte string
+        offset: offset of the header in data
+    Returns:
+        MP3FrameHeader object or None if data at offset is not
+        a valid frame header.
+    """
+    if len(data) < offset + 4:
+        return None
+    header, = struct.unpack(">I", data[offset:offset+4])
+    if header & 0xFFE00000 != 0xFFE00000:
+        return None
+
+    version_bits = (header >> 19) & 0x3
+    layer_bits = (header >> 17) & 0x3
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 0x3
+    padding = (header >> 9) & 0x1
+    channel_mode = (header >> 6) & 0x3
+
+    if version_bits == 1 or layer_bits == 0 \
+            or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    version = 1 if version_bits == 3 else 2
+    layer = 4 - layer_bits
+    return MP3FrameHeader(
+            version=version,
+            layer=layer,
+            bitrate=BITRATES[version][layer][bitrate_index],
+            sample_rate=SAMPLE_RATES[version_bits][sample_rate_index],
+            padding=padding,
+            channels=1 if channel_mode == 3 else 2)
+
+def skip_id3v2(data):
+    """Get offset of first byte after an ID3v2 tag, or 0."""
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = 0
+        for byte in bytearray(data[6:10]):
+            size = (size << 7) | (byte & 0x7F)
+        return 10 + size
+    return 0
+
+def iter_frames(data, offset=0):
+    """Iterate over (offset, MP3FrameHeader) for frames in data.
+
+    Iteration stops at the first byte which is not the start
+    of a complete frame.
+    """
+    while True:
+        header = parse_frame_header(data, offset)
+        if header is None or offset + header.size > len(data):
+            return
+        yield offset, header
+        offset += header.size
+
+def has_vbr_header(data, offset, header):
+    """Check if the frame at offset carries a Xing or VBRI VBR header."""
+    frame = data[offset:offset+header.size]
+    return b"Xing" in frame or b"VBRI" in frame
+
+def is_cbr(path, frames=32):
+    """Check if the mp3 at path is constant bitrate.
+
+    Reads the first frames of the file and checks that they
+    all share a bitrate and that no VBR header is present.
+
+    Args:
+        path: local filesystem path of mp3 file
+        frames: number of frames to check
+    Returns:
+        MP3FrameHeader of the first frame if the file is CBR,
+        None otherwise.
+    """
+    with open(path, "rb") as mp3_file:
+        data = mp3_file.read(64 * 1024)
+    offset = skip_id3v2(data)
+    if offset > len(data):
+        with open(path, "rb") as mp3_file:
+            mp3_file.seek(offset)
+            data = mp3_file.read(64 * 1024)
+        offset = 0
+
+    first = None
+    count = 0
+    for frame_offset, header in iter_frames(data, offset):
+        if first is None:
+            if has_vbr_header(data, frame_offset, header):
+                return None
+            first = header
+        elif header.bitrate != first.bitrate:
+            return None
+        count += 1
+        if count >= frames:
+            break
+    return first if count else None
@@ -1,11 +1,16 @@
 import abc
 import logging
 import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-from trsvcscore.db.models import MimeType
-from trsvcscore.db.models import ChatArchive, ChatArchiveType
+from trsvcscore.db.models import ChatArchive
 
+from lookup import LookupCache
 from stream import ArchiveStreamType
+from transfer import HashingFile, MappedFile, hash_file, local_path, \
+        open_upload, upload_file
 
 class ArchivePersisterException(Exception):
     """Archive persister exception"""
@@ -33,6 +38,143 @@ class ArchivePersister(object):
         return
 
 
+class ContainerIndex(object):
+    """Short-lived index of remote storage prefix listings.
+
+    Answers existence checks for files in remote storage from a
+    single listing of the names starting with a prefix, instead of
+    one request per file. Since archive files of a job share the
+    job's base filename, checking all files of a job costs one
+    listing of only that job's files, however many files share
+    their directory. The index is shared by concurrent persisters,
+    and listings are cached for ttl_seconds.
+
+    Storage backends without list_prefix() fall back to exists().
+    """
+
+    def __init__(self, ttl_seconds=60):
+        """ContainerIndex constructor.
+
+        Args:
+            ttl_seconds: number of seconds prefix listings are cached
+        """
+        self.ttl_seconds = ttl_seconds
+        self.listings = {}
+        self.listing_locks = {}
+        self.hits = 0
+        self.prefix_lists = 0
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _listing(self, key):
+        """Get cached listing for key, or None if missing or expired.
+
+        This method must be called with self.lock held.
+        """
+        listing = self.listings.get(key)
+        if listing is not None \
+                and time.time() - listing[0] > self.ttl_seconds:
+            del self.listings[key]
+            listing = None
+        return listing
+
+    def _list(self, storage_pool, prefix):
+        """List filenames starting with prefix.
+
+        Returns:
+            set of filenames starting with prefix, or None if the
+            storage backend can not list prefixes.
+        """
+        with storage_pool.get() as storage_backend:
+            list_prefix = getattr(storage_backend, "list_prefix", None)
+            if list_prefix is None:
+                return None
+            try:
+                filenames = list_prefix(prefix)
+            except Exception as error:
+                self.log.debug("Unable to list '%s': %s" \
+                        % (prefix, str(error)))
+                return None
+        return set(filenames)
+
+    def exists(self, storage_pool, filename, prefix=None):
+        """Check if filename exists in storage_pool's storage.
+
+        Args:
+            storage_pool: Pool object containing Storage objects
+            filename: filename to check
+            prefix: optional prefix of filename, shared with other
+                filenames checked, i.e. the job's base filename.
+                Defaults to filename.
+        Returns:
+            True if filename exists, False otherwise.
+        Raises:
+            ArchivePersisterException, StorageException
+        """
+        prefix = prefix or filename
+        if not filename.startswith(prefix):
+            raise ArchivePersisterException(
+                    "'%s' does not start with '%s'" % (filename, prefix))
+        key = (storage_pool, prefix)
+
+        with self.lock:
+            listing = self._listing(key)
+            listing_lock = self.listing_locks.setdefault(key, threading.Lock())
+
+        if listing is None:
+            #single listing per prefix for concurrent callers
+            with listing_lock:
+                with self.lock:
+                    listing = self._listing(key)
+                if listing is None:
+                    try:
+                        filenames = self._list(storage_pool, prefix)
+                        listing = (time.time(), filenames)
+                        with self.lock:
+                            self.listings[key] = listing
+                            self.prefix_lists += 1
+                    finally:
+                        with self.lock:
+                            self.listing_locks.pop(key, None)
+        else:
+            with self.lock:
+                self.hits += 1
+
+        if listing[1] is None:
+            with self.lock:
+                self.fallbacks += 1
+            with storage_pool.get() as storage_backend:
+                return storage_backend.exists(filename)
+        return filename in listing[1]
+
+    def add(self, storage_pool, filename):
+        """Record that filename has been saved to storage_pool's storage."""
+        with self.lock:
+            for key in list(self.listings):
+                pool, prefix = key
+                if pool is storage_pool and filename.startswith(prefix):
+                    listing = self._listing(key)
+                    if listing is not None and listing[1] is not None:
+                        listing[1].add(filename)
+
+    def counters(self):
+        """Get dict of container index counters."""
+        with self.lock:
+            now = time.time()
+            for key in [k for k, l in self.listings.items()
+                    if now - l[0] > self.ttl_seconds]:
+                del self.listings[key]
+            return {
+                "container_index_listings": len(self.listings),
+                "container_index_prefix_lists": self.prefix_lists,
+                "container_index_hits": self.hits,
+                "container_index_fallbacks": self.fallbacks
+            }
+
+
 class DefaultPersister(ArchivePersister):
     """Default persister implementation.
 
@@ -48,7 +190,11 @@ class DefaultPersister(ArchivePersister):
             db_session_factory,
             local_storage_pool,
             public_storage_pool=None,
-            private_storage_pool=None):
+            private_storage_pool=None,
+            upload_threads=4,
+            segment_bytes=None,
+            container_index=None,
+            lookup_cache=None):
         """DefaultPersister constructor.
 
         Args:
@@ -61,126 +207,263 @@ class DefaultPersister(ArchivePersister):
             private_storage_pool: Pool object containing Storage object
                 which will be used to store media stream which contain
                 video and should be kept private.
+            upload_threads: maximum number of concurrent uploads
+            segment_bytes: optional segment size in bytes. Larger
+                files are uploaded in concurrent segments to storage
+                backends which support manifest objects, i.e.
+                implement save_manifest(name, segment_names).
+            container_index: optional ContainerIndex object, shared
+                with other persisters, used to check which files
+                already exist in storage.
+            lookup_cache: optional LookupCache object used to get
+                ChatArchiveType and MimeType model ids.
         """
         self.db_session_factory = db_session_factory
         self.local_storage_pool = local_storage_pool
         self.public_storage_pool = public_storage_pool
         self.private_storage_pool = private_storage_pool
+        self.upload_threads = upload_threads
+        self.segment_bytes = segment_bytes
+        self.container_index = container_index or ContainerIndex()
+        self.lookup_cache = lookup_cache or LookupCache()
 
         self.log = logging.getLogger("%s.%s" \
                 % (__name__, self.__class__.__name__))
 
-    def _upload_public_archive_streams(self, archive_streams):
-        """Upload public archive streams.
+    def _upload_plan(self, archive_streams):
+        """Get uploads needed to persist archive_streams.
+
+        Public (audio only) archive streams and their waveforms are
+        uploaded to self.public_storage_pool, and private (containing
+        video) archive streams to self.private_storage_pool.
 
-        Uploads public (audio only) archive streams in archive_streams to 
-        self.public_storage_pool.
+        Files which already exist in storage, i.e. from a previous
+        attempt, are skipped if their remote ETag matches the md5 of
+        the local file, or if the storage backend does not expose
+        ETags. Files which differ, i.e. were truncated by an earlier
+        upload, are uploaded again. Segmented files are only made
+        visible once all segments are uploaded, so they're skipped
+        if they exist.
 
         Args:
             archive_streams: list of ArchiveStream objects.
+        Returns:
+            list of (storage_pool, filename, path, segments) tuples,
+            where path is the local filesystem path of filename and
+            segments is a list of (offset, length) tuples for files
+            which should be uploaded in segments, or None.
         Raises:
-            StroageException
+            StorageException
         """
-        if self.public_storage_pool is None:
-            return
+        uploads = []
+        hashes = {}
+        for stream in archive_streams:
+            if stream.content_hash:
+                hashes[stream.filename] = stream.content_hash
+            if stream.type == ArchiveStreamType.STITCHED_AUDIO_STREAM:
+                storage_pool = self.public_storage_pool
+                filenames = [stream.filename, stream.waveform_filename]
+            else:
+                storage_pool = self.private_storage_pool
+                filenames = [stream.filename]
+            if storage_pool is None:
+                continue
+            for filename in filenames:
+                if filename and (storage_pool, filename) not in uploads:
+                    uploads.append((storage_pool, filename))
+
+        with self.local_storage_pool.get() as local_storage:
+            paths = [local_storage.path(filename) for _, filename in uploads]
+
+        #files of a job share its base filename, so a single listing
+        #of their common prefix answers every existence check.
+        prefix = os.path.commonprefix([filename for _, filename in uploads])
+
+        result = []
+        features = {}
+        for (storage_pool, filename), path in zip(uploads, paths):
+            if storage_pool not in features:
+                with storage_pool.get() as storage_backend:
+                    features[storage_pool] = (
+                            hasattr(storage_backend, "save_manifest"),
+                            hasattr(storage_backend, "etag"))
+            manifests, etags = features[storage_pool]
+
+            size = os.path.getsize(path)
+            segmented = self.segment_bytes and manifests \
+                    and size > self.segment_bytes
+
+            #never list a whole directory for unrelated files
+            job_prefix = prefix
+            if len(prefix) <= len(os.path.dirname(filename)) + 1:
+                job_prefix = filename
 
-        #public archive streams
-        with self.public_storage_pool.get() as public_storage:
-            with self.local_storage_pool.get() as local_storage:
-                for stream in archive_streams:
-                    if stream.type == ArchiveStreamType.STITCHED_AUDIO_STREAM:
-                        if public_storage.exists(stream.filename):
-                            continue
-                        self.log.info("Uploading archive stream '%s'" \
-                                % stream)
-                        with local_storage.open(stream.filename, "r") as file:
-                            public_storage.save(stream.filename, file)
-                        self.log.info("Done uploading archive stream '%s'" \
-                                % stream)
-
-                        if stream.waveform_filename \
-                           and not public_storage.exists(stream.waveform_filename):
-                            self.log.info("Uploading waveform for archive stream '%s'" \
-                                    % stream)
-                            with local_storage.open(stream.waveform_filename, "r") as file:
-                                public_storage.save(stream.waveform_filename, file)
-                            self.log.info("Done uploading waveform for archive stream '%s'" \
-                                    % stream)
-        
-    def _upload_private_archive_streams(self, archive_streams):
-        """Upload private archive streams.
-
-        Uploads private (containing video) archive streams in archive_streams
-        to self.private_storage_pool.
+            if self.container_index.exists(storage_pool, filename, job_prefix):
+                if segmented or not etags:
+                    continue
+                content_hash = hashes.get(filename) or hash_file(path)
+                with storage_pool.get() as storage_backend:
+                    etag = storage_backend.etag(filename)
+                if etag and etag.strip('"') == content_hash:
+                    continue
+                self.log.warning("Remote '%s' differs from local file, "
+                        "uploading again" % filename)
+
+            segments = None
+            if segmented:
+                segments = [(offset, min(self.segment_bytes, size - offset))
+                        for offset in range(0, size, self.segment_bytes)]
+            result.append((storage_pool, filename, path, segments))
+        return result
+
+    def _segment_filename(self, filename, index):
+        """Get filename of segment index of filename."""
+        return "%s/%08d" % (filename, index)
+
+    def _upload(self, upload):
+        """Upload file or file segment.
+
+        This method is invoked in the context of an upload thread.
+
+        The md5 of the uploaded data is computed while it's read
+        for the upload, and verified against the ETag of the stored
+        object if the storage backend exposes ETags.
 
         Args:
-            archive_streams: list of ArchiveStream objects.
+            upload: (storage_pool, filename, path, segment) tuple,
+                where segment is an (index, offset, length) tuple or
+                None to upload the whole file.
+        Returns:
+            md5 hex digest of the uploaded data, or None if unknown.
         Raises:
-            StroageException
+            ArchivePersisterException, StorageException,
+            TransferException
         """
-        if self.private_storage_pool is None:
-            return
+        storage_pool, filename, path, segment = upload
+        with storage_pool.get() as storage_backend:
+            if segment is None:
+                if local_path(storage_backend, filename) is not None:
+                    #persisted archives are never rewritten, so may be linked
+                    upload_file(path, storage_backend, filename, link=True)
+                    return None
+                name = filename
+                body = HashingFile(open_upload(path))
+            else:
+                index, offset, length = segment
+                name = self._segment_filename(filename, index)
+                body = HashingFile(MappedFile(path, offset, length))
+
+            with body:
+                storage_backend.save(name, body)
+            content_hash = body.hexdigest()
+
+            if content_hash and hasattr(storage_backend, "etag"):
+                etag = storage_backend.etag(name)
+                if etag and etag.strip('"') != content_hash:
+                    raise ArchivePersisterException(
+                            "integrity check failed for '%s': %s != %s" \
+                            % (name, etag, content_hash))
+        return content_hash
+
+    def _upload_archive_streams(self, archive_streams):
+        """Upload archive streams.
+
+        Uploads are dispatched concurrently across the public and
+        private storage pools, with concurrency bounded by
+        self.upload_threads and the size of each storage pool. Files
+        larger than self.segment_bytes are uploaded in concurrent
+        segments, and stored as a manifest object referencing the
+        segments, if the storage backend supports manifests.
+        The md5 of each uploaded file is recorded as the stream's
+        content_hash, so it's saved with the job manifest on retry.
 
-        #private archives streams
-        with self.private_storage_pool.get() as private_storage:
-            with self.local_storage_pool.get() as local_storage:
-                for stream in archive_streams:
-                    if stream.type != ArchiveStreamType.STITCHED_AUDIO_STREAM:
-                        if private_storage.exists(stream.filename):
-                            continue
-                        self.log.info("Uploading archive stream '%s'" \
-                                % stream)
-                        with local_storage.open(stream.filename, "r") as file:
-                            private_storage.save(stream.filename, file)
-                        self.log.info("Done uploading archive stream '%s'" \
-                                % stream)
-    
-    def _get_chat_archive_type_id(self, archive_stream):
-        """Get ChatArchiveType model id for specified archive_stream.
-        
         Args:
-            archive_stream: ArchiveStream object
-        Returns:
-            ChatArchiveType model id for specified archive_stream.
+            archive_streams: list of ArchiveStream objects.
         Raises:
-            SQLAlchemy exceptions.
+            StorageException, TransferException
         """
+        plan = self._upload_plan(archive_streams)
+        if not plan:
+            return
+
+        uploads = []
+        for storage_pool, filename, path, segments in plan:
+            if segments is None:
+                uploads.append((storage_pool, filename, path, None))
+            else:
+                for index, (offset, length) in enumerate(segments):
+                    uploads.append((storage_pool, filename, path,
+                        (index, offset, length)))
+
+        self.log.info("Uploading %s files in %s requests" \
+                % (len(plan), len(uploads)))
+        pool = ThreadPool(min(self.upload_threads, len(uploads)))
         try:
-            db_session = self.db_session_factory()
-            type = db_session.query(ChatArchiveType)\
-                    .filter_by(name=archive_stream.type)\
-                    .one()
-            return type.id
+            hashes = pool.map(self._upload, uploads)
         finally:
-            if db_session:
-                db_session.commit()
-                db_session.close()
+            pool.close()
+            pool.join()
+
+        #record hashes of whole files in the streams, and with
+        #them in the job manifest saved for retries.
+        uploaded = {}
+        for (storage_pool, filename, path, segment), content_hash \
+                in zip(uploads, hashes):
+            if segment is None and content_hash:
+                uploaded[filename] = content_hash
+        for stream in archive_streams:
+            if stream.filename in uploaded:
+                stream.content_hash = uploaded[stream.filename]
+
+        #segments are complete, make them visible as a single object
+        for storage_pool, filename, path, segments in plan:
+            if segments is not None:
+                with storage_pool.get() as storage_backend:
+                    storage_backend.save_manifest(filename,
+                            [self._segment_filename(filename, index)
+                                for index in range(len(segments))])
+        for storage_pool, filename, path, segments in plan:
+            self.container_index.add(storage_pool, filename)
+        self.log.info("Done uploading %s files" % len(plan))
 
-    def _get_mime_type_id(self, archive_stream):
-        """Get MimeType model id for specified archive_stream.
+    def _archive_attributes(self, db_session, chat_id, archive_stream):
+        """Get ChatArchive model attributes for archive_stream.
 
         Args:
+            db_session: sqlalchemy Session object
+            chat_id: chat id
             archive_stream: ArchiveStream object
         Returns:
-            MimeType model id
+            dict of ChatArchive attribute name to value
         Raises:
-            SQLAlchemy exceptions.
+            LookupCacheException, SQLAlchemy exceptions.
         """
-        try:
-            db_session = self.db_session_factory()
-            root, file_extension = os.path.splitext(archive_stream.filename)
-            mime_type = db_session.query(MimeType)\
-                    .filter_by(extension=file_extension)\
-                    .first()
-            return mime_type.id
-        finally:
-            if db_session:
-                db_session.commit()
-                db_session.close()
+        root, file_extension = os.path.splitext(archive_stream.filename)
+        is_public = archive_stream.type \
+                == ArchiveStreamType.STITCHED_AUDIO_STREAM
+
+        return {
+            "chat_id": chat_id,
+            "type_id": self.lookup_cache.chat_archive_type_id(
+                db_session, archive_stream.type),
+            "path": archive_stream.filename,
+            "mime_type_id": self.lookup_cache.mime_type_id(
+                db_session, file_extension),
+            "public": is_public,
+            "length": archive_stream.length,
+            "offset": archive_stream.offset,
+            "waveform": archive_stream.waveform,
+            "waveform_path": archive_stream.waveform_filename
+        }
 
     def persist(self, chat_id, archive_streams):
         """Persist archive stream for specified chat id.
 
+        Media streams are uploaded, then ChatArchive models for all
+        streams are inserted or updated in a single transaction.
+        Persisting the same streams again, i.e. when a job is
+        retried after a later stage failed, is a no-op.
+
         Args:
             chat_id: chat id
             archive_streams: list of ArchiveStream objects to
@@ -188,50 +471,49 @@ class DefaultPersister(ArchivePersister):
         Raises:
             ArchivePersisterException
         """
+        db_session = None
         try:
+            self._upload_archive_streams(archive_streams)
+
             db_session = self.db_session_factory()
-            
-            self._upload_public_archive_streams(archive_streams)
-            self._upload_private_archive_streams(archive_streams)
 
+            #this is necessary for now since django file fields do not
+            #support unique constraints.
+            paths = [stream.filename for stream in archive_streams]
+            existing = {}
+            for archive in db_session.query(ChatArchive)\
+                    .filter(ChatArchive.path.in_(paths))\
+                    .all():
+                existing[archive.path] = archive
+
+            archives = []
             for stream in archive_streams:
-                chat_archive_type_id = self._get_chat_archive_type_id(stream)
-                mime_type_id = self._get_mime_type_id(stream)
-                
-                #this is necessary for now since django file fields do not
-                #support unique constraints.
-                if db_session.query(ChatArchive)\
-                        .filter_by(path=stream.filename)\
-                        .count() != 0:
-                            msg = "archive already exists for '%s'"\
-                                    % stream.filename
-                            raise RuntimeError(msg)
-                
-                if stream.type == ArchiveStreamType.STITCHED_AUDIO_STREAM:
-                    is_public = True
+                attributes = self._archive_attributes(
+                        db_session, chat_id, stream)
+                archive = existing.get(stream.filename)
+                if archive is None:
+                    archives.append(ChatArchive(**attributes))
+                elif archive.chat_id != chat_id:
+                    msg = "archive already exists for '%s' (chat_id=%s)"\
+                            % (stream.filename, archive.chat_id)
+                    raise ArchivePersisterException(msg)
                 else:
-                    is_public =False
-
-                archive = ChatArchive(
-                        chat_id=chat_id,
-                        type_id=chat_archive_type_id,
-                        path=stream.filename,
-                        mime_type_id=mime_type_id,
-                        public=is_public,
-                        length=stream.length,
-                        offset=stream.offset,
-                        waveform=stream.waveform,
-                        waveform_path=stream.waveform_filename)
-
-                db_session.add(archive)
-                
+                    for name, value in attributes.items():
+                        if getattr(archive, name) != value:
+                            setattr(archive, name, value)
+
+            if archives:
+                db_session.add_all(archives)
             db_session.commit()
 
+            self.log.info("Persisted %s new and %s existing archives "
+                    "for chat_id=%s" % (len(archives), len(existing), chat_id))
+
         except Exception as error:
             self.log.exception(error)
-            db_session.rollback()
+            if db_session:
+                db_session.rollback()
             raise ArchivePersisterException(str(error))
         finally:
             if db_session:
                 db_session.close()
-
@@ -0,0 +1,161 @@
+import datetime
+import json
+import logging
+import threading
+
+from trpycore.thread.util import join
+from trpycore.timezone import tz
+from trsvcscore.db.models import ChatArchiveJob
+
+
+class ArchivePrefetcher(object):
+    """Archive prefetcher.
+
+    Looks ahead in the archive job queue and downloads the
+    media streams for upcoming jobs into local storage, so that
+    network time is overlapped with stitching during backlogs.
+    Prefetched streams are claimed by the fetcher when the
+    worker thread processes the job.
+    """
+
+    def __init__(self,
+            db_session_factory,
+            fetcher_pool,
+            lookahead=4,
+            max_bytes=1024*1024*1024,
+            poll_seconds=30,
+            expire_seconds=3600,
+            horizon_seconds=900):
+        """ArchivePrefetcher constructor.
+
+        Args:
+            db_session_factory: callable returning a new sqlalchemy
+                db session.
+            fetcher_pool: Pool object returning a Fetcher object
+                which supports prefetch().
+            lookahead: maximum number of queued jobs to prefetch.
+            max_bytes: disk budget in bytes for prefetched streams.
+            poll_seconds: number of seconds between queue scans.
+            expire_seconds: number of seconds after which unclaimed
+                prefetched streams are removed.
+            horizon_seconds: only jobs which become available within
+                horizon_seconds are prefetched, so jobs scheduled far
+                in the future, i.e. retries, don't use the budget.
+        """
+        self.db_session_factory = db_session_factory
+        self.fetcher_pool = fetcher_pool
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self.poll_seconds = poll_seconds
+        self.expire_seconds = expire_seconds
+        self.horizon_seconds = horizon_seconds
+        self.thread = None
+        self.running = False
+        self.wakeup = threading.Event()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _get_upcoming_jobs(self):
+        """Get the next unowned jobs in the archive job queue.
+
+        Only jobs which become available within horizon_seconds
+        are returned.
+
+        Returns:
+            list of (chat_id, chat_session) tuples ordered by
+            the time at which the job will become available.
+        """
+        results = []
+        db_session = None
+        horizon = tz.utcnow() + \
+                datetime.timedelta(seconds=self.horizon_seconds)
+        try:
+            db_session = self.db_session_factory()
+            jobs = db_session.query(ChatArchiveJob)\
+                    .filter(ChatArchiveJob.owner == None)\
+                    .filter(ChatArchiveJob.not_before <= horizon)\
+                    .order_by(ChatArchiveJob.not_before)\
+                    .limit(self.lookahead)\
+                    .all()
+            for job in jobs:
+                results.append((job.chat_id, json.loads(job.data)))
+            db_session.commit()
+        except Exception:
+            if db_session:
+                db_session.rollback()
+            raise
+        finally:
+            if db_session:
+                db_session.close()
+        return results
+
+    def prefetch(self):
+        """Prefetch streams for upcoming jobs within the disk budget.
+
+        Returns:
+            number of bytes downloaded.
+        """
+        result = 0
+        jobs = self._get_upcoming_jobs()
+        if not jobs:
+            return result
+
+        with self.fetcher_pool.get() as fetcher:
+            used_bytes = fetcher.prefetched_bytes(
+                    expire_seconds=self.expire_seconds)
+
+            for chat_id, chat_session in jobs:
+                if not self.running:
+                    break
+                remaining = self.max_bytes - used_bytes - result
+                if remaining <= 0:
+                    self.log.info("Prefetch disk budget exhausted")
+                    break
+                try:
+                    self.log.info("Prefetching archives for chat_id=%s" \
+                            % chat_id)
+                    result += fetcher.prefetch(
+                            chat_id=chat_id,
+                            chat_session=chat_session,
+                            max_bytes=remaining)
+                except Exception as error:
+                    #prefetch is best effort, the worker will
+                    #fetch the streams itself.
+                    self.log.exception(error)
+        return result
+
+    def start(self):
+        """Start prefetcher."""
+        if not self.running:
+            self.running = True
+            self.wakeup.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+
+    def run(self):
+        """Run prefetcher.
+
+        This method is invoked in the context of self.thread
+        """
+        while self.running:
+            try:
+                self.prefetch()
+            except Exception as error:
+                self.log.exception(error)
+
+            if self.running:
+                self.wakeup.wait(self.poll_seconds)
+
+        self.running = False
+
+    def stop(self):
+        """Stop prefetcher."""
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+
+    def join(self, timeout):
+        """Join prefetcher."""
+        if self.thread is not None:
+            join([self.thread], timeout)
@@ -0,0 +1,169 @@
+import json
+import logging
+import subprocess
+
+import mp3
+
+class MediaProbeException(Exception):
+    """Media probe exception."""
+    pass
+
+
+class MediaInfo(object):
+    """Media stream format information."""
+    def __init__(self,
+            format_name=None,
+            audio_codec=None,
+            sample_rate=None,
+            channels=None,
+            channel_layout=None,
+            has_video=False,
+            duration=None,
+            duration_reliable=False):
+        self.format_name = format_name
+        self.audio_codec = audio_codec
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.channel_layout = channel_layout
+        self.has_video = has_video
+        self.duration = duration
+        self.duration_reliable = duration_reliable
+
+    def matches(self, audio_codec, sample_rate, channels=None):
+        """Check if audio matches the given target format.
+
+        Args:
+            audio_codec: target audio codec name, i.e. 'mp3'
+            sample_rate: target sample rate in Hz
+            channels: optional target number of channels
+        Returns:
+            True if the audio stream already has the target format.
+        """
+        if self.audio_codec != audio_codec:
+            return False
+        if self.sample_rate != sample_rate:
+            return False
+        if channels is not None and self.channels != channels:
+            return False
+        return True
+
+    def __repr__(self):
+        return "%s(format_name=%r, audio_codec=%r, sample_rate=%r, channels=%r, has_video=%r, duration=%r)" % (\
+                self.__class__.__name__,
+                self.format_name, self.audio_codec, self.sample_rate,
+                self.channels, self.has_video, self.duration)
+
+
+class FFProbe(object):
+    """ffprobe based media probe.
+
+    Reads container and stream format information, including
+    duration, from container headers without decoding the media.
+    """
+
+    def __init__(self, ffprobe_path):
+        """FFProbe constructor.
+
+        Args:
+            ffprobe_path: absolute path to ffprobe executable
+        """
+        self.ffprobe_path = ffprobe_path
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _run(self, path):
+        """Run ffprobe on path.
+
+        Returns:
+            (parsed json output, ffprobe warnings) tuple
+        Raises:
+            MediaProbeException
+        """
+        ffprobe_arguments = [
+                self.ffprobe_path,
+                "-v",
+                "warning",
+                "-print_format",
+                "json",
+                "-show_format",
+                "-show_streams",
+                path
+                ]
+
+        try:
+            process = subprocess.Popen(
+                    ffprobe_arguments,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            output, warnings = process.communicate()
+            if process.returncode:
+                raise MediaProbeException(warnings)
+            return json.loads(output), warnings
+        except (OSError, ValueError) as error:
+            raise MediaProbeException(str(error))
+
+    def probe(self, path):
+        """Probe media file at path.
+
+        Args:
+            path: local filesystem path of media file.
+        Returns:
+            MediaInfo object
+        Raises:
+            MediaProbeException
+        """
+        data, warnings = self._run(path)
+        container = data.get("format", {})
+
+        result = MediaInfo(format_name=container.get("format_name"))
+
+        for stream in data.get("streams", []):
+            codec_type = stream.get("codec_type")
+            if codec_type == "video":
+                #cover art in mp3 files is reported as a video stream
+                disposition = stream.get("disposition", {})
+                if not disposition.get("attached_pic"):
+                    result.has_video = True
+            elif codec_type == "audio" and result.audio_codec is None:
+                result.audio_codec = stream.get("codec_name")
+                if stream.get("sample_rate"):
+                    result.sample_rate = int(stream["sample_rate"])
+                if stream.get("channels"):
+                    result.channels = int(stream["channels"])
+                result.channel_layout = stream.get("channel_layout")
+                if stream.get("duration"):
+                    result.duration = float(stream["duration"])
+
+        if container.get("duration"):
+            result.duration = float(container["duration"])
+
+        #ffprobe falls back to estimating duration from the bitrate
+        #when the container has no duration (i.e. mp3 without a
+        #Xing header). The estimate is exact for CBR mp3 only.
+        if result.duration is not None:
+            if "Estimating duration from bitrate" not in warnings:
+                result.duration_reliable = True
+            elif result.audio_codec == "mp3" and not result.has_video:
+                result.duration_reliable = mp3.is_cbr(path) is not None
+
+        return result
+
+    def duration(self, path):
+        """Get media duration from container headers.
+
+        Args:
+            path: local filesystem path of media file.
+        Returns:
+            duration in seconds, or None if the container headers
+            are missing or unreliable and the media must be
+            decoded to determine its duration.
+        """
+        try:
+            media_info = self.probe(path)
+        except MediaProbeException as error:
+            self.log.warning("Unable to probe %s: %s" % (path, error))
+            return None
+        if media_info.duration_reliable:
+            return media_info.duration
+        return None
@@ -0,0 +1,508 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+from trpycore.thread.util import join
+
+#Bytes per second of 16-bit stereo wav at 44.1kHz, used to estimate
+#the sizes of intermediate audio files.
+WAV_BYTES_PER_SECOND = 44100 * 2 * 2
+
+class ScratchSpaceException(Exception):
+    """Scratch space exception."""
+    pass
+
+
+class ScratchSpace(object):
+    """Per-job scratch space for intermediate files.
+
+    Each job, identified by its output filename, gets an isolated
+    scratch directory on disk, and optionally one in a memory
+    backed directory, i.e. on /dev/shm. Intermediate files are
+    placed in memory as long as their estimated sizes fit within
+    a byte budget shared by all jobs, and spill to the job's disk
+    directory otherwise.
+
+    Since sizes are estimates, files are checked against their
+    reservations once written (see JobScratch.commit()), and files
+    which outgrew their reservation move to disk if the budget
+    can't cover the difference.
+
+    Job directories are removed when the job succeeds. When a job
+    fails they are kept for ttl_seconds, so a retry can reuse its
+    intermediates, and are then removed by collect(). Jobs whose
+    output filename differs between attempts, i.e. by a timestamp,
+    are registered with a key which doesn't (see job()).
+    """
+
+    def __init__(self,
+            directory,
+            memory_directory=None,
+            memory_bytes=0,
+            ttl_seconds=3600,
+            max_bytes=None):
+        """ScratchSpace constructor.
+
+        Args:
+            directory: disk directory path for job directories
+            memory_directory: optional memory backed directory path
+                for job directories.
+            memory_bytes: budget in bytes for files in memory_directory
+            ttl_seconds: number of seconds the directories of failed
+                or abandoned jobs are kept.
+            max_bytes: optional disk quota in bytes for directory.
+                When exceeded, collect() removes failed job
+                directories, oldest first, before their ttl expires.
+        """
+        #job directories outlive a job, so relative paths are
+        #resolved once rather than against a later working directory.
+        self.directory = os.path.abspath(directory)
+        self.memory_directory = memory_directory and \
+                os.path.abspath(memory_directory)
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.memory_used_bytes = 0
+        self.disk_bytes = 0
+        self.jobs = {}
+        self.job_keys = {}
+        self.spills = 0
+        self.collected = 0
+        self.lock = threading.Lock()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def _key(self, name):
+        return name.strip("/").replace("/", "-")
+
+    def _remove_directory(self, path):
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _directory_size(self, path):
+        result = 0
+        for root, directories, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    result += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass
+        return result
+
+    def job(self, name, key=None):
+        """Get JobScratch for job, creating it if needed.
+
+        Args:
+            name: job name, i.e. the job's output filename
+            key: optional name identifying the job across attempts,
+                i.e. its output filename without a timestamp.
+                Once registered, job(name) and finish(name) refer
+                to the job with key. Defaults to name.
+        Returns:
+            JobScratch object
+        """
+        with self.lock:
+            if key is not None:
+                self.job_keys[name] = key
+            key = self._key(self.job_keys.get(name, name))
+            job = self.jobs.get(key)
+            if job is None:
+                memory_directory = None
+                if self.memory_directory:
+                    memory_directory = os.path.join(self.memory_directory, key)
+                job = JobScratch(self, key,
+                        os.path.join(self.directory, key), memory_directory)
+                self.jobs[key] = job
+            job.name = name
+            job.failed = None
+        return job
+
+    def reserve_memory(self, size):
+        """Reserve size bytes of the memory budget.
+
+        Returns:
+            True if reserved, False if the file should spill to disk.
+        """
+        with self.lock:
+            if self.memory_directory is None \
+                    or self.memory_used_bytes + size > self.memory_bytes:
+                self.spills += 1
+                return False
+            self.memory_used_bytes += size
+            return True
+
+    def release_memory(self, size):
+        """Return size bytes to the memory budget."""
+        with self.lock:
+            self.memory_used_bytes -= size
+
+    def finish(self, name, success):
+        """Finish job.
+
+        Job directories are removed if the job succeeded, and
+        kept for ttl_seconds otherwise.
+
+        Args:
+            name: job name passed to job()
+            success: True if the job succeeded
+        """
+        with self.lock:
+            key = self._key(self.job_keys.pop(name, name))
+            job = self.jobs.get(key)
+            if job is None:
+                return
+            if success:
+                del self.jobs[key]
+            else:
+                job.failed = time.time()
+        if success:
+            job.remove()
+
+    def collect(self):
+        """Remove expired job directories and enforce the disk quota.
+
+        Directories of failed jobs are removed once their ttl
+        expires. Directories left by a previous process are removed
+        once they have not been modified for ttl_seconds.
+
+        Returns:
+            number of job directories removed.
+        """
+        result = 0
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, job in list(self.jobs.items()):
+                if job.failed and now - job.failed > self.ttl_seconds:
+                    del self.jobs[key]
+                    expired.append(job)
+            keys = set(self.jobs.keys())
+
+        for job in expired:
+            self.log.info("Removing expired scratch for %s" % job.key)
+            job.remove()
+            result += 1
+
+        #remove directories of jobs this process doesn't know about
+        for directory in [self.directory, self.memory_directory]:
+            if not directory or not os.path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                path = os.path.join(directory, key)
+                if key in keys or now - os.path.getmtime(path) <= self.ttl_seconds:
+                    continue
+                self.log.info("Removing orphaned scratch %s" % path)
+                self._remove_directory(path)
+                result += 1
+
+        disk_bytes = 0
+        if os.path.isdir(self.directory):
+            disk_bytes = self._directory_size(self.directory)
+
+        #enforce disk quota, oldest failed jobs first
+        if self.max_bytes is not None and disk_bytes > self.max_bytes:
+            with self.lock:
+                failed = sorted([j for j in self.jobs.values() if j.failed],
+                        key=lambda job: job.failed)
+            for job in failed:
+                if disk_bytes <= self.max_bytes:
+                    break
+                size = self._directory_size(job.directory)
+                with self.lock:
+                    if self.jobs.get(job.key) is not job or not job.failed:
+                        continue
+                    del self.jobs[job.key]
+                self.log.warning("Removing scratch for %s, disk quota exceeded" \
+                        % job.key)
+                job.remove()
+                disk_bytes -= size
+                result += 1
+            if disk_bytes > self.max_bytes:
+                self.log.warning("Scratch disk usage %s exceeds quota %s" \
+                        % (disk_bytes, self.max_bytes))
+
+        with self.lock:
+            self.disk_bytes = disk_bytes
+            self.collected += result
+        return result
+
+    def counters(self):
+        """Get dict of scratch space counters."""
+        with self.lock:
+            return {
+                "scratch_jobs": len(self.jobs),
+                "scratch_failed_jobs": len([j for j in self.jobs.values() if j.failed]),
+                "scratch_collected_jobs": self.collected,
+                "scratch_disk_bytes": self.disk_bytes,
+                "scratch_memory_bytes": self.memory_used_bytes,
+                "scratch_spills": self.spills
+            }
+
+
+class JobScratch(object):
+    """Scratch directories of a single job."""
+
+    def __init__(self, scratch, key, directory, memory_directory=None):
+        """JobScratch constructor.
+
+        Args:
+            scratch: ScratchSpace object
+            key: job key
+            directory: job's disk directory path
+            memory_directory: optional job's memory backed directory path
+        """
+        self.scratch = scratch
+        self.key = key
+        self.name = None
+        self.directory = directory
+        self.memory_directory = memory_directory
+        self.allocations = {}
+        self.failed = None
+        self.lock = threading.Lock()
+
+    def _ensure_directory(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #created concurrently
+                if not os.path.isdir(directory):
+                    raise
+
+    def _scratch_name(self, filename):
+        """Get scratch file name of intermediate filename.
+
+        Intermediates named after the current attempt's job name
+        are named independently of it, so a retry whose name
+        differs finds the files of a failed attempt.
+        """
+        if self.name and filename.startswith(self.name):
+            return "job%s" % filename[len(self.name):]
+        return os.path.basename(filename)
+
+    def allocate(self, filename, size):
+        """Allocate scratch file.
+
+        Args:
+            filename: intermediate filename
+            size: estimated file size in bytes, or None if unknown
+        Returns:
+            absolute path of the scratch file, in memory if it
+            fits in the budget and on disk otherwise.
+        """
+        path = self.path(filename)
+        if path is not None:
+            return path
+
+        name = self._scratch_name(filename)
+        with self.lock:
+            if self.memory_directory is not None and size is not None \
+                    and self.scratch.reserve_memory(size):
+                path = os.path.join(self.memory_directory, name)
+                self.allocations[filename] = (path, size)
+            else:
+                path = os.path.join(self.directory, name)
+                self.allocations[filename] = (path, 0)
+        self._ensure_directory(path)
+        return path
+
+    def path(self, filename):
+        """Get path of scratch file, or None if not allocated.
+
+        Files left in the job directories by a failed attempt
+        of the same job are found as well.
+        """
+        with self.lock:
+            allocation = self.allocations.get(filename)
+            if allocation is not None:
+                return allocation[0]
+
+            name = self._scratch_name(filename)
+            for directory in [self.memory_directory, self.directory]:
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    self.allocations[filename] = (path, 0)
+                    return path
+        return None
+
+    def commit(self, filename):
+        """Check written scratch file against its memory reservation.
+
+        The reservation is adjusted to the file's actual size. If
+        the file outgrew its reservation and the budget can't cover
+        the difference, the file is moved to the job's disk directory.
+
+        Args:
+            filename: intermediate filename passed to allocate()
+        Returns:
+            absolute path of the scratch file, or None if not allocated.
+        """
+        with self.lock:
+            allocation = self.allocations.get(filename)
+        if allocation is None:
+            return None
+        path, reserved = allocation
+        if not reserved or not os.path.exists(path):
+            return path
+
+        size = os.path.getsize(path)
+        if size <= reserved:
+            self.scratch.release_memory(reserved - size)
+        elif not self.scratch.reserve_memory(size - reserved):
+            self.scratch.release_memory(reserved)
+            disk_path = os.path.join(self.directory, os.path.basename(path))
+            self.scratch.log.info("Moving %s to disk, %s bytes over estimate" \
+                    % (filename, size - reserved))
+            self._ensure_directory(disk_path)
+            shutil.move(path, disk_path)
+            path, size = disk_path, 0
+
+        with self.lock:
+            self.allocations[filename] = (path, size)
+        return path
+
+    def release(self, filename):
+        """Remove scratch file and return its bytes to the budget."""
+        with self.lock:
+            allocation = self.allocations.pop(filename, None)
+        if allocation is None:
+            return
+        path, size = allocation
+        if size:
+            self.scratch.release_memory(size)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def remove(self):
+        """Remove job directories and all scratch files."""
+        with self.lock:
+            allocations, self.allocations = self.allocations, {}
+        for path, size in allocations.values():
+            if size:
+                self.scratch.release_memory(size)
+        for directory in [self.memory_directory, self.directory]:
+            if directory is not None and os.path.exists(directory):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def storage(self, storage_backend):
+        """Get ScratchStorage for storage_backend."""
+        return ScratchStorage(self, storage_backend)
+
+
+class ScratchStorage(object):
+    """Storage view resolving scratch files before storage_backend.
+
+    Intermediate files allocated with scratch_path() are resolved
+    to the job's scratch directories by path(), and all other
+    files, including inputs and final outputs, to storage_backend.
+    Other Storage methods are delegated to storage_backend.
+    """
+
+    def __init__(self, job, storage_backend):
+        """ScratchStorage constructor.
+
+        Args:
+            job: JobScratch object
+            storage_backend: Storage object, accessible on local filesystem
+        """
+        self.job = job
+        self.storage_backend = storage_backend
+        self.filenames = []
+
+    def __getattr__(self, name):
+        return getattr(self.storage_backend, name)
+
+    def path(self, filename):
+        """Get local filesystem path of filename."""
+        return self.job.path(filename) or self.storage_backend.path(filename)
+
+    def scratch_path(self, filename, size):
+        """Get local filesystem path for intermediate file.
+
+        Args:
+            filename: intermediate filename
+            size: estimated file size in bytes, or None if unknown
+        Returns:
+            path in the job's scratch directories.
+        """
+        self.filenames.append(filename)
+        return self.job.allocate(filename, size)
+
+    def commit(self, filename):
+        """Check written intermediate file, see JobScratch.commit().
+
+        Returns:
+            local filesystem path of filename.
+        """
+        return self.job.commit(filename) or self.path(filename)
+
+    def release(self):
+        """Release all scratch files allocated through this storage."""
+        filenames, self.filenames = self.filenames, []
+        for filename in filenames:
+            self.job.release(filename)
+
+
+class ScratchCollector(object):
+    """Scratch space collector.
+
+    Periodically removes expired job scratch directories and
+    enforces the scratch disk quota in the background.
+    """
+
+    def __init__(self, scratch, poll_seconds=60):
+        """ScratchCollector constructor.
+
+        Args:
+            scratch: ScratchSpace object
+            poll_seconds: number of seconds between collections
+        """
+        self.scratch = scratch
+        self.poll_seconds = poll_seconds
+        self.thread = None
+        self.running = False
+        self.wakeup = threading.Event()
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def start(self):
+        """Start collector."""
+        if not self.running:
+            self.running = True
+            self.wakeup.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+
+    def run(self):
+        """Run collector.
+
+        This method is invoked in the context of self.thread
+        """
+        while self.running:
+            try:
+                self.scratch.collect()
+            except Exception as error:
+                self.log.exception(error)
+
+            if self.running:
+                self.wakeup.wait(self.poll_seconds)
+
+        self.running = False
+
+    def stop(self):
+        """Stop collector."""
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+
+    def join(self, timeout):
+        """Join collector."""
+        if self.thread is not None:
+            join([self.thread], timeout)
@@ -0,0 +1,463 @@
+import logging
+import multiprocessing.pool
+import os
+import struct
+import subprocess
+import threading
+
+import mp3
+from governor import ResourceGovernor, bind_account
+
+#Segment boundaries are multiples of both the mp3 (1152) and
+#aac (1024) frame sizes, so that segments of both outputs
+#start on frame boundaries.
+SEGMENT_ALIGNMENT = 9216
+
+#raw ffmpeg input formats by (wav format tag, bits per sample)
+RAW_FORMATS = {
+    (1, 16): "s16le",
+    (1, 24): "s24le",
+    (1, 32): "s32le",
+    (3, 32): "f32le",
+    (3, 64): "f64le"
+}
+
+class SegmentedEncoderException(Exception):
+    """Segmented encoder exception."""
+    pass
+
+
+class WavInfo(object):
+    """Wav file format information."""
+    def __init__(self,
+            format_tag,
+            sample_rate,
+            channels,
+            bits_per_sample,
+            data_offset,
+            data_size):
+        self.format_tag = format_tag
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.data_offset = data_offset
+        self.data_size = data_size
+
+    @property
+    def frame_size(self):
+        """Size of a single sample frame in bytes."""
+        return self.channels * self.bits_per_sample // 8
+
+    @property
+    def frames(self):
+        """Number of sample frames."""
+        return self.data_size // self.frame_size
+
+    @property
+    def raw_format(self):
+        """ffmpeg raw format name of sample data."""
+        try:
+            return RAW_FORMATS[(self.format_tag, self.bits_per_sample)]
+        except KeyError:
+            raise SegmentedEncoderException(
+                    "unsupported wav format: %s/%s" \
+                    % (self.format_tag, self.bits_per_sample))
+
+    def __repr__(self):
+        return "%s(format_tag=%r, sample_rate=%r, channels=%r, bits_per_sample=%r)" % (\
+                self.__class__.__name__,
+                self.format_tag, self.sample_rate,
+                self.channels, self.bits_per_sample)
+
+
+def read_wav_info(path):
+    """Read wav header of file at path.
+
+    Args:
+        path: local filesystem path of wav file
+    Returns:
+        WavInfo object
+    Raises:
+        SegmentedEncoderException
+    """
+    with open(path, "rb") as wav_file:
+        header = wav_file.read(12)
+        if len(header) != 12:
+            raise SegmentedEncoderException("invalid wav header")
+        riff, unused, wave = struct.unpack("<4sI4s", header)
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise SegmentedEncoderException("invalid wav header")
+
+        fmt = None
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) != 8:
+                raise SegmentedEncoderException("missing wav data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"data":
+                break
+            chunk = wav_file.read(chunk_size + (chunk_size % 2))
+            if chunk_id == b"fmt ":
+                fmt = chunk
+
+        if fmt is None:
+            raise SegmentedEncoderException("missing wav fmt chunk")
+
+        format_tag, channels, sample_rate = struct.unpack("<HHI", fmt[:8])
+        bits_per_sample, = struct.unpack("<H", fmt[14:16])
+        if format_tag == 0xFFFE:
+            #WAVE_FORMAT_EXTENSIBLE, format is the start of the sub format
+            format_tag, = struct.unpack("<H", fmt[24:26])
+
+        data_offset = wav_file.tell()
+        #data size may be a placeholder if the wav was written to a pipe
+        data_size = min(chunk_size, os.path.getsize(path) - data_offset)
+
+    return WavInfo(
+            format_tag=format_tag,
+            sample_rate=sample_rate,
+            channels=channels,
+            bits_per_sample=bits_per_sample,
+            data_offset=data_offset,
+            data_size=data_size)
+
+def iter_adts_frames(data, offset=0):
+    """Iterate over (offset, size) for ADTS aac frames in data.
+
+    Iteration stops at the first byte which is not the start
+    of a complete frame.
+    """
+    while offset + 7 <= len(data):
+        header = bytearray(data[offset:offset+7])
+        if header[0] != 0xFF or header[1] & 0xF0 != 0xF0:
+            return
+        size = ((header[3] & 0x03) << 11) | (header[4] << 3) | (header[5] >> 5)
+        if size < 7 or offset + size > len(data):
+            return
+        yield offset, size
+        offset += size
+
+def iter_mp3_frames(data):
+    """Iterate over (offset, size) for mp3 frames in data."""
+    for frame_offset, header in mp3.iter_frames(data, mp3.skip_id3v2(data)):
+        yield frame_offset, header.size
+
+
+class SegmentFormat(object):
+    """Segmented output format.
+
+    Segments are encoded so that their frames can be concatenated,
+    i.e. without headers or cross frame state such as the mp3 bit
+    reservoir.
+    """
+    def __init__(self, extension, frame_samples, ffmpeg_arguments, iter_frames):
+        """SegmentFormat constructor.
+
+        Args:
+            extension: segment file extension
+            frame_samples: number of samples per encoded frame
+            ffmpeg_arguments: ffmpeg output arguments
+            iter_frames: function iterating over (offset, size)
+                of frames in encoded data.
+        """
+        self.extension = extension
+        self.frame_samples = frame_samples
+        self.ffmpeg_arguments = ffmpeg_arguments
+        self.iter_frames = iter_frames
+
+#Encoder arguments of the final mp3 and mp4 (aac) audio, shared
+#by whole and segmented encodes, so archives are encoded alike
+#whatever their length. ffmpeg before 3.0 only enables its native
+#aac encoder with -strict experimental.
+MP3_CODEC_ARGUMENTS = ["-acodec", "libmp3lame", "-ab", "128k"]
+AAC_CODEC_ARGUMENTS = ["-acodec", "aac", "-strict", "experimental",
+        "-ab", "128k"]
+
+MP3_FORMAT = SegmentFormat(
+        extension="mp3",
+        frame_samples=1152,
+        ffmpeg_arguments=MP3_CODEC_ARGUMENTS + [
+            "-reservoir", "0",
+            "-write_xing", "0",
+            "-id3v2_version", "0",
+            "-f", "mp3"],
+        iter_frames=iter_mp3_frames)
+
+AAC_FORMAT = SegmentFormat(
+        extension="aac",
+        frame_samples=1024,
+        ffmpeg_arguments=AAC_CODEC_ARGUMENTS + [
+            "-f", "adts"],
+        iter_frames=iter_adts_frames)
+
+
+class Segment(object):
+    """Time segment of a wav file, in sample frames.
+
+    Audio is encoded from start to end, which include the
+    preroll and postroll, and only the frames covering
+    segment_start to segment_end are kept.
+    """
+    def __init__(self, index, start, end, segment_start, segment_end, last):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.segment_start = segment_start
+        self.segment_end = segment_end
+        self.last = last
+
+    def __repr__(self):
+        return "%s(index=%r, start=%r, end=%r)" % (\
+                self.__class__.__name__,
+                self.index, self.segment_start, self.segment_end)
+
+
+class SegmentedEncoder(object):
+    """Segment-parallel mp3 and mp4 encoder.
+
+    Splits a wav file into time segments on frame boundaries
+    and encodes the segments in parallel. Each segment is encoded
+    with a preroll and postroll of neighbouring audio, so encoder
+    state at the segment boundaries matches a single encode, and
+    the extra frames are dropped before the segments are
+    concatenated. The concatenated aac is remuxed into mp4.
+    """
+
+    def __init__(self,
+            ffmpeg_path,
+            threads,
+            segment_seconds=300,
+            preroll_samples=SEGMENT_ALIGNMENT,
+            chunk_size=1024*1024,
+            governor=None):
+        """SegmentedEncoder constructor.
+
+        Args:
+            ffmpeg_path: absolute path to ffmpeg executable
+            threads: number of segments to encode in parallel
+            segment_seconds: approximate segment length in seconds
+            preroll_samples: number of samples of preroll and postroll
+                encoded with each segment. Must be a multiple of
+                SEGMENT_ALIGNMENT.
+            chunk_size: number of bytes to write to ffmpeg at a time
+            governor: optional ResourceGovernor object used to start
+                ffmpeg processes.
+        """
+        self.ffmpeg_path = ffmpeg_path
+        self.threads = threads
+        self.segment_seconds = segment_seconds
+        self.preroll_samples = preroll_samples
+        self.chunk_size = chunk_size
+        self.governor = governor or ResourceGovernor()
+        self.formats = [MP3_FORMAT, AAC_FORMAT]
+
+        self.log = logging.getLogger("%s.%s" \
+                % (__name__, self.__class__.__name__))
+
+    def segments(self, wav_info):
+        """Get list of Segment objects for wav.
+
+        Args:
+            wav_info: WavInfo object
+        Returns:
+            list of Segment objects
+        """
+        segment_frames = int(self.segment_seconds * wav_info.sample_rate)
+        segment_frames = max(SEGMENT_ALIGNMENT,
+                segment_frames - segment_frames % SEGMENT_ALIGNMENT)
+
+        results = []
+        segment_start = 0
+        while segment_start < wav_info.frames or not results:
+            segment_end = min(wav_info.frames, segment_start + segment_frames)
+            last = segment_end == wav_info.frames
+            results.append(Segment(
+                index=len(results),
+                start=max(0, segment_start - self.preroll_samples),
+                end=min(wav_info.frames, segment_end + self.preroll_samples),
+                segment_start=segment_start,
+                segment_end=segment_end,
+                last=last))
+            segment_start = segment_end
+            if last:
+                break
+        return results
+
+    def should_segment(self, length):
+        """Check if audio of length milliseconds spans multiple segments."""
+        return self.threads > 1 and length > self.segment_seconds * 1000.0
+
+    def _segment_path(self, output_path, segment, segment_format):
+        return "%s-seg-%s.%s" % (os.path.splitext(output_path)[0],
+                segment.index, segment_format.extension)
+
+    def _feed(self, path, wav_info, segment, pipe):
+        """Write segment's sample data to pipe."""
+        written = 0
+        try:
+            with open(path, "rb") as wav_file:
+                wav_file.seek(wav_info.data_offset
+                        + segment.start * wav_info.frame_size)
+                remaining = (segment.end - segment.start) * wav_info.frame_size
+                while remaining > 0:
+                    data = wav_file.read(min(self.chunk_size, remaining))
+                    if not data:
+                        break
+                    pipe.write(data)
+                    remaining -= len(data)
+                    written += len(data)
+        except IOError as error:
+            #ffmpeg exited early, its error is reported by the caller
+            self.log.warning("Unable to feed segment %s: %s" % (segment, error))
+        finally:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+            self.governor.record_pipe(write_bytes=written)
+
+    def _encode_segment(self, path, wav_info, segment, output_path):
+        """Encode segment to a segment file for each format.
+
+        Returns:
+            list of segment file paths, one per format
+        Raises:
+            subprocess.CalledProcessError
+        """
+        ffmpeg_arguments = [
+                self.ffmpeg_path,
+                "-y",
+                "-v",
+                "error",
+                "-f",
+                wav_info.raw_format,
+                "-ar",
+                "%s" % wav_info.sample_rate,
+                "-ac",
+                "%s" % wav_info.channels,
+                "-i",
+                "-"
+                ]
+
+        segment_paths = []
+        for segment_format in self.formats:
+            segment_path = self._segment_path(output_path, segment, segment_format)
+            ffmpeg_arguments.extend(segment_format.ffmpeg_arguments)
+            ffmpeg_arguments.append(segment_path)
+            segment_paths.append(segment_path)
+
+        self.log.info(ffmpeg_arguments)
+
+        length = 1000.0 * (segment.end - segment.start) / wav_info.sample_rate
+        process = self.governor.popen(
+                ffmpeg_arguments,
+                timeout=self.governor.timeout(length),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        feeder = threading.Thread(
+                target=bind_account(self._feed),
+                args=(path, wav_info, segment, process.stdin))
+        feeder.daemon = True
+        feeder.start()
+        output = process.stdout.read()
+        process.wait()
+        feeder.join()
+
+        self.governor.check_process(process, ffmpeg_arguments, output)
+        return segment_paths
+
+    def _append_segment(self, output_file, segment, segment_format, segment_path):
+        """Append segment's frames, less preroll and postroll, to output_file.
+
+        Raises:
+            SegmentedEncoderException
+        """
+        with open(segment_path, "rb") as segment_file:
+            data = segment_file.read()
+
+        frame_samples = segment_format.frame_samples
+        skip = (segment.segment_start - segment.start) // frame_samples
+        count = None
+        if not segment.last:
+            count = (segment.segment_end - segment.segment_start) // frame_samples
+
+        frames = list(segment_format.iter_frames(data))
+        if len(frames) < skip + (count or 0):
+            raise SegmentedEncoderException(
+                    "segment %s has %s frames, expected at least %s" \
+                    % (segment_path, len(frames), skip + (count or 0)))
+
+        kept = frames[skip:] if count is None else frames[skip:skip+count]
+        if kept:
+            first_offset = kept[0][0]
+            last_offset, last_size = kept[-1]
+            output_file.write(data[first_offset:last_offset+last_size])
+
+    def encode(self, path, mp3_path, mp4_path):
+        """Encode wav file at path to mp3 and mp4 in parallel segments.
+
+        Args:
+            path: local filesystem path of wav file
+            mp3_path: mp3 output path
+            mp4_path: mp4 output path
+        Raises:
+            SegmentedEncoderException, subprocess.CalledProcessError
+        """
+        wav_info = read_wav_info(path)
+        segments = self.segments(wav_info)
+        self.log.info("Encoding %s in %s segments (%r)" \
+                % (path, len(segments), wav_info))
+
+        aac_path = "%s.aac" % os.path.splitext(mp4_path)[0]
+        segment_paths = []
+        pool = multiprocessing.pool.ThreadPool(min(self.threads, len(segments)))
+        try:
+            segment_paths = pool.map(
+                    bind_account(lambda segment: self._encode_segment(
+                        path, wav_info, segment, mp3_path)),
+                    segments)
+
+            output_paths = [mp3_path, aac_path]
+            for index, segment_format in enumerate(self.formats):
+                with open(output_paths[index], "wb") as output_file:
+                    for segment, paths in zip(segments, segment_paths):
+                        self._append_segment(output_file, segment,
+                                segment_format, paths[index])
+
+            ffmpeg_arguments = [
+                    self.ffmpeg_path,
+                    "-y",
+                    "-v",
+                    "error",
+                    "-i",
+                    aac_path,
+                    "-acodec",
+                    "copy",
+                    "-bsf:a",
+                    "aac_adtstoasc",
+                    mp4_path
+                    ]
+            self.log.info(ffmpeg_arguments)
+            self.governor.check_output(
+                    ffmpeg_arguments,
+                    timeout=self.governor.timeout(
+                        1000.0 * wav_info.frames / wav_info.sample_rate),
+                    stderr=subprocess.STDOUT)
+
+        except Exception:
+            for output_path in [mp3_path, mp4_path]:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+            remove_paths = [aac_path]
+            for segment in segments:
+                for segment_format in self.formats:
+                    remove_paths.append(self._segment_path(
+                        mp3_path, segment, segment_format))
+            for remove_path in remove_paths:
+                if os.path.exists(remove_path):
+                    os.remove(remove_path)
@@ -35,12 +35,30 @@ RIAK_SESSION_POOL_SIZE = 4
 TWILIO_ACCOUNT_SID = "AC339bd35c385747713117ec475787c1f7"
 TWILIO_AUTH_TOKEN = "38ecd9a4310677ac69b575cd8f724d31"
 TWILIO_APPLICATION_SID = "AP1672ddc9ec844ae9b0274a63262ccb4d"
+TWILIO_BASE_URL = "https://api.twilio.com"
 
 #Archiver settings
 ARCHIVER_THREADS = 1
 ARCHIVER_POLL_SECONDS = 60
 ARCHIVER_JOB_RETRY_SECONDS = 300
 ARCHIVER_TIMESTAMP_FILENAMES = True
+ARCHIVER_DELETE_DIRECTORY = "./storage/deletes"
+ARCHIVER_DELETE_BATCH_SIZE = 10
+ARCHIVER_DELETE_RATE = 1.0
+ARCHIVER_DELETE_POLL_SECONDS = 30
+ARCHIVER_DELETE_RETRY_SECONDS = 300
+ARCHIVER_DELETE_MAX_ATTEMPTS = 10
+ARCHIVER_PREFETCH_LOOKAHEAD = 4
+ARCHIVER_PREFETCH_MAX_BYTES = 1024 * 1024 * 1024
+ARCHIVER_PREFETCH_POLL_SECONDS = 30
+ARCHIVER_PREFETCH_EXPIRE_SECONDS = 3600
+ARCHIVER_PREFETCH_HORIZON_SECONDS = 900
+#archive files are placed in ARCHIVER_LAYOUT_DEPTH levels of
+#hash prefix subdirectories under ARCHIVER_LAYOUT_PREFIX.
+#Existing files can be moved with migrate.py.
+ARCHIVER_LAYOUT_PREFIX = "archive"
+ARCHIVER_LAYOUT_DEPTH = 2
+ARCHIVER_LAYOUT_WIDTH = 2
 
 #Cloudfiles storge settings
 CLOUDFILES_USERNAME = "trdev"
@@ -52,15 +70,65 @@ CLOUDFILES_PRIVATE_CONTAINER_NAME = "trdev_private"
 CLOUDFILES_TIMEOUT = 10
 CLOUDFILES_RETRIES = 2
 CLOUDFILES_DEBUG_LEVEL = 0
-CLOUDFILES_STORAGE_POOL_SIZE = 1
+CLOUDFILES_STORAGE_POOL_MIN_SIZE = 1
+CLOUDFILES_STORAGE_POOL_MAX_SIZE = 8
+CLOUDFILES_STORAGE_POOL_IDLE_SECONDS = 300
 
 #Filesystem storage settings
 FILESYSTEM_STORAGE_LOCATION = "./storage"
 
+#Persister settings
+#uploads are bounded by PERSISTER_UPLOAD_THREADS and the size of
+#each cloudfiles storage pool. Files larger than
+#PERSISTER_SEGMENT_BYTES are uploaded in concurrent segments.
+PERSISTER_UPLOAD_THREADS = 8
+PERSISTER_SEGMENT_BYTES = 64 * 1024 * 1024
+#remote directory listings answer existence checks for this long
+PERSISTER_INDEX_TTL_SECONDS = 60
+
+#Lookup cache settings
+#ChatArchiveType and MimeType ids are loaded on start and
+#reinitialize, and reloaded after LOOKUP_CACHE_TTL_SECONDS.
+LOOKUP_CACHE_TTL_SECONDS = 3600
+
 #Stitch settings
 STITCH_FFMPEG_PATH = "/opt/local/bin/ffmpeg"
+STITCH_FFPROBE_PATH = "/opt/local/bin/ffprobe"
 STITCH_SOX_PATH = "/opt/local/bin/sox"
 STITCH_WORKING_DIRECTORY = "./storage"
+STITCH_STATS_CACHE_SIZE = 1024
+STITCH_INTERMEDIATE_FORMAT = "wav"
+STITCH_STREAMING = True
+STITCH_MIX_FAN_IN = 8
+STITCH_MIX_THREADS = None
+STITCH_SEGMENT_THREADS = 4
+STITCH_SEGMENT_SECONDS = 300
+#per-job directories for intermediate files, optionally memory
+#backed up to STITCH_SCRATCH_MEMORY_BYTES. Failed jobs' scratch
+#is kept for STITCH_SCRATCH_TTL_SECONDS for retries. Directories
+#should be absolute, since the service may change directory.
+STITCH_SCRATCH_DIRECTORY = "/var/tmp/archivesvc/scratch"
+STITCH_SCRATCH_MEMORY_DIRECTORY = None
+STITCH_SCRATCH_MEMORY_BYTES = 512 * 1024 * 1024
+STITCH_SCRATCH_MAX_BYTES = 20 * 1024 * 1024 * 1024
+STITCH_SCRATCH_TTL_SECONDS = 3600
+STITCH_SCRATCH_COLLECT_SECONDS = 300
+
+#Governor settings
+GOVERNOR_CORES = None
+GOVERNOR_MAX_THREADS = None
+GOVERNOR_AFFINITY = False
+GOVERNOR_NICE = None
+GOVERNOR_LOAD_AWARE = False
+#media processes are killed after GOVERNOR_TIMEOUT_FACTOR seconds
+#per second of media, or at least GOVERNOR_TIMEOUT seconds.
+GOVERNOR_TIMEOUT = 600
+GOVERNOR_TIMEOUT_FACTOR = 2.0
+#optional address space limit in bytes. RLIMIT_AS counts virtual
+#memory, including thread stacks and mapped libraries, so it should
+#be set well above the processes' resident memory.
+GOVERNOR_MAX_MEMORY = None
+GOVERNOR_CPU_LIMIT_FACTOR = 4.0
 
 #Logging settings
 LOGGING = {
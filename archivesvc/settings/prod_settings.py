@@ -42,6 +42,7 @@ ARCHIVER_THREADS = 1
 ARCHIVER_POLL_SECONDS = 60
 ARCHIVER_JOB_RETRY_SECONDS = 300
 ARCHIVER_TIMESTAMP_FILENAMES = False
+ARCHIVER_DELETE_DIRECTORY = "/opt/tr/data/archivesvc/deletes"
 
 #Cloudfiles storge settings
 CLOUDFILES_USERNAME = "trprod"
@@ -53,15 +54,20 @@ CLOUDFILES_PRIVATE_CONTAINER_NAME = "tr_private"
 CLOUDFILES_TIMEOUT = 10
 CLOUDFILES_RETRIES = 2
 CLOUDFILES_DEBUG_LEVEL = 0
-CLOUDFILES_STORAGE_POOL_SIZE = 1
+CLOUDFILES_STORAGE_POOL_MIN_SIZE = 1
+CLOUDFILES_STORAGE_POOL_MAX_SIZE = 8
+CLOUDFILES_STORAGE_POOL_IDLE_SECONDS = 300
 
 #Filesystem storage settings
 FILESYSTEM_STORAGE_LOCATION = "/opt/tr/data/archivesvc/storage"
 
 #Stitch settings
 STITCH_FFMPEG_PATH = "/opt/3ps/bin/ffmpeg"
+STITCH_FFPROBE_PATH = "/opt/3ps/bin/ffprobe"
 STITCH_SOX_PATH = "/opt/3ps/bin/sox"
 STITCH_WORKING_DIRECTORY = "/opt/tr/data/archivesvc/storage"
+STITCH_SCRATCH_DIRECTORY = "/opt/tr/data/archivesvc/scratch"
+STITCH_SCRATCH_MEMORY_DIRECTORY = "/dev/shm/archivesvc"
 
 #Logging settings
 LOGGING = {
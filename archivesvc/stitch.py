@@ -1,17 +1,70 @@
 import abc
+import json
 import logging
+import math
+import multiprocessing.pool
 import os
-import re
+import pipes
 import subprocess
+import threading
+
+import numpy as np
 
 from trpycore.pool.simple import SimplePool
 from trsvcscore.storage.exception import NotImplemented
 from trsvcscore.storage.filesystem import FileSystemStorage
+from audiostats import AudioStatsAccumulator, FFMpegAudioStatsEngine
+from governor import ResourceGovernor, bind_account
+from probe import FFProbe, MediaInfo, MediaProbeException
+from scratch import WAV_BYTES_PER_SECOND, ScratchStorage
+from segment import AAC_CODEC_ARGUMENTS, MP3_CODEC_ARGUMENTS
 from stream import ArchiveStream, ArchiveStreamType
+from transfer import atomic_outputs, transfer
+from waveform import Encoder, WaveformReducer
+
+#Audio format of extracted and stitched audio streams
+TARGET_AUDIO_CODEC = "mp3"
+TARGET_SAMPLE_RATE = 44100
+
+#Intermediate audio formats, by file extension, and their codecs.
+#Intermediates are only consumed by later stitching steps, so
+#'wav' avoids a lossy encode / decode between each step.
+INTERMEDIATE_FORMATS = {
+    "mp3": TARGET_AUDIO_CODEC,
+    "wav": "pcm_s16le"
+}
+
+#Upper bound on intermediate file sizes in bytes per second of
+#stereo audio, used to allocate scratch space. 'float' is the
+#32-bit float wav used for group mixes.
+INTERMEDIATE_BYTES_PER_SECOND = {
+    "mp3": 320 * 1000 // 8,
+    "wav": WAV_BYTES_PER_SECOND,
+    "float": WAV_BYTES_PER_SECOND * 2
+}
+
+#Stream types which contain video
+VIDEO_STREAM_TYPES = [
+    ArchiveStreamType.USER_VIDEO_STREAM,
+    ArchiveStreamType.USERS_VIDEO_STREAM
+]
+
+#Number of bytes read from the mixing pipeline at a time
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+#Volume factors this close to 1.0 are inaudible and are skipped
+#rather than paying for a full decode / encode.
+VOLUME_FACTOR_TOLERANCE = 0.01
 
 class ArchiveStitcherException(Exception):
-    """Archive stitcher exception."""
-    pass
+    """Archive stitcher exception.
+
+    Exceptions are permanent if the stitch will fail again
+    when retried, i.e. due to a corrupt input.
+    """
+    def __init__(self, message, permanent=False):
+        super(ArchiveStitcherException, self).__init__(message)
+        self.permanent = permanent
 
 
 class ArchiveStitcher(object):
@@ -57,7 +110,16 @@ class FFMpegSoxStitcher(ArchiveStitcher):
             ffmpeg_path,
             sox_path,
             storage_pool,
-            working_directory):
+            working_directory,
+            ffprobe_path=None,
+            stats_engine=None,
+            intermediate_format="mp3",
+            streaming=False,
+            mix_fan_in=None,
+            mix_threads=None,
+            segment_encoder=None,
+            governor=None,
+            scratch=None):
         """FFMpegSoxStitcher constructor.
 
         Args:
@@ -71,7 +133,50 @@ class FFMpegSoxStitcher(ArchiveStitcher):
                 path will be used to store downloaded
                 archive streams if the specified storage_pool
                 is not accessible on the local filesystem.
+            ffprobe_path: optional absolute path to ffprobe executable.
+                If provided, input streams will be probed and
+                transcodes skipped when the input already has
+                the target format.
+            stats_engine: optional FFMpegAudioStatsEngine object. This
+                should be shared with other components so that stats
+                are computed at most once per file.
+            intermediate_format: format of intermediate audio streams
+                (extracted, volume adjusted and mixed audio), one of
+                INTERMEDIATE_FORMATS. With 'wav' intermediates are
+                kept as PCM and audio is only encoded to a lossy
+                format for the final stitched streams.
+            streaming: if True, extraction, volume adjustment, mixing
+                and encoding are connected by pipes and only the final
+                stitched streams are written. Waveform data is computed
+                from the mixed audio as it is encoded and set on the
+                stitched streams.
+            mix_fan_in: optional maximum number of inputs to a single
+                sox mix. Larger mixes are done hierarchically, mixing
+                groups of at most mix_fan_in inputs into files, in
+                the scratch space if provided, and then mixing the
+                group outputs.
+            mix_threads: maximum number of group mixes to run in
+                parallel. Defaults to the number of cpus.
+            segment_encoder: optional SegmentedEncoder object. If
+                provided, long mixes are stitched through 'wav'
+                intermediates, even in streaming mode, and encoded
+                in parallel segments.
+            governor: optional ResourceGovernor object used to start
+                ffmpeg and sox processes. This should be shared with
+                other components.
+            scratch: optional ScratchSpace object. If provided,
+                intermediate files are written to the job's scratch
+                space, and only the final stitched streams are
+                written to storage_pool.
+        Raises:
+            ArchiveStitcherException
         """
+        if intermediate_format not in INTERMEDIATE_FORMATS:
+            raise ArchiveStitcherException(
+                    "invalid intermediate format: %s" % intermediate_format)
+        if mix_fan_in is not None and mix_fan_in < 2:
+            raise ArchiveStitcherException(
+                    "invalid mix fan in: %s" % mix_fan_in)
 
         self.ffmpeg_path = ffmpeg_path
         self.sox_path = sox_path
@@ -79,6 +184,15 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         self.working_directory = working_directory
         self.filesystem_storage_pool = SimplePool(
                 FileSystemStorage(self.working_directory))
+        self.probe = FFProbe(ffprobe_path) if ffprobe_path else None
+        self.stats_engine = stats_engine or FFMpegAudioStatsEngine(ffmpeg_path)
+        self.intermediate_format = intermediate_format
+        self.streaming = streaming
+        self.mix_fan_in = mix_fan_in
+        self.mix_threads = mix_threads or multiprocessing.cpu_count()
+        self.segment_encoder = segment_encoder
+        self.governor = governor or ResourceGovernor()
+        self.scratch = scratch
 
         self.log = logging.getLogger("%s.%s" \
                 % (__name__, self.__class__.__name__))
@@ -89,11 +203,144 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         if not os.path.exists(directory):
             os.makedirs(directory)
 
+    def _intermediate_filename(self, filename):
+        """Get filename with the intermediate format's extension."""
+        path, ext = os.path.splitext(filename)
+        return "%s.%s" % (path, self.intermediate_format)
+
+    def _intermediate_path(self, storage_backend, filename, length, format=None):
+        """Get local filesystem path for an intermediate file.
+
+        Intermediate files are placed in the job's scratch space
+        when storage_backend is a ScratchStorage, in memory if the
+        file fits.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem.
+            filename: intermediate filename
+            length: audio length in milliseconds, or None if unknown,
+                in which case the file is not placed in memory.
+            format: INTERMEDIATE_BYTES_PER_SECOND format, defaults
+                to the intermediate format.
+        Returns:
+            local filesystem path
+        """
+        if not isinstance(storage_backend, ScratchStorage):
+            return storage_backend.path(filename)
+        size = None
+        if length is not None:
+            bytes_per_second = INTERMEDIATE_BYTES_PER_SECOND[
+                    format or self.intermediate_format]
+            size = int(length / 1000.0 * bytes_per_second)
+        return storage_backend.scratch_path(filename, size)
+
+    def _commit_intermediate(self, storage_backend, filename):
+        """Check a written intermediate file against its size estimate.
+
+        Intermediate files in memory which outgrew their estimate
+        may move to disk (see JobScratch.commit()).
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem.
+            filename: intermediate filename
+        Returns:
+            local filesystem path of the intermediate file
+        """
+        if not isinstance(storage_backend, ScratchStorage):
+            return storage_backend.path(filename)
+        return storage_backend.commit(filename)
+
+    def _output_arguments(self, output_path):
+        """Get sox output arguments for an intermediate or stitched file.
+
+        The output format is set explicitly rather than taken from
+        the inputs, so 'wav' outputs are always 16-bit PCM, matching
+        INTERMEDIATE_FORMATS, even when mixing 32-bit float group
+        mixes, and all outputs are at TARGET_SAMPLE_RATE.
+
+        Args:
+            output_path: output path, whose extension selects the format.
+        Returns:
+            list of sox output arguments, ending with output_path.
+        """
+        format = os.path.splitext(output_path)[1][1:]
+        arguments = ["-r", "%s" % TARGET_SAMPLE_RATE]
+        if INTERMEDIATE_FORMATS.get(format) == "pcm_s16le":
+            arguments.extend(["-e", "signed-integer", "-b", "16"])
+        arguments.append(output_path)
+        return arguments
+
+    def _pipe_input(self, *commands):
+        """Get a sox '|command' input running commands through pipes.
+
+        Commands are run by sox rather than the governor, so they
+        are single threaded and otherwise inherit the sox process's
+        allocation (see ResourceGovernor.pipe_arguments()).
+
+        Args:
+            commands: argument lists, each of which is piped into
+                the next. Arguments are shell quoted.
+        Returns:
+            sox input string
+        """
+        return "|%s" % " | ".join([
+            " ".join([pipes.quote(argument) for argument in \
+                self.governor.pipe_arguments(arguments)]) \
+                    for arguments in commands])
+
+    def _probe_audio_stream(self, storage_backend, archive_stream):
+        """Probe archive stream format.
+
+        If the stream already carries format metadata it is used
+        as is, otherwise the stream is probed and the resulting
+        metadata is recorded on archive_stream.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem,
+                where archive_stream can be found.
+            archive_stream: ArchiveStream object to probe.
+        Returns:
+            MediaInfo object, or None if probing is not configured
+            or fails, in which case callers should assume the stream
+            needs to be transcoded.
+        """
+        if archive_stream.codec is not None:
+            return MediaInfo(
+                    audio_codec=archive_stream.codec,
+                    sample_rate=archive_stream.sample_rate,
+                    channels=archive_stream.channels,
+                    has_video=archive_stream.type in VIDEO_STREAM_TYPES,
+                    duration=archive_stream.length and archive_stream.length / 1000.0,
+                    duration_reliable=archive_stream.length is not None)
+
+        if self.probe is None:
+            return None
+        try:
+            path = storage_backend.path(archive_stream.filename)
+            media_info = self.probe.probe(path)
+        except MediaProbeException as error:
+            self.log.warning("Unable to probe %s: %s" % (archive_stream, error))
+            return None
+
+        archive_stream.codec = media_info.audio_codec
+        archive_stream.sample_rate = media_info.sample_rate
+        archive_stream.channels = media_info.channels
+        if archive_stream.size is None:
+            archive_stream.size = os.path.getsize(path)
+        return media_info
+
     def _extract_audio_stream(self, storage_backend, archive_stream, output_filename):
         """Extract audio stream from specified archive stream.
 
         Extracts audio stream from video stream using ffmpeg, and stores the resulting
         stream using the specified storage_backend.
+
+        If the archive stream is already an audio only stream in the
+        target format no extraction is done and the returned stream
+        references the input file. If only the container needs to
+        change, the audio is stream copied instead of re-encoded.
+        Otherwise audio is decoded to the intermediate format, and
+        output_filename's extension is replaced accordingly.
         
         Args:
             storage_backend: Storage object, accessible on local filesystem,
@@ -106,7 +353,31 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         Raises:
             subprocess.CalledProcessError, StorageException
         """
-        output_path = storage_backend.path(output_filename)
+        media_info = self._probe_audio_stream(storage_backend, archive_stream)
+        target_format = media_info is not None and media_info.matches(
+                TARGET_AUDIO_CODEC, TARGET_SAMPLE_RATE)
+
+        if target_format and not media_info.has_video:
+            self.log.info("Skipping audio extraction for %s (%r)" \
+                    % (archive_stream, media_info))
+            result = ArchiveStream(
+                    filename=archive_stream.filename,
+                    type=ArchiveStreamType.USER_AUDIO_STREAM,
+                    length=archive_stream.length,
+                    users=archive_stream.users,
+                    offset=archive_stream.offset)
+            result.update_metadata(archive_stream)
+            return result
+
+        if target_format:
+            codec = TARGET_AUDIO_CODEC
+            output_path = self._intermediate_path(storage_backend,
+                    output_filename, archive_stream.length, format="mp3")
+        else:
+            codec = INTERMEDIATE_FORMATS[self.intermediate_format]
+            output_filename = self._intermediate_filename(output_filename)
+            output_path = self._intermediate_path(storage_backend,
+                    output_filename, archive_stream.length)
         self._ensure_directory(output_path)
         
         if not os.path.exists(output_path):
@@ -117,49 +388,56 @@ class FFMpegSoxStitcher(ArchiveStitcher):
                     "-y",
                     "-i",
                     storage_backend.path(archive_stream.filename),
-                    "-vn",
-                    "-ar",
-                    "44100",
-                    storage_backend.path(output_filename)
-                    ]
-            
-            self.log.info(ffmpeg_arguments)
+                    "-vn"]
+
+            if target_format:
+                ffmpeg_arguments.extend(["-acodec", "copy"])
+            else:
+                if codec != TARGET_AUDIO_CODEC:
+                    ffmpeg_arguments.extend(["-acodec", codec])
+                ffmpeg_arguments.extend(["-ar", "%s" % TARGET_SAMPLE_RATE])
+
+            with atomic_outputs(output_path) as (temp_path,):
+                ffmpeg_arguments.append(temp_path)
+                
+                self.log.info(ffmpeg_arguments)
 
-            output = subprocess.check_output(
-                    ffmpeg_arguments,
-                    stderr=subprocess.STDOUT)
+                output = self.governor.check_output(
+                        ffmpeg_arguments,
+                        timeout=self.governor.timeout(archive_stream.length),
+                        stderr=subprocess.STDOUT)
 
             self.log.info(output)
+            self._commit_intermediate(storage_backend, output_filename)
 
         return ArchiveStream(
                 filename=output_filename,
                 type=ArchiveStreamType.USER_AUDIO_STREAM,
                 length=archive_stream.length,
                 users=archive_stream.users,
-                offset=archive_stream.offset)
+                offset=archive_stream.offset,
+                codec=codec,
+                sample_rate=TARGET_SAMPLE_RATE,
+                channels=archive_stream.channels)
     
     def _get_audio_stream_stats(self, storage_backend, archive_stream):
         """Get dict of audio stream stats.
         
-        Returns dict of audio stream stats based on the output
-        from 'sox <file> -n stat'. Stats include the following:
+        Returns dict of audio stream stats computed in-process by
+        self.stats_engine. Stats use the key names of
+        'sox <file> -n stat' and include the following:
 
             Samples read
             Length (seconds)
-            Scaled by
             Maximum amplitude
             Minimum amplitude
-            Midline amplitude
-            Mean norm
-            Mean amplitude
             RMS amplitude
-            Maximum delta
-            Minimum delta
-            Mean delta
-            RMS delta
-            Rough frequency
             Volume adjustment
 
+        Stats are cached by the stats engine, so each file is
+        decoded for stats at most once, and are recorded on
+        archive_stream.stats for later stages.
+
         Args:
             storage_backend: Storage object, accessible on local filesystem,
                 where archive_stream can be found.
@@ -167,30 +445,20 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         Returns:
             dict of audio stream stats
         Raises:
-            subprocess.CalledProcessError, StorageException
+            subprocess.CalledProcessError, AudioStatsException,
+            StorageException
         """
-        result = {}
-
-        sox_arguments = [
-                self.sox_path,
-                storage_backend.path(archive_stream.filename),
-                "-n",
-                "stat"]
-        
-        output = subprocess.check_output(sox_arguments, stderr=subprocess.STDOUT)
-        for line in output.split("\n"):
-            line = line.strip()
-            key_value = line.split(":", 1)
-            if len(key_value) == 2:
-                #remove duplicate spaces from stat key
-                key = re.sub(r"\s+", " ", key_value[0].strip())
-                value = float(key_value[1].strip())
-                result[key] = value
-
-        return result
+        if archive_stream.stats is None:
+            path = storage_backend.path(archive_stream.filename)
+            archive_stream.stats = self.stats_engine.stats(path).to_dict()
+        return archive_stream.stats
 
     def _get_audio_stream_length(self, storage_backend, archive_stream):
         """Get audio stream length in milliseconds.
+
+        The length is read from container headers when they are
+        present and reliable, and only falls back to decoding
+        the stream otherwise.
         
         Args:
             storage_backend: Storage object, accessible on local filesystem,
@@ -201,6 +469,10 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         Raises:
             subprocess.CalledProcessError, StorageException
         """
+        media_info = self._probe_audio_stream(storage_backend, archive_stream)
+        if media_info is not None and media_info.duration_reliable:
+            return media_info.duration * 1000.0
+
         stats = self._get_audio_stream_stats(storage_backend, archive_stream)
         return stats["Length (seconds)"] * 1000.0
 
@@ -223,33 +495,48 @@ class FFMpegSoxStitcher(ArchiveStitcher):
             output_filename: output filename to use when  storing audio stream
                 on the storage_backend.
         Returns:
-            ArchiveStream object with adjusted volume
+            ArchiveStream object with adjusted volume. If volume_factor
+            is within VOLUME_FACTOR_TOLERANCE of 1.0 archive_stream
+            is returned unmodified.
         Raises:
             subprocess.CalledProcessError, StorageException
         """
-        output_path = storage_backend.path(output_filename)
+        if abs(volume_factor - 1.0) < VOLUME_FACTOR_TOLERANCE:
+            self.log.info("Skipping volume adjustment (%s) for %s" \
+                    % (volume_factor, archive_stream))
+            return archive_stream
+
+        output_path = self._intermediate_path(storage_backend,
+                output_filename, archive_stream.length)
         self._ensure_directory(output_path)
 
         if not os.path.exists(output_path):
             self.log.info("Adjusting audio volume for %s" % archive_stream)
 
-            sox_arguments = [
-                    self.sox_path,
-                    storage_backend.path(archive_stream.filename),
-                    output_path,
-                    "vol",
-                    "%s" % volume_factor]
-            
-            self.log.info(sox_arguments)
-            output = subprocess.check_output(sox_arguments, stderr=subprocess.STDOUT)
+            with atomic_outputs(output_path) as (temp_path,):
+                sox_arguments = [
+                        self.sox_path,
+                        storage_backend.path(archive_stream.filename)]
+                sox_arguments.extend(self._output_arguments(temp_path))
+                sox_arguments.extend(["vol", "%s" % volume_factor])
+                
+                self.log.info(sox_arguments)
+                output = self.governor.check_output(
+                        sox_arguments,
+                        timeout=self.governor.timeout(archive_stream.length),
+                        stderr=subprocess.STDOUT)
             self.log.info(output)
+            self._commit_intermediate(storage_backend, output_filename)
 
         return ArchiveStream(
                 filename=output_filename,
                 type=archive_stream.type,
                 length=archive_stream.length,
                 users=archive_stream.users,
-                offset=archive_stream.offset)
+                offset=archive_stream.offset,
+                codec=INTERMEDIATE_FORMATS[self.intermediate_format],
+                sample_rate=TARGET_SAMPLE_RATE,
+                channels=archive_stream.channels)
     
     def _normalize_audio_streams(self, storage_backend, archive_streams):
         """Normalize audio streams.
@@ -272,7 +559,8 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         storage_backend with filenames calculated from the
         input stream. The output filename will be identical
         to the input stream with addition of "-norm" immediately
-        before the filename's extension.
+        before the filename's extension, which is replaced by
+        the intermediate format's extension.
 
         Args:
             storage_backend: Storage object, accessible on local filesystem,
@@ -288,7 +576,7 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         def build_output_filename(stream):
             """Get output_filename for given stream."""
             path, ext = os.path.splitext(stream.filename)
-            return "%s-norm%s" % (path, ext)
+            return "%s-norm.%s" % (path, self.intermediate_format)
         
         #determine stream with the lowest volume (RMS Amplitude)
         stream_stats = []
@@ -345,11 +633,116 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         return results
 
 
-    def _stitch_audio_streams(self, storage_backend, archive_streams, output_filename):
+    def _mix_arguments(self, inputs, output_arguments, norm=False):
+        """Get sox arguments mixing inputs.
+
+        Args:
+            inputs: list of (volume, input) tuples, where input is
+                a sox input filename or '|command' pipe.
+            output_arguments: sox output arguments
+            norm: if True, the output is peak normalized
+        Returns:
+            list of sox arguments
+        """
+        sox_arguments = [self.sox_path, "-V1"]
+        if len(inputs) > 1:
+            sox_arguments.append("-m")
+        if norm:
+            sox_arguments.append("--norm")
+        for volume, input in inputs:
+            sox_arguments.extend(["-v", "%s" % volume, input])
+        sox_arguments.extend(output_arguments)
+        return sox_arguments
+
+    def _groups(self, inputs):
+        """Split inputs into groups of at most mix_fan_in inputs."""
+        return [inputs[index:index+self.mix_fan_in] \
+                for index in range(0, len(inputs), self.mix_fan_in)]
+
+    def _reduce_mix_inputs_through_files(self,
+            storage_backend,
+            inputs,
+            output_filename,
+            length=None):
+        """Reduce mix inputs to at most mix_fan_in inputs through files.
+
+        Groups of inputs are mixed, up to mix_threads groups at a
+        time, into 32-bit float wav files, which are then used as
+        inputs in place of the groups. Float output avoids clipping
+        in partial mixes. Input volumes must already include the
+        mix scaling, since group mixes are unity gain.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem.
+            inputs: list of (volume, input) tuples
+            output_filename: base filename for group mix files
+            length: optional mix length in milliseconds, used to
+                set the group mix timeouts.
+        Returns:
+            (list of (volume, input) tuples, list of group mix paths)
+        Raises:
+            subprocess.CalledProcessError, StorageException
+        """
+        paths = []
+        level = 1
+        while self.mix_fan_in and len(inputs) > self.mix_fan_in:
+            commands = []
+            filenames = []
+            next_inputs = []
+            for index, group in enumerate(self._groups(inputs)):
+                if len(group) == 1:
+                    next_inputs.extend(group)
+                    continue
+                filename = "%s-mix-%s-%s.wav" % (os.path.splitext(
+                    output_filename)[0], level, index+1)
+                path = self._intermediate_path(storage_backend,
+                        filename, length, format="float")
+                commands.append(self._mix_arguments(group,
+                    ["-e", "floating-point", "-b", "32", path]))
+                filenames.append(filename)
+                next_inputs.append((1.0, filename))
+
+            self.log.info("Mixing %s groups (level %s)" % (len(commands), level))
+            pool = multiprocessing.pool.ThreadPool(
+                    min(self.mix_threads, len(commands)))
+            try:
+                run = bind_account(
+                        lambda command: self._run_mix_command(command, length))
+                for output in pool.map(run, commands):
+                    self.log.info(output)
+            finally:
+                pool.close()
+                pool.join()
+
+            #replace group mix filenames with their committed paths
+            committed = {}
+            for filename in filenames:
+                committed[filename] = self._commit_intermediate(
+                        storage_backend, filename)
+                paths.append(committed[filename])
+            inputs = [(volume, committed.get(input, input)) \
+                    for volume, input in next_inputs]
+            level += 1
+        return inputs, paths
+
+    def _run_mix_command(self, sox_arguments, length=None):
+        self.log.info(sox_arguments)
+        return self.governor.check_output(
+                sox_arguments,
+                timeout=self.governor.timeout(length),
+                stderr=subprocess.STDOUT)
+
+    def _stitch_audio_streams(self,
+            storage_backend,
+            archive_streams,
+            output_filename,
+            intermediate=False):
         """Stitch multiple audio streams into a single audio stream.
         
         Stitches multiple audio stream into a single audio stream using sox,
         and stores the resulting stream using the specified storage_backend.
+        If there are more than mix_fan_in streams they are mixed
+        hierarchically.
         
         Args:
             storage_backend: Storage object, accessible on local filesystem,
@@ -357,12 +750,18 @@ class FFMpegSoxStitcher(ArchiveStitcher):
             archive_streams: ArchiveStream objects to stitch
             output_filename: output filename to use when storing audio stream
                 on the storage_backend.
+            intermediate: if True, the stitched stream is an intermediate
+                stream which may be placed in the scratch space.
         Returns:
             ArchiveStream object containing stitched audio streams.
         Raises:
             subprocess.CalledProcessError, StorageException
         """
-        output_path = storage_backend.path(output_filename)
+        if intermediate:
+            output_path = self._intermediate_path(storage_backend,
+                    output_filename, self._mix_length(archive_streams))
+        else:
+            output_path = storage_backend.path(output_filename)
         self._ensure_directory(output_path)
 
         users = []
@@ -372,32 +771,55 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         if not os.path.exists(output_path):
             self.log.info("Stitching audio from %s" % archive_streams)
 
-            if len(archive_streams) > 1:
-                sox_arguments = [self.sox_path, "-m", "--norm"]
-
-                for stream in archive_streams:
-                    sox_arguments.append("|sox %s -p pad %s" % (\
+            with atomic_outputs(output_path) as (temp_path,):
+                mix_paths = []
+                if len(archive_streams) > 1:
+                    #scale inputs as sox -m does by default, since
+                    #explicit input volumes disable sox's scaling.
+                    volume = 1.0 / len(archive_streams)
+                    inputs = []
+                    for stream in archive_streams:
+                        inputs.append((volume, self._pipe_input([
+                            self.sox_path,
                             storage_backend.path(stream.filename),
-                            (stream.offset or 0)/1000.0))
-                sox_arguments.append(output_path)
-            else:
-                input_filename = storage_backend.path(archive_streams[0].filename)
-                sox_arguments = [
-                        self.sox_path,
-                        "--norm",
-                        input_filename,
-                        output_path,
-                        "pad",
-                        "%s" % ((stream.offset or 0)/1000.0)
-                        ]
+                            "-p",
+                            "pad",
+                            "%s" % ((stream.offset or 0)/1000.0)])))
+                    inputs, mix_paths = self._reduce_mix_inputs_through_files(
+                            storage_backend=storage_backend,
+                            inputs=inputs,
+                            output_filename=output_filename,
+                            length=self._mix_length(archive_streams))
+                    sox_arguments = self._mix_arguments(inputs,
+                            self._output_arguments(temp_path), norm=True)
+                else:
+                    input_filename = storage_backend.path(archive_streams[0].filename)
+                    sox_arguments = [
+                            self.sox_path,
+                            "--norm",
+                            input_filename]
+                    sox_arguments.extend(self._output_arguments(temp_path))
+                    sox_arguments.extend([
+                            "pad",
+                            "%s" % ((stream.offset or 0)/1000.0)
+                            ])
                 
-            self.log.info(sox_arguments)
-
-            output = subprocess.check_output(
-                    sox_arguments,
-                    stderr=subprocess.STDOUT)
+                self.log.info(sox_arguments)
+
+                try:
+                    output = self.governor.check_output(
+                            sox_arguments,
+                            timeout=self.governor.timeout(
+                                self._mix_length(archive_streams)),
+                            stderr=subprocess.STDOUT)
+                finally:
+                    for path in mix_paths:
+                        if os.path.exists(path):
+                            os.remove(path)
 
             self.log.info(output)
+            if intermediate:
+                self._commit_intermediate(storage_backend, output_filename)
         
         result = ArchiveStream(
                 filename=output_filename,
@@ -409,8 +831,589 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         length = self._get_audio_stream_length(storage_backend, result)
         result.length = length
 
+        #format set by _output_arguments(), after the length so it's
+        #still read from the probed headers rather than decoded.
+        if result.codec is None:
+            result.codec = INTERMEDIATE_FORMATS.get(
+                    os.path.splitext(output_filename)[1][1:], TARGET_AUDIO_CODEC)
+        result.sample_rate = TARGET_SAMPLE_RATE
+
         return result
     
+    def _stitch_single_audio_stream(self,
+            storage_backend,
+            archive_stream,
+            output_filename):
+        """Normalize and encode a single audio stream in one pass.
+
+        Fast path for chats which reduce to a single audio stream.
+        Since there is nothing to mix, the volume normalization
+        pipeline collapses to a single peak normalization gain,
+        which is computed from one stats pass. The stream is then
+        decoded once by sox, which applies the gain and offset
+        padding, and piped into a single ffmpeg process which
+        encodes both the mp3 and mp4 outputs.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem,
+                where archive_stream can be found.
+            archive_stream: audio ArchiveStream object to stitch
+            output_filename: output base filename to use when storing
+                the .mp3 and .mp4 streams on the storage_backend.
+        Returns:
+            (mp3 ArchiveStream, mp4 ArchiveStream) tuple
+        Raises:
+            subprocess.CalledProcessError, StorageException
+        """
+        mp3_filename = "%s.mp3" % output_filename
+        mp4_filename = "%s.mp4" % output_filename
+        mp3_path = storage_backend.path(mp3_filename)
+        mp4_path = storage_backend.path(mp4_filename)
+        self._ensure_directory(mp3_path)
+
+        stats = self._get_audio_stream_stats(storage_backend, archive_stream)
+        offset = (archive_stream.offset or 0) / 1000.0
+        length = stats["Length (seconds)"] * 1000.0
+
+        if not os.path.exists(mp3_path) or not os.path.exists(mp4_path):
+            self.log.info("Stitching single audio stream %s" % archive_stream)
+
+            #peak normalize, equivalent to sox --norm, less a hair of
+            #headroom since the stat volume adjustment is rounded.
+            volume_factor = stats["Volume adjustment"] * 0.999
+            if math.isinf(volume_factor):
+                #digital silence
+                volume_factor = 1.0
+
+            with atomic_outputs(mp3_path, mp4_path) as \
+                    (mp3_temp_path, mp4_temp_path):
+                sox_arguments = [
+                        self.sox_path,
+                        "-V1",
+                        storage_backend.path(archive_stream.filename),
+                        "-t",
+                        "wav",
+                        "-",
+                        "vol",
+                        "%s" % volume_factor,
+                        "pad",
+                        "%s" % offset
+                        ]
+
+                ffmpeg_arguments = [
+                        self.ffmpeg_path,
+                        "-y",
+                        "-i",
+                        "-"] \
+                        + MP3_CODEC_ARGUMENTS + [mp3_temp_path] \
+                        + AAC_CODEC_ARGUMENTS + [mp4_temp_path]
+
+                self.log.info(sox_arguments)
+                self.log.info(ffmpeg_arguments)
+
+                timeout = self.governor.timeout(length + (archive_stream.offset or 0))
+                sox = self.governor.popen(
+                        sox_arguments,
+                        timeout=timeout,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+                ffmpeg = self.governor.popen(
+                        ffmpeg_arguments,
+                        timeout=timeout,
+                        stdin=sox.stdout,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT)
+                #allow sox to receive SIGPIPE if ffmpeg exits
+                sox.stdout.close()
+
+                output, unused = ffmpeg.communicate()
+                sox_output = sox.stderr.read()
+                sox.wait()
+
+                self.log.info(output)
+
+                if sox.returncode or ffmpeg.returncode:
+                    self.governor.check_pipeline([
+                        (sox, sox_arguments, sox_output),
+                        (ffmpeg, ffmpeg_arguments, output)])
+
+        mp3_stream = ArchiveStream(
+                filename=mp3_filename,
+                type=ArchiveStreamType.STITCHED_AUDIO_STREAM,
+                length=length + (archive_stream.offset or 0),
+                users=archive_stream.users,
+                offset=archive_stream.offset,
+                codec=TARGET_AUDIO_CODEC,
+                sample_rate=archive_stream.sample_rate,
+                channels=archive_stream.channels)
+
+        mp4_stream = ArchiveStream(
+                filename=mp4_filename,
+                type=mp3_stream.type,
+                length=mp3_stream.length,
+                users=mp3_stream.users,
+                offset=mp3_stream.offset,
+                codec="aac",
+                sample_rate=mp3_stream.sample_rate,
+                channels=mp3_stream.channels)
+
+        return mp3_stream, mp4_stream
+
+    def _encode_audio_stream(self, storage_backend, archive_stream, output_filename):
+        """Encode intermediate audio stream to final mp3 and mp4 streams.
+
+        The stream is decoded once and encoded to both outputs by
+        a single ffmpeg process, or by self.segment_encoder in
+        parallel segments if the stream is long enough.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem,
+                where archive_stream can be found.
+            archive_stream: intermediate ArchiveStream object to encode.
+            output_filename: output base filename to use when storing
+                the .mp3 and .mp4 streams on the storage_backend.
+        Returns:
+            (mp3 ArchiveStream, mp4 ArchiveStream) tuple
+        Raises:
+            subprocess.CalledProcessError, StorageException
+        """
+        mp3_filename = "%s.mp3" % output_filename
+        mp4_filename = "%s.mp4" % output_filename
+        mp3_path = storage_backend.path(mp3_filename)
+        mp4_path = storage_backend.path(mp4_filename)
+        self._ensure_directory(mp3_path)
+
+        segmented = self.segment_encoder is not None \
+                and archive_stream.length is not None \
+                and self.segment_encoder.should_segment(archive_stream.length)
+
+        if segmented and \
+                (not os.path.exists(mp3_path) or not os.path.exists(mp4_path)):
+            with atomic_outputs(mp3_path, mp4_path) as \
+                    (mp3_temp_path, mp4_temp_path):
+                self.segment_encoder.encode(
+                        path=storage_backend.path(archive_stream.filename),
+                        mp3_path=mp3_temp_path,
+                        mp4_path=mp4_temp_path)
+
+        elif not os.path.exists(mp3_path) or not os.path.exists(mp4_path):
+            self.log.info("Encoding audio for %s" % archive_stream)
+
+            with atomic_outputs(mp3_path, mp4_path) as \
+                    (mp3_temp_path, mp4_temp_path):
+                ffmpeg_arguments = [
+                        self.ffmpeg_path,
+                        "-y",
+                        "-i",
+                        storage_backend.path(archive_stream.filename)] \
+                        + MP3_CODEC_ARGUMENTS + [mp3_temp_path] \
+                        + AAC_CODEC_ARGUMENTS + [mp4_temp_path]
+
+                self.log.info(ffmpeg_arguments)
+
+                output = self.governor.check_output(
+                        ffmpeg_arguments,
+                        timeout=self.governor.timeout(archive_stream.length),
+                        stderr=subprocess.STDOUT)
+
+            self.log.info(output)
+
+        mp3_stream = ArchiveStream(
+                filename=mp3_filename,
+                type=archive_stream.type,
+                length=archive_stream.length,
+                users=archive_stream.users,
+                offset=archive_stream.offset,
+                codec=TARGET_AUDIO_CODEC,
+                sample_rate=archive_stream.sample_rate,
+                channels=archive_stream.channels)
+
+        mp4_stream = ArchiveStream(
+                filename=mp4_filename,
+                type=mp3_stream.type,
+                length=mp3_stream.length,
+                users=mp3_stream.users,
+                offset=mp3_stream.offset,
+                codec="aac",
+                sample_rate=mp3_stream.sample_rate,
+                channels=mp3_stream.channels)
+
+        return mp3_stream, mp4_stream
+
+    def _drain(self, pipe, output):
+        """Read pipe to EOF in a background thread, appending to output."""
+        def run():
+            output.append(pipe.read())
+            pipe.close()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run_encode_pipeline(self,
+            sox_arguments,
+            channels,
+            mp3_path,
+            mp4_path,
+            length=None):
+        """Run sox pipeline and encode its output to mp3 and mp4.
+
+        sox_arguments must write raw 32-bit float audio at
+        TARGET_SAMPLE_RATE with the given number of channels to
+        stdout. The audio is read in-process and written to a single
+        ffmpeg process encoding both outputs, while length and
+        waveform data are computed from the same samples, so only
+        the final outputs are written to disk.
+
+        Args:
+            sox_arguments: sox command writing raw float audio to stdout
+            channels: number of channels in sox output
+            mp3_path: mp3 output path
+            mp4_path: mp4 output path
+            length: optional length of the audio in milliseconds,
+                used to set the pipeline's timeout.
+        Returns:
+            (AudioStats, waveform data numpy array) tuple
+        Raises:
+            subprocess.CalledProcessError
+        """
+        ffmpeg_arguments = [
+                self.ffmpeg_path,
+                "-y",
+                "-f",
+                "f32le",
+                "-ar",
+                "%s" % TARGET_SAMPLE_RATE,
+                "-ac",
+                "%s" % channels,
+                "-i",
+                "-"] \
+                + MP3_CODEC_ARGUMENTS + [mp3_path] \
+                + AAC_CODEC_ARGUMENTS + [mp4_path]
+
+        self.log.info(sox_arguments)
+        self.log.info(ffmpeg_arguments)
+
+        timeout = self.governor.timeout(length)
+        sox = self.governor.popen(
+                sox_arguments,
+                timeout=timeout,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        ffmpeg = self.governor.popen(
+                ffmpeg_arguments,
+                timeout=timeout,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+
+        sox_output = []
+        ffmpeg_output = []
+        drain_threads = [
+            self._drain(sox.stderr, sox_output),
+            self._drain(ffmpeg.stdout, ffmpeg_output)
+        ]
+
+        accumulator = AudioStatsAccumulator(TARGET_SAMPLE_RATE, channels)
+        reducer = WaveformReducer(channels)
+        frame_size = 4 * channels
+        read = written = 0
+        try:
+            #keep samples aligned to whole frames
+            remainder = b""
+            while True:
+                data = sox.stdout.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                read += len(data)
+                ffmpeg.stdin.write(data)
+                written += len(data)
+                data = remainder + data
+                aligned = len(data) - (len(data) % frame_size)
+                remainder = data[aligned:]
+                samples = np.frombuffer(data[:aligned], dtype="<f4")
+                accumulator.update(samples)
+                reducer.update(samples)
+        except IOError as error:
+            #ffmpeg exited early, its error is reported below
+            self.log.warning("Encode pipeline error: %s" % error)
+        finally:
+            sox.stdout.close()
+            try:
+                ffmpeg.stdin.close()
+            except IOError:
+                pass
+            sox.wait()
+            ffmpeg.wait()
+            for thread in drain_threads:
+                thread.join()
+            self.governor.record_pipe(read_bytes=read, write_bytes=written)
+
+        output = b"".join(ffmpeg_output)
+        self.log.info(output)
+
+        if sox.returncode or ffmpeg.returncode:
+            for path in [mp3_path, mp4_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.governor.check_pipeline([
+                (sox, sox_arguments, b"".join(sox_output)),
+                (ffmpeg, ffmpeg_arguments, output)])
+
+        return accumulator.stats(), reducer.data()
+
+    def _get_mix_peak(self, sox_arguments, length=None):
+        """Get the peak amplitude of a mix.
+
+        sox_arguments must write raw 32-bit float audio to stdout,
+        which is read in-process and discarded, so nothing is
+        written to disk.
+
+        Args:
+            sox_arguments: sox command writing raw float audio to stdout
+            length: optional length of the audio in milliseconds,
+                used to set the timeout.
+        Returns:
+            peak absolute sample value
+        Raises:
+            subprocess.CalledProcessError
+        """
+        self.log.info(sox_arguments)
+
+        sox = self.governor.popen(
+                sox_arguments,
+                timeout=self.governor.timeout(length),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        sox_output = []
+        drain_thread = self._drain(sox.stderr, sox_output)
+
+        peak = 0.0
+        read = 0
+        try:
+            #keep samples aligned to whole samples
+            remainder = b""
+            while True:
+                data = sox.stdout.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                read += len(data)
+                data = remainder + data
+                aligned = len(data) - (len(data) % 4)
+                remainder = data[aligned:]
+                if aligned:
+                    samples = np.frombuffer(data[:aligned], dtype="<f4")
+                    peak = max(peak, float(np.abs(samples).max()))
+        finally:
+            sox.stdout.close()
+            sox.wait()
+            drain_thread.join()
+            self.governor.record_pipe(read_bytes=read)
+
+        self.governor.check_process(sox, sox_arguments, b"".join(sox_output))
+        return peak
+
+    def _get_volume_factors(self, stream_stats):
+        """Get normalization volume factors for streams.
+
+        Computes the volume factors applied by
+        _normalize_audio_streams() from the streams' stats alone,
+        so they can be applied while mixing. Since volume is
+        linear, the adjusted RMS amplitude of the lowest volume
+        stream is its RMS amplitude times its volume factor.
+
+        Args:
+            stream_stats: list of audio stream stats dicts
+        Returns:
+            list of volume factors
+        """
+        audible = [i for i, stats in enumerate(stream_stats) \
+                if stats["RMS amplitude"] > 0]
+        if not audible:
+            return [1.0] * len(stream_stats)
+
+        lowest_volume_index = min(audible,
+                key=lambda i: stream_stats[i]["RMS amplitude"])
+        lowest_volume_stats = stream_stats[lowest_volume_index]
+        lowest_volume_factor = lowest_volume_stats["Volume adjustment"] * 0.7
+        target_volume = lowest_volume_stats["RMS amplitude"] \
+                * lowest_volume_factor
+
+        results = []
+        for index, stats in enumerate(stream_stats):
+            if index == lowest_volume_index:
+                results.append(lowest_volume_factor)
+            elif index in audible:
+                results.append(target_volume / stats["RMS amplitude"])
+            else:
+                results.append(1.0)
+        return results
+
+    def _stream_audio_streams(self, storage_backend, archive_streams, output_filename):
+        """Extract, normalize, mix and encode audio streams through pipes.
+
+        Streaming equivalent of extracting, normalizing and stitching
+        audio streams and converting the result to mp4. Streams which
+        need audio extraction are decoded by an ffmpeg process piped
+        into sox, volume factors are applied as sox input volumes,
+        and the mix is encoded by _run_encode_pipeline(). Only the
+        final mp3 and mp4 streams are written, unless there are more
+        than mix_fan_in streams, in which case groups of streams are
+        first mixed into files by _reduce_mix_inputs_through_files(),
+        so no sox process runs more than mix_fan_in input pipelines.
+
+        A single stream is peak normalized with the gain from its
+        stats, as in _stitch_single_audio_stream(). A mix is peak
+        normalized with a gain from its peak, measured by first
+        running the mix through _get_mix_peak(), which costs a
+        second decode of the inputs but no disk I/O.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem,
+                where archive_streams can be found.
+            archive_streams: ArchiveStream objects to stitch
+            output_filename: output base filename to use when storing
+                the .mp3 and .mp4 streams on the storage_backend.
+        Returns:
+            (mp3 ArchiveStream, mp4 ArchiveStream) tuple with
+            waveform data set.
+        Raises:
+            subprocess.CalledProcessError, StorageException
+        """
+        mp3_filename = "%s.mp3" % output_filename
+        mp4_filename = "%s.mp4" % output_filename
+        mp3_path = storage_backend.path(mp3_filename)
+        mp4_path = storage_backend.path(mp4_filename)
+        self._ensure_directory(mp3_path)
+
+        self.log.info("Streaming audio from %s" % archive_streams)
+
+        users = []
+        for stream in archive_streams:
+            users.extend(stream.users)
+
+        stream_stats = [self._get_audio_stream_stats(storage_backend, s) \
+                for s in archive_streams]
+        channels = max([s.channels or 2 for s in archive_streams])
+
+        if len(archive_streams) > 1:
+            #scale inputs as sox -m does by default, since
+            #explicit input volumes disable sox's scaling.
+            volume_factors = [factor / len(archive_streams) \
+                    for factor in self._get_volume_factors(stream_stats)]
+        else:
+            #peak normalize, less a hair of headroom since the
+            #stat volume adjustment is rounded.
+            volume_factor = stream_stats[0]["Volume adjustment"] * 0.999
+            if math.isinf(volume_factor):
+                #digital silence
+                volume_factor = 1.0
+            volume_factors = [volume_factor]
+
+        inputs = []
+        for stream, volume_factor in zip(archive_streams, volume_factors):
+            path = storage_backend.path(stream.filename)
+            offset = (stream.offset or 0) / 1000.0
+            media_info = self._probe_audio_stream(storage_backend, stream)
+            if media_info is not None and not media_info.has_video \
+                    and media_info.audio_codec in INTERMEDIATE_FORMATS.values():
+                input = self._pipe_input([
+                    self.sox_path,
+                    path,
+                    "-p",
+                    "rate",
+                    "%s" % TARGET_SAMPLE_RATE,
+                    "pad",
+                    "%s" % offset])
+            else:
+                input = self._pipe_input([
+                    self.ffmpeg_path,
+                    "-v",
+                    "error",
+                    "-i",
+                    path,
+                    "-vn",
+                    "-ar",
+                    "%s" % TARGET_SAMPLE_RATE,
+                    "-f",
+                    "sox",
+                    "-"], [
+                    self.sox_path,
+                    "-p",
+                    "-p",
+                    "pad",
+                    "%s" % offset])
+            inputs.append((volume_factor, input))
+
+        output_arguments = [
+            "-t",
+            "raw",
+            "-e",
+            "floating-point",
+            "-b",
+            "32",
+            "-r",
+            "%s" % TARGET_SAMPLE_RATE,
+            "-c",
+            "%s" % channels,
+            "-"]
+        length = self._mix_length(archive_streams)
+
+        #bound the number of inputs, and so decoders, per sox process
+        inputs, mix_paths = self._reduce_mix_inputs_through_files(
+                storage_backend=storage_backend,
+                inputs=inputs,
+                output_filename=output_filename,
+                length=length)
+
+        try:
+            if len(archive_streams) > 1:
+                #peak normalize the mix, equivalent to sox --norm, which
+                #would spool the whole mix to a temporary file. Instead
+                #the peak is measured by a first pass through the mix.
+                peak = self._get_mix_peak(
+                        self._mix_arguments(inputs, output_arguments), length)
+                if peak > 0:
+                    inputs = [(volume * 0.999 / peak, input) \
+                            for volume, input in inputs]
+
+            with atomic_outputs(mp3_path, mp4_path) as \
+                    (mp3_temp_path, mp4_temp_path):
+                stats, waveform_data = self._run_encode_pipeline(
+                        sox_arguments=self._mix_arguments(inputs, output_arguments),
+                        channels=channels,
+                        mp3_path=mp3_temp_path,
+                        mp4_path=mp4_temp_path,
+                        length=length)
+        finally:
+            for path in mix_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        mp3_stream = ArchiveStream(
+                filename=mp3_filename,
+                type=ArchiveStreamType.STITCHED_AUDIO_STREAM,
+                length=stats.length * 1000.0,
+                users=users,
+                offset=min([s.offset for s in archive_streams]),
+                waveform=json.dumps(waveform_data, cls=Encoder),
+                codec=TARGET_AUDIO_CODEC,
+                sample_rate=TARGET_SAMPLE_RATE,
+                channels=channels)
+
+        mp4_stream = ArchiveStream(
+                filename=mp4_filename,
+                type=mp3_stream.type,
+                length=mp3_stream.length,
+                users=mp3_stream.users,
+                offset=mp3_stream.offset,
+                waveform=mp3_stream.waveform,
+                codec="aac",
+                sample_rate=mp3_stream.sample_rate,
+                channels=mp3_stream.channels)
+
+        return mp3_stream, mp4_stream
+
     def _to_mp4_stream(self, storage_backend, archive_stream, output_filename):
         """Convert stream mp4 archive stream.
 
@@ -433,17 +1436,18 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         if not os.path.exists(output_path):
             self.log.info("Converting to mp4 for %s" % archive_stream)
 
-            ffmpeg_arguments = [
-                    self.ffmpeg_path,
-                    "-y",
-                    "-i",
-                    storage_backend.path(archive_stream.filename),
-                    storage_backend.path(output_filename)
-                    ]
-
-            output = subprocess.check_output(
-                    ffmpeg_arguments,
-                    stderr=subprocess.STDOUT)
+            with atomic_outputs(output_path) as (temp_path,):
+                ffmpeg_arguments = [
+                        self.ffmpeg_path,
+                        "-y",
+                        "-i",
+                        storage_backend.path(archive_stream.filename)] \
+                        + AAC_CODEC_ARGUMENTS + [temp_path]
+
+                output = self.governor.check_output(
+                        ffmpeg_arguments,
+                        timeout=self.governor.timeout(archive_stream.length),
+                        stderr=subprocess.STDOUT)
             
             self.log.info(output)
 
@@ -452,8 +1456,105 @@ class FFMpegSoxStitcher(ArchiveStitcher):
                 type=archive_stream.type,
                 length=archive_stream.length,
                 users=archive_stream.users,
-                offset=archive_stream.offset)
+                offset=archive_stream.offset,
+                codec="aac",
+                sample_rate=archive_stream.sample_rate,
+                channels=archive_stream.channels)
     
+    def _stitch_files(self, storage_backend, archive_streams, output_filename):
+        """Extract, normalize and stitch audio streams through files.
+
+        Each step writes its output to storage_backend, where
+        it's read by the next step.
+
+        Args:
+            storage_backend: Storage object, accessible on local filesystem,
+                where archive_streams can be found.
+            archive_streams: preprocessed ArchiveStream objects to stitch
+            output_filename: output base filename to use when storing
+                the .mp3 and .mp4 streams on the storage_backend.
+        Returns:
+            (mp3 ArchiveStream, mp4 ArchiveStream) tuple
+        Raises:
+            subprocess.CalledProcessError, StorageException
+        """
+        #extact audio from video streams
+        audio_streams = []
+        for index, stream in enumerate(archive_streams):
+            audio_stream = self._extract_audio_stream(
+                    storage_backend=storage_backend,
+                    archive_stream=stream,
+                    output_filename="%s-%s.%s" \
+                            % (output_filename, index+1,
+                                self.intermediate_format))
+            audio_streams.append(audio_stream)
+        
+        if len(audio_streams) == 1:
+            #single stream, nothing to mix
+            stitched_stream, mp4_stream = \
+                    self._stitch_single_audio_stream(
+                            storage_backend=storage_backend,
+                            archive_stream=audio_streams[0],
+                            output_filename=output_filename)
+        else:
+            #normalize audio streams volume
+            normalized_streams = self._normalize_audio_streams(
+                    storage_backend=storage_backend,
+                    archive_streams=audio_streams)
+
+            if self.intermediate_format == "mp3":
+                #stitch audio streams together
+                stitched_stream = self._stitch_audio_streams(
+                        storage_backend=storage_backend,
+                        archive_streams=normalized_streams,
+                        output_filename="%s.mp3" % output_filename)
+
+                #convert stitched stream to mp4
+                mp4_stream = self._to_mp4_stream(
+                        storage_backend=storage_backend,
+                        archive_stream=stitched_stream,
+                        output_filename="%s.mp4" % output_filename)
+            else:
+                #stitch audio streams together into an
+                #intermediate stream and encode it once
+                #to the final mp3 and mp4 streams.
+                mixed_stream = self._stitch_audio_streams(
+                        storage_backend=storage_backend,
+                        archive_streams=normalized_streams,
+                        output_filename="%s-mix.%s" % \
+                                (output_filename,
+                                    self.intermediate_format),
+                        intermediate=True)
+
+                stitched_stream, mp4_stream = \
+                        self._encode_audio_stream(
+                                storage_backend=storage_backend,
+                                archive_stream=mixed_stream,
+                                output_filename=output_filename)
+
+        return stitched_stream, mp4_stream
+
+    def _should_segment(self, archive_streams):
+        """Check if the mix of archive_streams should be segment encoded.
+
+        Segmented encoding requires a 'wav' intermediate mix and
+        is only worthwhile for mixes spanning multiple segments.
+        """
+        if self.segment_encoder is None or self.intermediate_format != "wav":
+            return False
+        length = self._mix_length(archive_streams)
+        return length is not None and self.segment_encoder.should_segment(length)
+
+    def _mix_length(self, archive_streams):
+        """Get length of the mix of archive_streams in milliseconds.
+
+        Returns:
+            mix length, or None if any stream's length is unknown.
+        """
+        if any([s.length is None for s in archive_streams]):
+            return None
+        return max([(s.offset or 0) + s.length for s in archive_streams])
+
     def _download_archive_streams(self, archive_streams):
         """Download archive streams to local filesystem.
         
@@ -468,8 +1569,7 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         with self.storage_pool.get() as remote_storage:
             with self.filesystem_storage_pool.get() as local_storage:
                 for stream in archive_streams:
-                    with remote_storage.open(stream.filename, "r") as stream_file:
-                        local_storage.save(stream.filename, stream_file)
+                    transfer(remote_storage, local_storage, stream.filename)
 
     def _upload_archive_streams(self, archive_streams):
         """Upload archive streams to storage_pool.
@@ -484,8 +1584,7 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         with self.storage_pool.get() as remote_storage:
             with self.filesystem_storage_pool.get() as local_storage:
                 for stream in archive_streams:
-                    with local_storage.open(stream.filename, "r") as stream_file:
-                        remote_storage.save(stream.filename, stream_file)
+                    transfer(local_storage, remote_storage, stream.filename)
 
     def _preprocess_archive_streams(self, archive_streams, storage_backend):
         """Pre-process archive streams. 
@@ -569,32 +1668,31 @@ class FFMpegSoxStitcher(ArchiveStitcher):
                         archive_streams=archive_streams,
                         storage_backend=storage_backend)
 
-                #extact audio from video streams
-                audio_streams = []
-                for index, stream in enumerate(archive_streams):
-                    audio_stream = self._extract_audio_stream(
+                if self.scratch is not None:
+                    storage_backend = self.scratch.job(
+                            output_filename).storage(storage_backend)
+
+                if self.streaming and not self._should_segment(archive_streams):
+                    #extract, normalize, stitch and encode through pipes
+                    stitched_stream, mp4_stream = \
+                            self._stream_audio_streams(
+                                    storage_backend=storage_backend,
+                                    archive_streams=archive_streams,
+                                    output_filename=output_filename)
+                else:
+                    stitched_stream, mp4_stream = self._stitch_files(
                             storage_backend=storage_backend,
-                            archive_stream=stream,
-                            output_filename="%s-%s.mp3" \
-                                    % (output_filename, index+1))
-                    audio_streams.append(audio_stream)
-                
-                #normalize audio streams volume
-                normalized_streams = self._normalize_audio_streams(
-                        storage_backend=storage_backend,
-                        archive_streams=audio_streams)
+                            archive_streams=archive_streams,
+                            output_filename=output_filename)
 
-                #stitch audio streams together
-                stitched_stream = self._stitch_audio_streams(
-                        storage_backend=storage_backend,
-                        archive_streams=normalized_streams,
-                        output_filename="%s.mp3" % output_filename)
+                for stream in [stitched_stream, mp4_stream]:
+                    if stream.size is None:
+                        stream.size = os.path.getsize(
+                                storage_backend.path(stream.filename))
 
-                #convert stitched stream to mp4
-                mp4_stream = self._to_mp4_stream(
-                        storage_backend=storage_backend,
-                        archive_stream=stitched_stream,
-                        output_filename="%s.mp4" % output_filename)
+                #intermediates are kept for retries on failure only
+                if self.scratch is not None:
+                    storage_backend.release()
             
             #if the storage_pool is not accessible on local filesystem
             #upload the stitched stream.
@@ -603,6 +1701,7 @@ class FFMpegSoxStitcher(ArchiveStitcher):
         
         except Exception as error:
             self.log.exception(error)
-            raise ArchiveStitcherException(str(error))
+            raise ArchiveStitcherException(str(error),
+                    permanent=getattr(error, "permanent", False))
 
         return [mp4_stream, stitched_stream]
@@ -0,0 +1,163 @@
+from trsvcscore.storage.cloudfiles import CloudfilesStorage
+from trsvcscore.storage.exception import StorageException
+
+from elastic import CONNECTION_ERRORS
+
+class StorageConnectionException(StorageException):
+    """Storage exception caused by a connection error.
+
+    Raised instead of StorageException so pools can discard the
+    storage object's broken connection instead of reusing it.
+    """
+    pass
+
+def storage_exception(error):
+    """Wrap error in a StorageException.
+
+    Args:
+        error: exception raised by the cloudfiles client
+    Returns:
+        StorageConnectionException if error is one of
+        CONNECTION_ERRORS, StorageException otherwise, with
+        the original exception as its cause attribute.
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        exception = StorageConnectionException(str(error))
+    else:
+        exception = StorageException(str(error))
+    exception.cause = error
+    return exception
+
+class ManifestCloudfilesStorage(CloudfilesStorage):
+    """Cloudfiles storage supporting segmented objects.
+
+    Cloudfiles limits the size of a single object, and uploads a
+    single object serially. Large files are instead uploaded as
+    concurrent segments and made visible as a single object by a
+    zero-byte manifest object whose X-Object-Manifest header names
+    the container and prefix of its segments. Reads of the manifest
+    object return the segments concatenated in name order.
+
+    Objects can also be listed by name prefix, paging through
+    listings larger than a single response, and expose their ETag
+    so uploads can be verified.
+    """
+
+    def __init__(self, cloudfiles_client, container_name,
+            list_page_size=10000, *args, **kwargs):
+        """ManifestCloudfilesStorage constructor.
+
+        Args:
+            cloudfiles_client: Cloudfiles client object
+            container_name: name of container to store objects in
+            list_page_size: maximum number of names per listing
+                request. Cloudfiles returns at most 10000.
+        """
+        super(ManifestCloudfilesStorage, self).__init__(
+                cloudfiles_client=cloudfiles_client,
+                container_name=container_name,
+                *args, **kwargs)
+        self.client = cloudfiles_client
+        self.container_name = container_name
+        self.list_page_size = list_page_size
+
+    def list_prefix(self, prefix):
+        """List names of objects starting with prefix.
+
+        Args:
+            prefix: object name prefix
+        Returns:
+            list of object names starting with prefix, in name order.
+        Raises:
+            StorageException
+        """
+        try:
+            container = self.client.get_container(
+                    self.container_name)
+            names = []
+            marker = None
+            while True:
+                page = container.list_objects(prefix=prefix,
+                        marker=marker, limit=self.list_page_size)
+                names.extend(page)
+                if len(page) < self.list_page_size:
+                    break
+                marker = page[-1]
+            return names
+        except Exception as error:
+            raise storage_exception(error)
+
+    def etag(self, name):
+        """Get ETag of stored object, the md5 hex digest of its data.
+
+        Manifest objects' ETags are not the md5 of their data.
+
+        Args:
+            name: object name
+        Returns:
+            ETag string, or None if unknown.
+        Raises:
+            StorageException
+        """
+        try:
+            container = self.client.get_container(
+                    self.container_name)
+            return container.get_object(name).etag
+        except Exception as error:
+            raise storage_exception(error)
+
+    def segments(self, name):
+        """Get segment names of a manifest object.
+
+        Args:
+            name: object name
+        Returns:
+            list of segment names in order, or None if name is
+            not a manifest object.
+        Raises:
+            StorageException
+        """
+        try:
+            container = self.client.get_container(
+                    self.container_name)
+            manifest = container.get_object(name).manifest
+        except Exception as error:
+            raise storage_exception(error)
+        if not manifest:
+            return None
+
+        container_name, prefix = manifest.split("/", 1)
+        if container_name != self.container_name:
+            raise StorageException(
+                    "segments of '%s' are in container '%s'" \
+                    % (name, container_name))
+        return self.list_prefix(prefix)
+
+    def save_manifest(self, name, segment_names):
+        """Save manifest object for previously saved segments.
+
+        Args:
+            name: name of the manifest object
+            segment_names: names of the segments of name, which
+                must be prefixed by "<name>/" and sort in order.
+        Raises:
+            StorageException
+        """
+        prefix = "%s/" % name
+        for segment_name in segment_names:
+            if not segment_name.startswith(prefix):
+                raise StorageException(
+                        "segment '%s' is not prefixed by '%s'" \
+                        % (segment_name, prefix))
+        if sorted(segment_names) != list(segment_names):
+            raise StorageException(
+                    "segments of '%s' are not in name order" % name)
+
+        try:
+            container = self.client.get_container(
+                    self.container_name)
+            manifest = container.create_object(name)
+            manifest.manifest = "%s/%s" % (self.container_name, prefix)
+            manifest.write(b"")
+        except Exception as error:
+            raise storage_exception(error)
@@ -2,10 +2,20 @@ class ArchiveStreamManifest(object):
     """Archive steam manifest."""
     def __init__(self, archive_streams):
         self.archive_streams = archive_streams
-    
+
+    def to_dict(self):
+        return {
+            "archive_streams": [s.to_dict() for s in self.archive_streams]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(archive_streams=[ArchiveStream.from_dict(s) \
+                for s in data.get("archive_streams", [])])
+
     def __repr__(self):
-        return "%s(filename=%r)" % \
-            (self.__class__.__name__, self.filename)
+        return "%s(archive_streams=%r)" % \
+            (self.__class__.__name__, self.archive_streams)
 
 class ArchiveStreamType(object):
     """Archive steam type."""
@@ -16,7 +26,33 @@ class ArchiveStreamType(object):
     STITCHED_AUDIO_STREAM = "STITCHED_AUDIO_STREAM"
 
 class ArchiveStream(object):
-    """Archive stream."""
+    """Archive stream.
+
+    In addition to the stream's identity, an archive stream
+    carries media metadata (codec, sample_rate, channels, size,
+    content_hash and loudness stats) once any stage has
+    computed it, so later stages do not need to re-probe.
+    """
+
+    #media metadata fields, which are None until computed
+    METADATA_FIELDS = (
+        "codec",
+        "sample_rate",
+        "channels",
+        "size",
+        "content_hash",
+        "stats"
+    )
+
+    __slots__ = (
+        "filename",
+        "type",
+        "length",
+        "users",
+        "offset",
+        "waveform",
+        "waveform_filename") + METADATA_FIELDS
+
     def __init__(self,
             filename,
             type,
@@ -24,7 +60,13 @@ class ArchiveStream(object):
             users=None,
             offset=0,
             waveform=None,
-            waveform_filename=None):
+            waveform_filename=None,
+            codec=None,
+            sample_rate=None,
+            channels=None,
+            size=None,
+            content_hash=None,
+            stats=None):
         self.filename = filename
         self.type = type
         self.length = length
@@ -32,7 +74,54 @@ class ArchiveStream(object):
         self.offset = offset
         self.waveform = waveform
         self.waveform_filename = waveform_filename
-    
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.size = size
+        self.content_hash = content_hash
+        self.stats = stats
+
+    def update_metadata(self, archive_stream):
+        """Copy media metadata from archive_stream.
+
+        Only fields which have not yet been computed for this
+        stream are copied. This should only be used for streams
+        which reference the same media.
+
+        Args:
+            archive_stream: ArchiveStream object
+        """
+        for field in self.METADATA_FIELDS:
+            if getattr(self, field) is None:
+                setattr(self, field, getattr(archive_stream, field))
+
+    def metadata(self):
+        """Get dict of computed media metadata fields."""
+        result = {}
+        for field in self.METADATA_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                result[field] = value
+        return result
+
+    def to_dict(self):
+        """Get compact dict representation, omitting unset fields."""
+        result = {
+            "filename": self.filename,
+            "type": self.type,
+            "length": self.length
+        }
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if value is not None and value != []:
+                result[field] = value
+        return result
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create ArchiveStream from to_dict() representation."""
+        return cls(**dict((str(k), v) for k, v in data.items()))
+
     def __repr__(self):
         return "%s(filename=%r, type=%r, length=%r, offset=%r)" % (\
                 self.__class__.__name__,
@@ -0,0 +1,435 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+
+from trsvcscore.storage.exception import NotImplemented
+
+#Linux FICLONE ioctl, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+#maximum bytes per copy_file_range / sendfile call
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+class TransferException(Exception):
+    """Transfer exception."""
+    pass
+
+
+class MappedFile(object):
+    """Read-only file object backed by mmap.
+
+    Upload bodies are read straight out of the page cache instead
+    of being copied through a userspace read buffer first. The file
+    object may be restricted to a window of the file, so segments
+    of a large file can be uploaded concurrently.
+    """
+
+    def __init__(self, path, offset=0, length=None):
+        """MappedFile constructor.
+
+        Args:
+            path: local filesystem path of a non-empty file
+            offset: offset in bytes of the window in the file
+            length: length in bytes of the window, defaults to
+                the rest of the file.
+        """
+        self.name = path
+        self.file = open(path, "rb")
+        try:
+            file_size = os.fstat(self.file.fileno()).st_size
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.offset = min(offset, file_size)
+        if length is None:
+            length = file_size - self.offset
+        self.size = min(length, file_size - self.offset)
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            data = self.read(1024 * 1024)
+            if not data:
+                break
+            yield data
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        start = self.offset + self.position
+        self.position += size
+        return self.map[start:start + size]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.map.close()
+            self.file.close()
+
+
+class HashingFile(object):
+    """File object wrapper computing the md5 of data read from it.
+
+    The digest is computed in the same read loop the storage
+    backend uses to upload the file, so the file is read once.
+    If the backend rewinds to retry, the digest is restarted.
+    """
+
+    def __init__(self, file):
+        """HashingFile constructor.
+
+        Args:
+            file: file object to read from
+        """
+        self.file = file
+        self.md5 = hashlib.md5()
+        self.valid = True
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def __len__(self):
+        if hasattr(self.file, "__len__"):
+            return len(self.file)
+        #regular file objects, i.e. empty files from open_upload()
+        return os.fstat(self.file.fileno()).st_size
+
+    def __iter__(self):
+        while True:
+            data = self.read(1024 * 1024)
+            if not data:
+                break
+            yield data
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.md5.update(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.file.seek(offset, whence)
+        if self.file.tell() == 0:
+            self.md5 = hashlib.md5()
+            self.valid = True
+        else:
+            self.valid = False
+
+    def hexdigest(self):
+        """Get md5 hex digest of the data read, or None if unknown."""
+        if not self.valid:
+            return None
+        return self.md5.hexdigest()
+
+
+def hash_file(path):
+    """Get md5 hex digest of local file at path."""
+    md5 = hashlib.md5()
+    with open_upload(path) as file:
+        while True:
+            data = file.read(1024 * 1024)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+def local_path(storage_backend, filename):
+    """Get local filesystem path of filename in storage_backend.
+
+    Returns:
+        local filesystem path, or None if storage_backend
+        is not accessible on the local filesystem.
+    """
+    try:
+        return storage_backend.path(filename)
+    except NotImplemented:
+        return None
+
+def open_upload(path):
+    """Open local file at path as an upload body.
+
+    Returns:
+        MappedFile, or a regular file object for empty files
+        which can not be mapped.
+    """
+    if os.path.getsize(path) == 0:
+        return open(path, "rb")
+    return MappedFile(path)
+
+def _ensure_directory(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            #created concurrently
+            if not os.path.isdir(directory):
+                raise
+
+def _file_mode():
+    """Get mode of files created under the process umask."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Umask:"):
+                    return 0o666 & ~int(line.split()[1], 8)
+    except (IOError, OSError, ValueError):
+        pass
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def _reflink(source_file, destination_file):
+    fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+def _kernel_copy(source_file, destination_file, size):
+    """Copy size bytes between files without userspace buffers.
+
+    Returns:
+        name of the method used.
+    Raises:
+        OSError, if no kernel side copy is available or supported.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    source_fd = source_file.fileno()
+    destination_fd = destination_file.fileno()
+
+    for name, copy in [("copy_file_range", copy_file_range),
+            ("sendfile", sendfile)]:
+        if copy is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                count = min(size - offset, KERNEL_COPY_CHUNK_SIZE)
+                if name == "sendfile":
+                    copied = copy(destination_fd, source_fd, offset, count)
+                else:
+                    copied = copy(source_fd, destination_fd, count,
+                            offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as error:
+            #unsupported for this pair of files, i.e. cross filesystem
+            #copy_file_range on older kernels, try next method
+            if offset == 0 and error.errno in (errno.EXDEV, errno.EINVAL,
+                    errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                continue
+            raise
+        if offset == size:
+            return name
+        raise OSError(errno.EIO, "short copy %s of %s bytes" % (offset, size))
+
+    raise OSError(errno.ENOSYS, "no kernel copy available")
+
+def copy_file(source_path, destination_path, link=False):
+    """Copy local file, avoiding userspace copies where possible.
+
+    Methods are tried in order: hardlink, if link is True, and
+    reflink when both paths are on the same filesystem, then
+    copy_file_range, sendfile and finally a buffered copy. The
+    destination is written to a temporary file and renamed into
+    place, so an existing destination is replaced, never modified
+    in place.
+
+    Args:
+        source_path: local filesystem path of source file
+        destination_path: local filesystem path of destination file
+        link: if True, the destination may be hardlinked to the
+            source. Only use for files which are never modified
+            in place afterwards.
+    Returns:
+        name of the method used.
+    Raises:
+        TransferException
+    """
+    temp_path = None
+    try:
+        _ensure_directory(destination_path)
+        directory, filename = os.path.split(destination_path)
+        same_device = os.stat(source_path).st_dev \
+                == os.stat(directory or ".").st_dev
+
+        fd, temp_path = tempfile.mkstemp(prefix=".%s." % filename,
+                dir=directory or None)
+        os.close(fd)
+
+        method = None
+        if link and same_device:
+            try:
+                os.remove(temp_path)
+                os.link(source_path, temp_path)
+                method = "link"
+            except OSError:
+                #i.e. EPERM on filesystems without hardlinks
+                pass
+
+        if method is None:
+            size = os.path.getsize(source_path)
+            with open(source_path, "rb") as source_file:
+                with open(temp_path, "wb") as destination_file:
+                    if same_device:
+                        try:
+                            _reflink(source_file, destination_file)
+                            method = "reflink"
+                        except (IOError, OSError):
+                            pass
+                    if method is None:
+                        try:
+                            method = _kernel_copy(source_file,
+                                    destination_file, size)
+                        except OSError:
+                            source_file.seek(0)
+                            destination_file.seek(0)
+                            destination_file.truncate()
+                            shutil.copyfileobj(source_file,
+                                    destination_file, 1024 * 1024)
+                            method = "copy"
+            shutil.copymode(source_path, temp_path)
+
+        os.rename(temp_path, destination_path)
+        return method
+    except Exception as error:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise TransferException(str(error))
+
+@contextlib.contextmanager
+def atomic_outputs(*paths):
+    """Write output files under temporary names, renamed on success.
+
+    Temporary files are created next to their outputs and keep the
+    output's extension, since ffmpeg and sox choose output formats
+    by extension. If the block raises they are removed, so output
+    paths only ever hold complete files, and a retry never reuses
+    an output truncated by a failed or killed process.
+
+    Usage:
+        with atomic_outputs(mp3_path, mp4_path) as (mp3_temp, mp4_temp):
+            ...
+
+    Args:
+        paths: output file paths
+    Returns:
+        list of temporary paths, one for each output path.
+    """
+    temp_paths = []
+    try:
+        for path in paths:
+            _ensure_directory(path)
+            directory, filename = os.path.split(path)
+            base, extension = os.path.splitext(filename)
+            fd, temp_path = tempfile.mkstemp(prefix=".%s." % base,
+                    suffix=extension, dir=directory or None)
+            os.close(fd)
+            temp_paths.append(temp_path)
+
+        yield temp_paths
+
+        #mkstemp files are owner only, outputs keep the mode of the
+        #file they replace, or get the mode of a newly created file.
+        mode = _file_mode()
+        for temp_path, path in zip(temp_paths, paths):
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+            else:
+                os.chmod(temp_path, mode)
+            os.rename(temp_path, path)
+    finally:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def upload_file(path, destination_storage, filename, link=False):
+    """Store local file at path in destination_storage as filename.
+
+    Args:
+        path: local filesystem path
+        destination_storage: Storage object to store filename in
+        filename: destination filename
+        link: if True, local destinations may be hardlinked to
+            path. See copy_file().
+    Returns:
+        name of the method used.
+    Raises:
+        TransferException, StorageException
+    """
+    destination_path = local_path(destination_storage, filename)
+    if destination_path is not None:
+        return copy_file(path, destination_path, link=link)
+    with open_upload(path) as upload:
+        destination_storage.save(filename, upload)
+    return "mmap"
+
+def transfer(source_storage, destination_storage, filename, link=False):
+    """Transfer filename from source_storage to destination_storage.
+
+    Local to local transfers use copy_file(). Uploads from local
+    storage read the file through mmap. Other transfers stream the
+    file through the storage backends.
+
+    Args:
+        source_storage: Storage object containing filename
+        destination_storage: Storage object to store filename in
+        filename: filename to transfer
+        link: if True, local destinations may be hardlinked to
+            the source. See copy_file().
+    Returns:
+        name of the method used.
+    Raises:
+        TransferException, StorageException
+    """
+    source_path = local_path(source_storage, filename)
+    destination_path = local_path(destination_storage, filename)
+
+    if source_path is not None and destination_path is not None:
+        if os.path.abspath(source_path) == os.path.abspath(destination_path):
+            return "none"
+        method = copy_file(source_path, destination_path, link=link)
+    elif source_path is not None:
+        method = upload_file(source_path, destination_storage, filename)
+    else:
+        with source_storage.open(filename, "r") as stream_file:
+            destination_storage.save(filename, stream_file)
+        method = "stream"
+
+    log.debug("Transferred '%s' (%s)" % (filename, method))
+    return method
@@ -11,7 +11,11 @@ from scikits.audiolab import Sndfile
 from trpycore.pool.simple import SimplePool
 from trsvcscore.storage.exception import NotImplemented
 from trsvcscore.storage.filesystem import FileSystemStorage
+from audiostats import AudioStats, FFMpegAudioStatsEngine
+from governor import ResourceGovernor
+from scratch import WAV_BYTES_PER_SECOND, ScratchStorage
 from stream import ArchiveStream, ArchiveStreamType
+from transfer import atomic_outputs, transfer
 
 class Encoder(json.JSONEncoder):
     def default(self, obj):
@@ -19,9 +23,89 @@ class Encoder(json.JSONEncoder):
             return [float("%.4f" % n) for n in obj]
         return json.JSONEncoder.default(self, obj)
 
+class WaveformReducer(object):
+    """Streaming waveform data reducer.
+
+    Reduces interleaved float samples, fed in chunks as they are
+    decoded, to waveform data without knowing the stream length in
+    advance. The maximum magnitude of each block of block_frames
+    frames is kept, and blocks are reduced to the requested number
+    of values when data() is called. Until there are enough frames
+    for size blocks, the maximum of each frame is kept instead, so
+    short streams still span the full size.
+    """
+    def __init__(self, channels, size=1800, block_frames=256):
+        """WaveformReducer constructor.
+
+        Args:
+            channels: number of interleaved channels
+            size: size of the waveform data array
+            block_frames: number of frames reduced to a single
+                value as samples are fed.
+        """
+        self.channels = channels
+        self.size = size
+        self.block_frames = block_frames
+        self.frames = []
+        self.frame_count = 0
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.blocks = []
+
+    def update(self, samples):
+        """Reduce numpy array of interleaved samples.
+
+        samples must contain whole frames.
+        """
+        frames = np.abs(samples).reshape(-1, self.channels).max(axis=1)
+        if self.frames is not None:
+            self.frames.append(frames)
+            self.frame_count += len(frames)
+            if self.frame_count < self.size * self.block_frames:
+                return
+            #long enough for blocks to span size
+            frames = np.concatenate(self.frames)
+            self.frames = None
+
+        if len(self.pending):
+            frames = np.concatenate([self.pending, frames])
+        count = len(frames) - (len(frames) % self.block_frames)
+        if count:
+            self.blocks.append(frames[:count].reshape(
+                    -1, self.block_frames).max(axis=1))
+        self.pending = frames[count:]
+
+    def data(self):
+        """Get waveform data.
+
+        Returns:
+            numpy array of max amplitude waveform data of length size
+        """
+        if self.frames is not None:
+            values = list(self.frames)
+        else:
+            values = list(self.blocks)
+            if len(self.pending):
+                values.append(np.array([self.pending.max()]))
+        if not values:
+            return np.zeros(self.size, dtype=np.float64)
+        values = np.concatenate(values)
+
+        indices = np.arange(self.size) * len(values) // self.size
+        if len(values) < self.size:
+            #fewer values than size, each spans several
+            return values[indices].astype(np.float64)
+        return np.maximum.reduceat(values, indices).astype(np.float64)
+
+
 class ArchiveWaveformGeneratorException(Exception):
-    """Archive waveform generator exception."""
-    pass
+    """Archive waveform generator exception.
+
+    Exceptions are permanent if waveform generation will fail
+    again when retried, i.e. due to a corrupt input.
+    """
+    def __init__(self, message, permanent=False):
+        super(ArchiveWaveformGeneratorException, self).__init__(message)
+        self.permanent = permanent
 
 
 class ArchiveWaveformGenerator(object):
@@ -65,7 +149,10 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
     def __init__(self,
             ffmpeg_path,
             storage_pool,
-            working_directory):
+            working_directory,
+            stats_engine=None,
+            governor=None,
+            scratch=None):
         """FFMpegWaveformGenerator constructor.
 
         Args:
@@ -78,6 +165,14 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
                 path will be used to store downloaded
                 archive streams if the specified storage_pool
                 is not accessible on the local filesystem.
+            stats_engine: optional FFMpegAudioStatsEngine object shared
+                with the stitcher. Stats for decoded waveform audio
+                are recorded in its cache.
+            governor: optional ResourceGovernor object used to start
+                ffmpeg processes.
+            scratch: optional ScratchSpace object. If provided, the
+                decoded waveform audio is written to the job's
+                scratch space.
         """
 
         self.ffmpeg_path = ffmpeg_path
@@ -85,6 +180,9 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         self.working_directory = working_directory
         self.filesystem_storage_pool = SimplePool(
                 FileSystemStorage(self.working_directory))
+        self.stats_engine = stats_engine or FFMpegAudioStatsEngine(ffmpeg_path)
+        self.governor = governor or ResourceGovernor()
+        self.scratch = scratch
 
         self.log = logging.getLogger("%s.%s" \
                 % (__name__, self.__class__.__name__))
@@ -112,30 +210,41 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         Raises:
             subprocess.CalledProcessError, StorageException
         """
-        output_path = storage_backend.path(output_filename)
+        if isinstance(storage_backend, ScratchStorage):
+            size = None
+            if archive_stream.length is not None:
+                size = int(archive_stream.length / 1000.0 * WAV_BYTES_PER_SECOND)
+            output_path = storage_backend.scratch_path(output_filename, size)
+        else:
+            output_path = storage_backend.path(output_filename)
         self._ensure_directory(output_path)
         
         if not os.path.exists(output_path):
             self.log.info("Extracting .wav audio from %s" % archive_stream)
 
-            ffmpeg_arguments = [
-                    self.ffmpeg_path,
-                    "-y",
-                    "-i",
-                    storage_backend.path(archive_stream.filename),
-                    "-vn",
-                    "-ar",
-                    "44100",
-                    storage_backend.path(output_filename)
-                    ]
-            
-            self.log.info(ffmpeg_arguments)
+            with atomic_outputs(output_path) as (temp_path,):
+                ffmpeg_arguments = [
+                        self.ffmpeg_path,
+                        "-y",
+                        "-i",
+                        storage_backend.path(archive_stream.filename),
+                        "-vn",
+                        "-ar",
+                        "44100",
+                        temp_path
+                        ]
+                
+                self.log.info(ffmpeg_arguments)
 
-            output = subprocess.check_output(
-                    ffmpeg_arguments,
-                    stderr=subprocess.STDOUT)
+                output = self.governor.check_output(
+                        ffmpeg_arguments,
+                        timeout=self.governor.timeout(archive_stream.length),
+                        stderr=subprocess.STDOUT)
 
             self.log.info(output)
+            if isinstance(storage_backend, ScratchStorage):
+                #may move to disk if larger than estimated
+                storage_backend.commit(output_filename)
 
         return ArchiveStream(
                 filename=output_filename,
@@ -144,7 +253,8 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
                 users=archive_stream.users,
                 offset=archive_stream.offset)
 
-    def _extract_waveform_data(self, storage_backend, archive_stream, size=1800):
+    def _extract_waveform_data(self, storage_backend, archive_stream, size=1800,
+            source_path=None):
         """Extract waveform data from .wav archive stream.
 
         Extracts waveform data from stream as normalized numpy array
@@ -158,6 +268,10 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
             archive_stream: ArchiveStream object containing a .wav stream for
                 which to extract the waveform data.
             size: size of the array to return
+            source_path: optional path of the file the .wav stream was
+                extracted from. Stats of the decoded samples are cached
+                under this path, since the temporary .wav is never
+                looked up by other components.
         Returns:
             numpy array of normalized max amplitude waveform data
         Raises:
@@ -165,8 +279,17 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         """
         self.log.info("Extracting waveform data from %s" % archive_stream)
 
-        sound_file = Sndfile(storage_backend.path(archive_stream.filename), 'r')
+        path = storage_backend.path(archive_stream.filename)
+        sound_file = Sndfile(path, 'r')
         frames = sound_file.read_frames(sound_file.nframes, dtype=np.float64)
+
+        #the samples are already in memory, so record their stats
+        #for the source rather than having the stats engine, shared
+        #with the stitcher, decode the source again.
+        if source_path is not None:
+            self.stats_engine.cache.put(source_path, AudioStats.from_samples(
+                    frames.ravel(), sound_file.samplerate, sound_file.channels))
+
         if sound_file.channels == 2:
             frames = frames[::2]
 
@@ -227,8 +350,7 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         with self.storage_pool.get() as remote_storage:
             with self.filesystem_storage_pool.get() as local_storage:
                 for stream in archive_streams:
-                    with remote_storage.open(stream.filename, "r") as stream_file:
-                        local_storage.save(stream.filename, stream_file)
+                    transfer(remote_storage, local_storage, stream.filename)
 
     def _upload_archive_streams(self, archive_streams):
         """Upload archive streams to storage_pool.
@@ -243,12 +365,51 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         with self.storage_pool.get() as remote_storage:
             with self.filesystem_storage_pool.get() as local_storage:
                 for stream in archive_streams:
-                    with local_storage.open(stream.filename, "r") as stream_file:
-                        remote_storage.save(stream.filename, stream_file)
+                    transfer(local_storage, remote_storage, stream.filename)
+
+    def _render_existing_waveform(self, archive_stream, output_filename):
+        """Render waveform image from archive_stream.waveform.
+
+        Returns:
+            modified ArchiveStream object.
+        Raises:
+            StorageException
+        """
+        waveform_data = np.array(json.loads(archive_stream.waveform))
+        waveform_filename = "%s.png" % output_filename
+
+        with self.storage_pool.get() as storage_backend:
+            try:
+                storage_backend.path(waveform_filename)
+                storage_pool = self.storage_pool
+            except NotImplemented:
+                storage_pool = self.filesystem_storage_pool
+
+        with storage_pool.get() as storage_backend:
+            self._ensure_directory(storage_backend.path(waveform_filename))
+            self._render_waveform_data(
+                    storage_backend=storage_backend,
+                    waveform_data=waveform_data,
+                    output_filename=waveform_filename)
+
+        #if the storage_pool is not accessible on local filesystem
+        #upload the waveform image.
+        if storage_pool is not self.storage_pool:
+            self._upload_archive_streams([ArchiveStream(
+                filename=waveform_filename,
+                type=archive_stream.type,
+                length=None)])
+
+        archive_stream.waveform_filename = waveform_filename
+        return archive_stream
 
     def generate(self, archive_stream, output_filename):
         """Generate waveform data and image for stream.
 
+        If archive_stream already carries waveform data, i.e.
+        computed by a streaming stitcher, only the waveform
+        image is rendered.
+
         Note that waveform generation requires archive streams
         to be available on the local filesystem for stitching.
         If the storage_pool provided is not accessible on
@@ -266,6 +427,10 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
             ArchiveWaveformGeneratorException
         """
         try:
+            if archive_stream.waveform is not None:
+                return self._render_existing_waveform(
+                        archive_stream, output_filename)
+
             #check to see if the archive_stream stored on self.storage_pool
             #are accessible on the local filesystem. Waveform generation requres
             #the archive streams to be accessible on the local filesystem, so if
@@ -280,15 +445,21 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
                     storage_pool = self.filsystem_storage_pool
             
             with storage_pool.get() as storage_backend:
+                if self.scratch is not None:
+                    storage_backend = self.scratch.job(
+                            output_filename).storage(storage_backend)
+
                 #extact .wav audio from stream
                 audio_stream = self._extract_audio_stream(
                         storage_backend=storage_backend,
                         archive_stream=archive_stream,
                         output_filename="%s.wav" % (output_filename))
 
+                source_path = storage_backend.path(archive_stream.filename)
                 waveform_data = self._extract_waveform_data(
                         storage_backend=storage_backend,
-                        archive_stream=audio_stream)
+                        archive_stream=audio_stream,
+                        source_path=source_path)
                 
                 waveform_filename = "%s.png" % output_filename
                 self._render_waveform_data(
@@ -299,6 +470,13 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
                 archive_stream.waveform = json.dumps(waveform_data, cls=Encoder)
                 archive_stream.waveform_filename = waveform_filename
 
+                if archive_stream.length is None:
+                    stats = self.stats_engine.stats(source_path)
+                    archive_stream.length = stats.length * 1000.0
+
+                if self.scratch is not None:
+                    storage_backend.release()
+
             #if the storage_pool is not accessible on local filesystem
             #upload the stitched stream.
             if storage_pool is not self.storage_pool:
@@ -308,6 +486,7 @@ class FFMpegWaveformGenerator(ArchiveWaveformGenerator):
         
         except Exception as error:
             self.log.exception(error)
-            raise ArchiveWaveformGeneratorException(str(error))
+            raise ArchiveWaveformGeneratorException(str(error),
+                    permanent=getattr(error, "permanent", False))
 
         return archive_stream
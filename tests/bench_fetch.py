@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""TwilioFetcher fetch benchmark.
+
+Runs TwilioFetcher against a local FakeTwilioServer at several
+concurrency levels and reports throughput and tail latency.
+
+    $ python bench_fetch.py --chats 32 --duration 600 --latency 0.05
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import Queue
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+from trsvcscore.storage.filesystem import FileSystemStorage
+
+from fakevendor import FakeTwilioServer
+from fetch import TwilioFetcher
+
+ACCOUNT_SID = "AC00000000000000000000000000000000"
+
+def percentile(values, percent):
+    """Get percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def run(server, chats, concurrency, storage_location):
+    """Fetch all chats with the given number of threads.
+
+    Returns:
+        (elapsed seconds, bytes fetched, sorted latencies, errors)
+    """
+    work = Queue.Queue()
+    for chat in chats:
+        work.put(chat)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        fetcher = TwilioFetcher(
+                db_session_factory=None,
+                storage_pool=SimplePool(FileSystemStorage(storage_location)),
+                twilio_account_sid=ACCOUNT_SID,
+                twilio_auth_token="token",
+                twilio_application_sid="AP",
+                twilio_base_url=server.base_url)
+        while True:
+            try:
+                chat_id, chat_session = work.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                fetcher.fetch(chat_id, chat_session, "archive/%s" % chat_id)
+                with lock:
+                    latencies.append(time.time() - start)
+            except Exception as error:
+                with lock:
+                    errors.append(error)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    fetched_bytes = 0
+    for root, directories, filenames in os.walk(storage_location):
+        for filename in filenames:
+            fetched_bytes += os.path.getsize(os.path.join(root, filename))
+
+    return elapsed, fetched_bytes, sorted(latencies), errors
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="TwilioFetcher benchmark")
+    parser.add_argument("--chats", type=int, default=16,
+            help="number of chats to fetch per run")
+    parser.add_argument("--calls", type=int, default=2,
+            help="number of recordings per chat")
+    parser.add_argument("--duration", type=float, default=300,
+            help="recording duration in seconds")
+    parser.add_argument("--latency", type=float, default=0.05,
+            help="fake vendor response latency in seconds")
+    parser.add_argument("--bandwidth", type=int, default=None,
+            help="fake vendor per-connection bandwidth in bytes/second")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+            help="fake vendor error rate (0-1)")
+    parser.add_argument("--concurrency", default="1,2,4,8",
+            help="comma separated list of concurrency levels")
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.ERROR)
+
+    server = FakeTwilioServer(
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            error_rate=args.error_rate,
+            seed=0)
+
+    chats = []
+    for chat_id in range(args.chats):
+        calls = {}
+        for call in range(args.calls):
+            call_sid = "CA%s%s" % (chat_id, call)
+            server.add_recording(call_sid, duration=args.duration)
+            calls[call_sid] = {}
+        chats.append((chat_id, {
+            "twilio_data": {"users": {"%s" % chat_id: {"calls": calls}}}
+        }))
+
+    server.start()
+    try:
+        print("%-12s %10s %10s %10s %10s %10s %8s" % (
+            "concurrency", "chats/s", "MB/s", "p50", "p95", "p99", "errors"))
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            storage_location = tempfile.mkdtemp(dir=WORKING_DIRECTORY)
+            try:
+                elapsed, fetched_bytes, latencies, errors = run(
+                        server, chats, concurrency, storage_location)
+            finally:
+                shutil.rmtree(storage_location)
+
+            print("%-12d %10.2f %10.2f %10.3f %10.3f %10.3f %8d" % (
+                concurrency,
+                len(latencies) / elapsed,
+                fetched_bytes / elapsed / (1024 * 1024),
+                percentile(latencies, 50),
+                percentile(latencies, 95),
+                percentile(latencies, 99),
+                len(errors)))
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
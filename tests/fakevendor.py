@@ -0,0 +1,252 @@
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+#MPEG-1 layer III, 128kbps, 44.1kHz, mono frame header.
+#Frames with zeroed side info and main data decode as silence.
+MP3_FRAME_HEADER = "\xff\xfb\x90\xc4"
+MP3_FRAME_SIZE = 417
+MP3_FRAME_SAMPLES = 1152
+MP3_SAMPLE_RATE = 44100
+
+def synthetic_mp3(duration):
+    """Generate a silent mp3 of roughly duration seconds.
+
+    Args:
+        duration: duration in seconds
+    Returns:
+        mp3 data string
+    """
+    frames = int(duration * MP3_SAMPLE_RATE / MP3_FRAME_SAMPLES) + 1
+    frame = MP3_FRAME_HEADER + "\x00" * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * frames
+
+
+class FakeTwilioRecording(object):
+    """Recording stored by the fake Twilio server."""
+    def __init__(self, sid, call_sid, duration, data):
+        self.sid = sid
+        self.call_sid = call_sid
+        self.duration = duration
+        self.data = data
+
+
+class FakeTwilioRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for FakeTwilioServer.
+
+    Implements the subset of the Twilio 2010-04-01 REST API
+    used by TwilioFetcher: recordings list, recording media
+    and recording delete.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    LIST_RE = re.compile(r"^/2010-04-01/Accounts/(\w+)/Recordings(\.json)?$")
+    INSTANCE_RE = re.compile(r"^/2010-04-01/Accounts/(\w+)/Recordings/(\w+)(\.\w+)?$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body="", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if self.server.vendor.content_length:
+            self.send_header("Content-Length", str(len(body)))
+        else:
+            #body is delimited by closing the connection
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+        bandwidth = self.server.vendor.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+
+        chunk_size = 16 * 1024
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset+chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(float(len(chunk)) / bandwidth)
+
+    def _recording_json(self, account_sid, recording):
+        return {
+            "sid": recording.sid,
+            "account_sid": account_sid,
+            "call_sid": recording.call_sid,
+            "duration": str(recording.duration),
+            "api_version": "2010-04-01",
+            "uri": "/2010-04-01/Accounts/%s/Recordings/%s.json" \
+                    % (account_sid, recording.sid)
+        }
+
+    def _handle(self, method):
+        vendor = self.server.vendor
+        vendor.record_request(method, self.path)
+
+        if vendor.latency:
+            time.sleep(vendor.latency)
+        if vendor.should_fail():
+            self._send(vendor.error_status, json.dumps({
+                "status": vendor.error_status,
+                "message": "injected error"}))
+            return
+
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        match = self.LIST_RE.match(url.path)
+        if match and method == "GET":
+            account_sid = match.group(1)
+            call_sid = query.get("CallSid", [None])[0]
+            recordings = [self._recording_json(account_sid, r) \
+                    for r in vendor.list_recordings(call_sid)]
+            self._send(200, json.dumps({
+                "page": 0,
+                "num_pages": 1,
+                "page_size": 50,
+                "total": len(recordings),
+                "start": 0,
+                "end": max(len(recordings) - 1, 0),
+                "uri": url.path,
+                "first_page_uri": url.path,
+                "last_page_uri": url.path,
+                "next_page_uri": None,
+                "previous_page_uri": None,
+                "recordings": recordings}))
+            return
+
+        match = self.INSTANCE_RE.match(url.path)
+        if match:
+            account_sid, recording_sid, extension = match.groups()
+            recording = vendor.get_recording(recording_sid)
+            if recording is None:
+                self._send(404, json.dumps({"status": 404}))
+            elif method == "DELETE":
+                vendor.delete_recording(recording_sid)
+                self._send(204)
+            elif extension == ".mp3":
+                self._send(200, recording.data, content_type="audio/mpeg")
+            else:
+                self._send(200, json.dumps(
+                    self._recording_json(account_sid, recording)))
+            return
+
+        self._send(404, json.dumps({"status": 404}))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeTwilioServer(object):
+    """Local stand-in for the Twilio REST API.
+
+    Serves synthetic mp3 recordings with configurable latency,
+    bandwidth and error injection, so TwilioFetcher can be
+    exercised and benchmarked without the live vendor.
+    """
+
+    def __init__(self,
+            host="127.0.0.1",
+            port=0,
+            latency=0,
+            bandwidth=None,
+            error_rate=0.0,
+            error_status=500,
+            content_length=True,
+            seed=None):
+        """FakeTwilioServer constructor.
+
+        Args:
+            host: interface to listen on
+            port: port to listen on, 0 to pick a free port
+            latency: seconds to delay every response
+            bandwidth: optional bytes per second to limit
+                response bodies to.
+            error_rate: probability (0-1) that a request fails
+                with error_status.
+            error_status: http status returned for injected errors.
+            content_length: send Content-Length headers if True.
+            seed: optional random seed for error injection.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.content_length = content_length
+        self.random = random.Random(seed)
+        self.recordings = {}
+        self.deleted = []
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.server = ThreadedHTTPServer((host, port), FakeTwilioRequestHandler)
+        self.server.vendor = self
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return "http://%s:%s" % (host, port)
+
+    def add_recording(self, call_sid, duration=10):
+        """Add a synthetic recording for call_sid.
+
+        Returns:
+            recording sid
+        """
+        with self.lock:
+            sid = "RE%032x" % (len(self.recordings) + len(self.deleted) + 1)
+            self.recordings[sid] = FakeTwilioRecording(
+                    sid=sid,
+                    call_sid=call_sid,
+                    duration=duration,
+                    data=synthetic_mp3(duration))
+        return sid
+
+    def list_recordings(self, call_sid=None):
+        with self.lock:
+            return [r for r in self.recordings.values() \
+                    if call_sid is None or r.call_sid == call_sid]
+
+    def get_recording(self, sid):
+        with self.lock:
+            return self.recordings.get(sid)
+
+    def delete_recording(self, sid):
+        with self.lock:
+            if sid in self.recordings:
+                del self.recordings[sid]
+                self.deleted.append(sid)
+
+    def record_request(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+
+    def should_fail(self):
+        with self.lock:
+            return self.error_rate and self.random.random() < self.error_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,45 @@
+import os
+import time
+import unittest
+
+import numpy as np
+
+from testbase import WORKING_DIRECTORY
+
+from audiostats import AudioStats, AudioStatsCache
+
+class AudioStatsTest(unittest.TestCase):
+
+    def test_from_samples(self):
+        samples = np.array([0.5, -0.25, 0.25, -0.5, 0.0, 0.0], dtype=np.float32)
+        stats = AudioStats.from_samples(samples, sample_rate=3, channels=2)
+        self.assertAlmostEqual(stats.length, 1.0)
+        self.assertAlmostEqual(stats.peak, 0.5)
+        self.assertAlmostEqual(stats.volume_adjustment, 2.0)
+        self.assertAlmostEqual(stats.rms, (0.625 / 6) ** 0.5)
+
+        sox_stats = stats.to_dict()
+        self.assertAlmostEqual(sox_stats["Length (seconds)"], 1.0)
+        self.assertAlmostEqual(sox_stats["Volume adjustment"], 2.0)
+
+    def test_cache(self):
+        path = os.path.join(WORKING_DIRECTORY, "output/stats.raw")
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("a")
+
+        cache = AudioStatsCache(size=1)
+        stats = AudioStats.from_samples(np.zeros(4), 4, 1)
+        cache.put(path, stats)
+        self.assertIs(cache.get(path), stats)
+
+        #rewritten file must not return stale stats
+        time.sleep(0.01)
+        with open(path, "w") as f:
+            f.write("ab")
+        self.assertIsNone(cache.get(path))
+        os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import logging
+import os
+import shutil
+import time
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+
+from delete import ArchiveDeleteJournal, ArchiveDeleteSweeper
+
+class FailingFetcher(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.deleted = []
+
+    def delete(self, chat_id, chat_session):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("delete failed")
+        self.deleted.append(chat_id)
+
+class ArchiveDeleteSweeperTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.DEBUG)
+        cls.directory = os.path.join(WORKING_DIRECTORY, "output/deletes")
+
+    def setUp(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        self.journal = ArchiveDeleteJournal(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_journal(self):
+        self.journal.add(1, {"twilio_data": {}})
+        self.journal.add(2, {"twilio_data": {}})
+        records = self.journal.pending()
+        self.assertEqual([r.chat_id for r in records], [1, 2])
+
+        #journal must survive being reopened
+        journal = ArchiveDeleteJournal(self.directory)
+        self.assertEqual(len(journal.pending(limit=1)), 1)
+
+        journal.remove(records[0])
+        self.assertEqual([r.chat_id for r in journal.pending()], [2])
+
+    def test_sweep(self):
+        fetcher = FailingFetcher(failures=1)
+        sweeper = ArchiveDeleteSweeper(
+                fetcher_pool=SimplePool(fetcher),
+                journal=self.journal,
+                batch_size=10,
+                deletes_per_second=0,
+                retry_seconds=60)
+        sweeper.running = True
+
+        self.journal.add(1, {})
+        self.journal.add(2, {})
+        self.assertEqual(sweeper.sweep(), 2)
+        self.assertEqual(fetcher.deleted, [2])
+
+        #failed delete is retried with backoff, not immediately
+        self.assertEqual(self.journal.pending(), [])
+        records = self.journal.pending(now=time.time() + 61)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].attempts, 1)
+
+if __name__ == '__main__':
+    unittest.main()
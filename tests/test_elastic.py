@@ -0,0 +1,83 @@
+import socket
+import threading
+import time
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from elastic import ElasticPool, ElasticPoolException
+
+class CountingFactory(object):
+    def __init__(self):
+        self.count = 0
+
+    def create(self):
+        self.count += 1
+        return self.count
+
+
+class ElasticPoolTest(unittest.TestCase):
+
+    def test_grow(self):
+        factory = CountingFactory()
+        pool = ElasticPool(factory, min_size=1, max_size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual([first, second], [1, 2])
+        self.assertRaises(ElasticPoolException, pool.acquire, 0.01)
+
+        pool.release(second)
+        #most recently released object is reused
+        self.assertEqual(pool.acquire(), second)
+        self.assertEqual(factory.count, 2)
+
+    def test_wait(self):
+        pool = ElasticPool(CountingFactory(), min_size=1, max_size=1)
+        obj = pool.acquire()
+        timer = threading.Timer(0.05, pool.release, [obj, time.time()])
+        timer.start()
+        with pool.get() as result:
+            self.assertEqual(result, obj)
+        timer.join()
+
+        counters = pool.counters("test")
+        self.assertEqual(counters["test_waits"], 1)
+        self.assertTrue(counters["test_max_wait_ms"] >= 40)
+        self.assertEqual(counters["test_in_use"], 0)
+
+    def test_shrink(self):
+        pool = ElasticPool(CountingFactory(), min_size=1, max_size=3,
+                idle_seconds=0)
+        objects = [pool.acquire() for i in range(3)]
+        self.assertEqual(pool.counters()["pool_size"], 3)
+        for obj in objects:
+            pool.release(obj)
+        self.assertEqual(pool.counters()["pool_size"], 1)
+
+    def test_discard(self):
+        factory = CountingFactory()
+        pool = ElasticPool(factory, min_size=1, max_size=1)
+        try:
+            with pool.get():
+                raise socket.error("connection reset")
+        except socket.error:
+            pass
+        with pool.get() as obj:
+            self.assertEqual(obj, 2)
+        self.assertEqual(pool.counters()["pool_discarded"], 1)
+
+    def test_keep(self):
+        factory = CountingFactory()
+        pool = ElasticPool(factory, min_size=1, max_size=1)
+        try:
+            with pool.get():
+                raise KeyError("missing file")
+        except KeyError:
+            pass
+        #application errors leave the client usable
+        with pool.get() as obj:
+            self.assertEqual(obj, 1)
+        self.assertEqual(pool.counters()["pool_discarded"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import logging
+import os
+import shutil
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+from trsvcscore.storage.filesystem import FileSystemStorage
+
+from fakevendor import FakeTwilioServer, synthetic_mp3
+from fetch import TwilioFetcher, ArchiveFetcherException
+
+ACCOUNT_SID = "AC00000000000000000000000000000000"
+
+class TwilioFetcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.DEBUG)
+        cls.storage_location = os.path.join(WORKING_DIRECTORY, "output/fetch")
+
+    def setUp(self):
+        if os.path.exists(self.storage_location):
+            shutil.rmtree(self.storage_location)
+        self.server = FakeTwilioServer(seed=0)
+        self.server.start()
+
+        self.fetcher = TwilioFetcher(
+                db_session_factory=None,
+                storage_pool=SimplePool(FileSystemStorage(self.storage_location)),
+                twilio_account_sid=ACCOUNT_SID,
+                twilio_auth_token="token",
+                twilio_application_sid="AP",
+                twilio_base_url=self.server.base_url)
+
+        self.chat_session = {
+            "twilio_data": {
+                "users": {
+                    "11": {"calls": {"CA1": {}}},
+                    "12": {"calls": {"CA2": {}}}
+                }
+            }
+        }
+        self.server.add_recording("CA1", duration=5)
+        self.server.add_recording("CA2", duration=7)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.storage_location)
+
+    def test_fetch(self):
+        manifest = self.fetcher.fetch(1, self.chat_session, "archive/chat")
+        self.assertEqual(len(manifest.archive_streams), 2)
+
+        expected_sizes = {
+            "archive/chat-CA1.mp3": len(synthetic_mp3(5)),
+            "archive/chat-CA2.mp3": len(synthetic_mp3(7))
+        }
+        for stream in manifest.archive_streams:
+            path = os.path.join(self.storage_location, stream.filename)
+            self.assertEqual(os.path.getsize(path), expected_sizes[stream.filename])
+
+    def test_prefetch(self):
+        downloaded = self.fetcher.prefetch(1, self.chat_session)
+        self.assertEqual(downloaded, self.fetcher.prefetched_bytes())
+
+        media_requests = len(self.server.requests)
+        self.fetcher.fetch(1, self.chat_session, "archive/chat")
+        self.assertEqual(len(self.server.requests), media_requests)
+        self.assertEqual(self.fetcher.prefetched_bytes(), 0)
+
+    def test_prefetch_max_bytes(self):
+        #recordings without a Content-Length are limited as streamed
+        self.server.content_length = False
+        max_bytes = len(synthetic_mp3(5)) + 1
+        downloaded = self.fetcher.prefetch(1, self.chat_session,
+                max_bytes=max_bytes)
+        self.assertEqual(downloaded, len(synthetic_mp3(5)))
+        self.assertEqual(self.fetcher.prefetched_bytes(), downloaded)
+
+        prefetch_directory = os.path.join(self.storage_location,
+                os.path.dirname(self.fetcher._prefetch_filename("CA2")))
+        self.assertFalse([name for name in os.listdir(prefetch_directory)
+            if name.endswith(".part")])
+
+    def test_delete(self):
+        self.fetcher.delete(1, self.chat_session)
+        self.assertEqual(len(self.server.deleted), 2)
+        self.assertEqual(self.server.list_recordings(), [])
+
+    def test_fetch_error(self):
+        self.server.error_rate = 1.0
+        self.assertRaises(ArchiveFetcherException,
+                self.fetcher.fetch, 1, self.chat_session, "archive/chat")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from governor import ResourceGovernor, ResourceAccount, PermanentProcessError, \
+        TransientProcessError, accounting, bind_account
+
+class ResourceGovernorTest(unittest.TestCase):
+
+    def test_passthrough(self):
+        governor = ResourceGovernor()
+        allocation = governor.allocate()
+        arguments = ["/opt/3ps/bin/ffmpeg", "-i", "in.wav", "out.mp3"]
+        self.assertEqual(governor.arguments(arguments, allocation), arguments)
+
+    def test_budget(self):
+        governor = ResourceGovernor(cores=4, max_threads=3)
+        first = governor.allocate()
+        second = governor.allocate()
+        third = governor.allocate()
+        self.assertEqual(first.threads, 3)
+        self.assertEqual(second.threads, 1)
+        #budget exhausted, processes still start single threaded
+        self.assertEqual(third.threads, 1)
+
+        for allocation in [first, second, third]:
+            governor.release(allocation)
+        self.assertEqual(governor.allocated, 0)
+
+    def test_arguments(self):
+        governor = ResourceGovernor(cores=2, max_threads=1, affinity=True)
+        first = governor.allocate()
+        second = governor.allocate()
+        self.assertEqual(governor.arguments(["ffmpeg", "-i", "in.wav", "out.mp3"], first),
+                ["taskset", "-c", "0", "ffmpeg", "-i", "in.wav", "-threads", "1", "out.mp3"])
+        self.assertEqual(governor.arguments(["/usr/bin/sox", "in.wav"], second),
+                ["taskset", "-c", "1", "/usr/bin/sox", "--single-threaded", "in.wav"])
+
+    def test_output_threads(self):
+        governor = ResourceGovernor(cores=4, max_threads=2)
+        allocation = governor.allocate()
+        arguments = ["ffmpeg", "-y", "-f", "f32le", "-i", "-", "-vn",
+                "-acodec", "aac", "out.mp4", "out.mp3"]
+        self.assertEqual(governor.arguments(arguments, allocation),
+                ["ffmpeg", "-y", "-f", "f32le", "-i", "-", "-vn",
+                    "-acodec", "aac", "-threads", "2", "out.mp4",
+                    "-threads", "2", "out.mp3"])
+        self.assertEqual(governor.arguments(
+            ["ffmpeg", "-i", "in.mp4", "-f", "sox", "-"], allocation),
+            ["ffmpeg", "-i", "in.mp4", "-f", "sox", "-threads", "2", "-"])
+
+    def test_pipe_arguments(self):
+        arguments = ["ffmpeg", "-i", "in.mp4", "-f", "sox", "-"]
+        self.assertEqual(ResourceGovernor().pipe_arguments(arguments), arguments)
+
+        governor = ResourceGovernor(cores=4, affinity=True)
+        self.assertEqual(governor.pipe_arguments(arguments),
+                ["ffmpeg", "-i", "in.mp4", "-f", "sox", "-threads", "1", "-"])
+        self.assertEqual(governor.pipe_arguments(["sox", "in.wav", "-p"]),
+                ["sox", "--single-threaded", "in.wav", "-p"])
+        self.assertEqual(governor.allocated, 0)
+
+    def test_release_on_exit(self):
+        governor = ResourceGovernor(cores=2, nice=1)
+        output = governor.check_output([sys.executable, "-c", "print('ok')"])
+        self.assertEqual(output.strip(), b"ok")
+        self.assertEqual(governor.allocated, 0)
+
+    def test_timeout(self):
+        governor = ResourceGovernor(timeout=60, timeout_factor=2.0)
+        self.assertEqual(governor.timeout(), 60)
+        self.assertEqual(governor.timeout(10 * 1000), 60)
+        self.assertEqual(governor.timeout(3600 * 1000), 7200)
+
+        #child and grandchild are killed as a process group
+        arguments = [sys.executable, "-c",
+                "import subprocess, sys, time; "
+                "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']); "
+                "time.sleep(30)"]
+        try:
+            governor.check_output(arguments, timeout=0.5)
+            self.fail("expected TransientProcessError")
+        except TransientProcessError as error:
+            self.assertFalse(error.permanent)
+        self.assertEqual(governor.counters()["governor_timeouts"], 1)
+        self.assertEqual(governor.counters()["governor_processes"], 0)
+
+    def test_permanent_error(self):
+        governor = ResourceGovernor()
+        arguments = [sys.executable, "-c", "import sys; "
+                "sys.stderr.write('in.mp4: Invalid data found when processing input'); "
+                "sys.exit(1)"]
+        try:
+            governor.check_output(arguments, stderr=subprocess.STDOUT)
+            self.fail("expected PermanentProcessError")
+        except PermanentProcessError as error:
+            self.assertTrue(error.permanent)
+            self.assertEqual(error.returncode, 1)
+
+    def test_transient_error(self):
+        governor = ResourceGovernor()
+        arguments = [sys.executable, "-c", "import sys; "
+                "sys.stderr.write('No space left on device'); sys.exit(1)"]
+        try:
+            governor.check_output(arguments, stderr=subprocess.STDOUT)
+            self.fail("expected TransientProcessError")
+        except TransientProcessError as error:
+            self.assertFalse(error.permanent)
+            self.assertEqual(error.returncode, 1)
+
+    def test_record_pipe(self):
+        governor = ResourceGovernor()
+        with accounting(ResourceAccount()) as account:
+            governor.record_pipe(read_bytes=10, write_bytes=4)
+            governor.record_pipe(read_bytes=5)
+        governor.record_pipe(read_bytes=1)
+        self.assertEqual(account.to_dict()["pipe_read_bytes"], 15)
+        self.assertEqual(account.to_dict()["pipe_write_bytes"], 4)
+        self.assertEqual(governor.counters()["governor_pipe_read_bytes"], 16)
+
+    def test_cancel(self):
+        governor = ResourceGovernor()
+        process = governor.popen([sys.executable, "-c",
+                "import time; time.sleep(30)"])
+        governor.cancel()
+        process.wait()
+        self.assertRaises(TransientProcessError,
+                governor.check_process, process, [sys.executable])
+        #no new processes are started once cancelled
+        self.assertRaises(TransientProcessError,
+                governor.popen, [sys.executable, "-c", "pass"])
+
+    def test_cancel_account(self):
+        governor = ResourceGovernor()
+        arguments = [sys.executable, "-c", "import time; time.sleep(30)"]
+        with accounting(ResourceAccount()) as account:
+            process = governor.popen(arguments)
+        with accounting(ResourceAccount()) as other_account:
+            other_process = governor.popen(arguments)
+
+        governor.cancel(account)
+        process.wait()
+        self.assertRaises(TransientProcessError,
+                governor.check_process, process, [sys.executable])
+        #other jobs' processes keep running
+        self.assertIsNone(other_process.poll())
+        other_process.kill()
+        other_process.wait()
+
+        #the cancelled job can't start new processes, others can
+        with accounting(account):
+            self.assertRaises(TransientProcessError,
+                    governor.popen, [sys.executable, "-c", "pass"])
+        with accounting(other_account):
+            governor.check_output([sys.executable, "-c", "pass"])
+        governor.check_output([sys.executable, "-c", "pass"])
+        self.assertEqual(governor.counters()["governor_cancellations"], 1)
+
+    def test_accounting(self):
+        governor = ResourceGovernor()
+        arguments = [sys.executable, "-c",
+                "sum(range(10 ** 6))"]
+        with accounting(ResourceAccount()) as account:
+            governor.check_output(arguments)
+            #processes started from other threads are recorded once bound
+            thread = threading.Thread(
+                    target=bind_account(governor.check_output), args=(arguments,))
+            thread.start()
+            thread.join()
+        governor.check_output(arguments)
+
+        self.assertEqual(account.processes, 2)
+        self.assertEqual(len(account.usages), 2)
+        usage = account.usages[0]
+        self.assertEqual(usage.command, os.path.basename(sys.executable))
+        self.assertEqual(usage.returncode, 0)
+        self.assertTrue(usage.user_time + usage.system_time > 0)
+        self.assertTrue(usage.max_rss > 0)
+        self.assertTrue(usage.wall_time >= usage.user_time)
+
+        counters = governor.counters()
+        self.assertEqual(counters["governor_completed_processes"], 3)
+        self.assertEqual(counters["governor_failed_processes"], 0)
+        self.assertTrue(counters["governor_max_rss_kb"] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from layout import ArchiveLayout
+
+class ArchiveLayoutTest(unittest.TestCase):
+
+    def test_flat(self):
+        layout = ArchiveLayout()
+        self.assertEqual(layout.filename("abc"), "archive/abc")
+        self.assertEqual(layout.relocate("archive/abc-CA1.mp3"),
+                "archive/abc-CA1.mp3")
+
+    def test_sharded(self):
+        layout = ArchiveLayout(depth=2, width=2)
+        filename = layout.filename("abc")
+        #md5("abc") = 900150983cd24fb0d6963f7d28e17f72
+        self.assertEqual(filename, "archive/90/01/abc")
+        self.assertEqual(layout.key("%s-1380000000.0-CA1.mp3" % filename), "abc")
+
+    def test_relocate(self):
+        layout = ArchiveLayout(depth=2, width=2)
+        relocated = layout.relocate("archive/abc-1380000000.0.mp3")
+        self.assertEqual(relocated, "archive/90/01/abc-1380000000.0.mp3")
+        self.assertEqual(layout.relocate(relocated), relocated)
+        self.assertEqual(ArchiveLayout().relocate(relocated),
+                "archive/abc-1380000000.0.mp3")
+        self.assertTrue(layout.contains(relocated))
+        self.assertFalse(layout.contains("prefetch/CA1.mp3"))
+
+if __name__ == '__main__':
+    unittest.main()
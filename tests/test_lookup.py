@@ -0,0 +1,107 @@
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from lookup import LookupCache, LookupCacheException
+
+class FakeModel(object):
+    def __init__(self, id, **kwargs):
+        self.id = id
+        self.__dict__.update(kwargs)
+
+
+class FakeQuery(object):
+    def __init__(self, session, rows):
+        self.session = session
+        self.rows = rows
+        self.filters = {}
+
+    def filter_by(self, **kwargs):
+        self.filters = kwargs
+        return self
+
+    def first(self):
+        self.session.queries += 1
+        return self.rows.get(tuple(self.filters.items())[0])
+
+    def all(self):
+        self.session.queries += 1
+        return list(self.rows.values())
+
+
+class FakeSession(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def query(self, model_class):
+        return FakeQuery(self, self.rows.get(model_class.__name__, {}))
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LookupCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession({
+            "ChatArchiveType": {("name", "STITCHED_AUDIO_STREAM"):
+                FakeModel(1, name="STITCHED_AUDIO_STREAM")},
+            "MimeType": {("extension", ".mp3"):
+                FakeModel(7, extension=".mp3")}
+        })
+
+    def test_cache(self):
+        cache = LookupCache()
+        for i in range(3):
+            self.assertEqual(cache.chat_archive_type_id(
+                self.session, "STITCHED_AUDIO_STREAM"), 1)
+            self.assertEqual(cache.mime_type_id(self.session, ".mp3"), 7)
+        self.assertEqual(self.session.queries, 2)
+        self.assertEqual(cache.counters()["lookup_cache_hits"], 4)
+
+    def test_missing(self):
+        cache = LookupCache()
+        self.assertRaises(LookupCacheException,
+                cache.mime_type_id, self.session, ".ogg")
+
+    def test_preload(self):
+        cache = LookupCache()
+        cache.load(lambda: self.session)
+        self.assertEqual(self.session.queries, 2)
+        self.assertEqual(cache.mime_type_id(self.session, ".mp3"), 7)
+        self.assertEqual(self.session.queries, 2)
+
+    def test_ttl(self):
+        reload_session = FakeSession(self.session.rows)
+        cache = LookupCache(ttl_seconds=0,
+                db_session_factory=lambda: reload_session)
+        cache.preload(self.session)
+        cache.loaded -= 1
+        self.session.rows["MimeType"][("extension", ".mp3")].id = 8
+        self.assertEqual(cache.mime_type_id(self.session, ".mp3"), 8)
+        self.assertEqual(cache.counters()["lookup_cache_loads"], 2)
+
+        #reloads use their own session, not the caller's
+        self.assertEqual(self.session.queries, 2)
+        self.assertEqual(reload_session.queries, 2)
+
+    def test_failed_reload(self):
+        def db_session_factory():
+            raise RuntimeError("database unavailable")
+        cache = LookupCache(ttl_seconds=0,
+                db_session_factory=db_session_factory)
+        cache.preload(self.session)
+        cache.loaded -= 1
+        #stale ids are still served, the caller's session is unaffected
+        self.assertEqual(cache.mime_type_id(self.session, ".mp3"), 7)
+        self.assertEqual(self.session.queries, 2)
+
+if __name__ == '__main__':
+    unittest.main()
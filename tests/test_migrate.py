@@ -0,0 +1,192 @@
+import os
+import shutil
+import unittest
+from io import BytesIO
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+from trsvcscore.storage.filesystem import FileSystemStorage
+
+from layout import ArchiveLayout
+from migrate import LayoutMigrator, LayoutMigratorException
+
+class FakeArchive(object):
+    def __init__(self, id, path, waveform_path=None):
+        self.id = id
+        self.path = path
+        self.waveform_path = waveform_path
+
+
+class FakeQuery(object):
+    def __init__(self, session):
+        self.session = session
+
+    def filter(self, *args):
+        return self
+
+    def order_by(self, *args):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def all(self):
+        self.session.queries += 1
+        if self.session.queries > 1:
+            return []
+        return self.session.archives
+
+
+class FakeSession(object):
+    def __init__(self, archives, events):
+        self.archives = archives
+        self.events = events
+        self.queries = 0
+        self.committed = {}
+
+    def query(self, model_class):
+        return FakeQuery(self)
+
+    def commit(self):
+        for archive in self.archives:
+            self.committed[archive.id] = (archive.path, archive.waveform_path)
+        self.events.append("commit")
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeStorage(object):
+    """Remote storage recording operations."""
+    def __init__(self, files, events, manifests=None):
+        self.files = files
+        self.events = events
+        self.manifests = manifests if manifests is not None else {}
+
+    def exists(self, filename):
+        return filename in self.files
+
+    def open(self, filename, mode):
+        return BytesIO(self.files[filename])
+
+    def save(self, filename, file):
+        self.files[filename] = file.read()
+        self.events.append(("save", filename))
+
+    def delete(self, filename):
+        del self.files[filename]
+        self.manifests.pop(filename, None)
+        self.events.append(("delete", filename))
+
+    def segments(self, filename):
+        if filename not in self.manifests:
+            return None
+        return sorted([name for name in self.files
+            if name.startswith("%s/" % filename)])
+
+    def save_manifest(self, filename, segment_names):
+        self.files[filename] = b""
+        self.manifests[filename] = segment_names
+        self.events.append(("save_manifest", filename))
+
+
+class LayoutMigratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "migrate")
+        os.makedirs(os.path.join(self.directory, "archive"))
+        self.local_storage = FileSystemStorage(self.directory)
+        self.layout = ArchiveLayout(depth=2, width=2)
+        self.events = []
+
+        self.filename = "archive/abc-CA1.mp3"
+        self.new_filename = self.layout.relocate(self.filename)
+        with open(self.local_storage.path(self.filename), "wb") as f:
+            f.write(b"mp3")
+        os.chmod(self.local_storage.path(self.filename), 0o644)
+        self.remote_files = {self.filename: b"mp3"}
+        self.remote_manifests = {}
+        self.session = FakeSession(
+                [FakeArchive(1, self.filename)], self.events)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _migrator(self, **kwargs):
+        return LayoutMigrator(
+                db_session_factory=lambda: self.session,
+                layout=self.layout,
+                local_storage_pool=SimplePool(self.local_storage),
+                remote_storage_pools=[SimplePool(FakeStorage(
+                    self.remote_files, self.events, self.remote_manifests))],
+                threads=2,
+                **kwargs)
+
+    def test_migrate(self):
+        inode = os.stat(self.local_storage.path(self.filename)).st_ino
+        migrator = self._migrator()
+        migrator.migrate()
+
+        #originals are deleted only after the batch is committed
+        self.assertEqual(self.events, [("save", self.new_filename),
+            "commit", ("delete", self.filename)])
+        self.assertEqual(self.session.committed[1], (self.new_filename, None))
+        self.assertEqual(self.remote_files, {self.new_filename: b"mp3"})
+        self.assertFalse(os.path.exists(self.local_storage.path(self.filename)))
+        with open(self.local_storage.path(self.new_filename), "rb") as f:
+            self.assertEqual(f.read(), b"mp3")
+        self.assertEqual(migrator.moved, 1)
+        self.assertEqual(migrator.failed, 0)
+
+        #local files are linked, not copied
+        stat = os.stat(self.local_storage.path(self.new_filename))
+        self.assertEqual(stat.st_ino, inode)
+        self.assertEqual(stat.st_mode & 0o777, 0o644)
+
+    def test_migrate_manifest(self):
+        segments = ["%s/%08d" % (self.filename, index) for index in range(2)]
+        self.remote_files.update({self.filename: b"",
+            segments[0]: b"mp", segments[1]: b"3"})
+        self.remote_manifests[self.filename] = segments
+
+        self._migrator().migrate()
+
+        #segments are copied and a new manifest saved, originals
+        #are deleted after the batch is committed.
+        new_segments = ["%s/%08d" % (self.new_filename, index)
+                for index in range(2)]
+        self.assertEqual(self.events,
+                [("save", new_segments[0]), ("save", new_segments[1]),
+                    ("save_manifest", self.new_filename), "commit",
+                    ("delete", self.filename),
+                    ("delete", segments[0]), ("delete", segments[1])])
+        self.assertEqual(self.remote_manifests,
+                {self.new_filename: new_segments})
+        self.assertEqual(sorted(self.remote_files),
+                [self.new_filename] + new_segments)
+
+    def test_failed_commit(self):
+        def commit():
+            raise RuntimeError("commit failed")
+        self.session.commit = commit
+
+        migrator = self._migrator()
+        self.assertRaises(LayoutMigratorException, migrator.migrate)
+
+        #originals referenced by the uncommitted model are kept
+        self.assertEqual(self.remote_files[self.filename], b"mp3")
+        self.assertTrue(os.path.exists(self.local_storage.path(self.filename)))
+        self.assertNotIn(("delete", self.filename), self.events)
+
+    def test_dry_run(self):
+        migrator = self._migrator(dry_run=True)
+        migrator.migrate()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.remote_files, {self.filename: b"mp3"})
+        self.assertTrue(os.path.exists(self.local_storage.path(self.filename)))
+
+if __name__ == '__main__':
+    unittest.main()
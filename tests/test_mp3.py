@@ -0,0 +1,112 @@
+import os
+import shutil
+import struct
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+import mp3
+
+def frame(bitrate_index=9, padding=0, channel_mode=3, size=None, body=b""):
+    """Build an MPEG-1 layer 3 44.1kHz frame."""
+    header = 0xFFFB0000 | (bitrate_index << 12) | (padding << 9) \
+            | (channel_mode << 6)
+    data = struct.pack(">I", header) + body
+    header = mp3.parse_frame_header(data)
+    return data + b"\x00" * (header.size - len(data))
+
+def id3v2(size):
+    """Build an ID3v2 tag with size bytes of tag data."""
+    syncsafe = bytearray([(size >> shift) & 0x7F for shift in (21, 14, 7, 0)])
+    return b"ID3\x03\x00\x00" + bytes(syncsafe) + b"\x00" * size
+
+
+class MP3Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = os.path.join(WORKING_DIRECTORY, "output", "mp3")
+
+    def setUp(self):
+        os.makedirs(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, filename, data):
+        path = os.path.join(self.directory, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_parse_frame_header(self):
+        header = mp3.parse_frame_header(frame(bitrate_index=9, padding=1))
+        self.assertEqual(header.version, 1)
+        self.assertEqual(header.layer, 3)
+        self.assertEqual(header.bitrate, 128)
+        self.assertEqual(header.sample_rate, 44100)
+        self.assertEqual(header.channels, 1)
+        self.assertEqual(header.samples, 1152)
+        self.assertEqual(header.size, 418)
+
+        #MPEG-2 layer 3, 22.05kHz, 64kbps, stereo
+        header = mp3.parse_frame_header(struct.pack(">I", 0xFFF38000))
+        self.assertEqual(header.version, 2)
+        self.assertEqual(header.sample_rate, 22050)
+        self.assertEqual(header.bitrate, 64)
+        self.assertEqual(header.channels, 2)
+        self.assertEqual(header.samples, 576)
+        self.assertEqual(header.size, 208)
+
+        #offset into data
+        header = mp3.parse_frame_header(b"\x00\x00" + frame(), 2)
+        self.assertEqual(header.bitrate, 128)
+
+    def test_invalid_frame_header(self):
+        self.assertIsNone(mp3.parse_frame_header(b"\xff\xfb"))
+        self.assertIsNone(mp3.parse_frame_header(b"ID3\x03"))
+        #free format and invalid bitrate index
+        self.assertIsNone(mp3.parse_frame_header(struct.pack(">I", 0xFFFB0000)))
+        self.assertIsNone(mp3.parse_frame_header(struct.pack(">I", 0xFFFBF000)))
+        #reserved sample rate and version
+        self.assertIsNone(mp3.parse_frame_header(struct.pack(">I", 0xFFFB9C00)))
+        self.assertIsNone(mp3.parse_frame_header(struct.pack(">I", 0xFFEB9000)))
+
+    def test_skip_id3v2(self):
+        self.assertEqual(mp3.skip_id3v2(id3v2(200) + frame()), 210)
+        self.assertEqual(mp3.skip_id3v2(id3v2(300)), 310)
+        self.assertEqual(mp3.skip_id3v2(frame()), 0)
+        self.assertEqual(mp3.skip_id3v2(b"ID3"), 0)
+
+    def test_cbr(self):
+        path = self._write("cbr.mp3", id3v2(100) + frame() * 40)
+        header = mp3.is_cbr(path)
+        self.assertEqual(header.bitrate, 128)
+        self.assertEqual(header.sample_rate, 44100)
+
+        #tag larger than the first read
+        path = self._write("tagged.mp3", id3v2(100 * 1024) + frame() * 4)
+        self.assertEqual(mp3.is_cbr(path).bitrate, 128)
+
+    def test_vbr(self):
+        path = self._write("vbr.mp3",
+                frame(9) * 4 + frame(11) + frame(9) * 4)
+        self.assertIsNone(mp3.is_cbr(path))
+
+    def test_xing(self):
+        #Xing header in the first frame marks a VBR file, even if
+        #the following frames share a bitrate.
+        xing = frame(body=b"\x00" * 17 + b"Xing\x00\x00\x00\x0f")
+        path = self._write("xing.mp3", xing + frame() * 8)
+        self.assertIsNone(mp3.is_cbr(path))
+
+        path = self._write("vbri.mp3", frame(body=b"\x00" * 32 + b"VBRI")
+                + frame() * 8)
+        self.assertIsNone(mp3.is_cbr(path))
+
+    def test_not_mp3(self):
+        path = self._write("not.mp3", b"RIFF" + b"\x00" * 1000)
+        self.assertIsNone(mp3.is_cbr(path))
+
+if __name__ == '__main__':
+    unittest.main()
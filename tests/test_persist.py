@@ -0,0 +1,205 @@
+import hashlib
+import os
+import shutil
+import threading
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+from trsvcscore.storage.exception import NotImplemented
+
+from persist import ArchivePersisterException, ContainerIndex, \
+        DefaultPersister
+from stream import ArchiveStream, ArchiveStreamType
+
+class LocalStorage(object):
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+
+class ManifestStorage(object):
+    def __init__(self, existing=None):
+        self.files = dict(existing or {})
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        raise NotImplemented()
+
+    def exists(self, name):
+        return name in self.files or name in self.manifests
+
+    def save(self, name, file):
+        data = file.read()
+        with self.lock:
+            self.files[name] = data
+
+    def save_manifest(self, name, segment_names):
+        self.manifests[name] = segment_names
+
+    def read(self, name):
+        if name in self.manifests:
+            return b"".join([self.files[s] for s in self.manifests[name]])
+        return self.files[name]
+
+
+class ListingStorage(ManifestStorage):
+    def __init__(self, existing=None):
+        super(ListingStorage, self).__init__(existing)
+        self.requests = []
+
+    def exists(self, name):
+        self.requests.append(("exists", name))
+        return super(ListingStorage, self).exists(name)
+
+    def list_prefix(self, prefix):
+        self.requests.append(("list_prefix", prefix))
+        return [n for n in list(self.files) + list(self.manifests)
+                if n.startswith(prefix)]
+
+
+class EtagStorage(ListingStorage):
+    def __init__(self, existing=None, corrupt=False):
+        super(EtagStorage, self).__init__(existing)
+        self.corrupt = corrupt
+
+    def save(self, name, file):
+        super(EtagStorage, self).save(name, file)
+        self.requests.append(("save", name))
+        if self.corrupt:
+            self.files[name] = self.files[name][:-1]
+
+    def etag(self, name):
+        return '"%s"' % hashlib.md5(self.files[name]).hexdigest()
+
+
+class DefaultPersisterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "persist")
+        self.local_storage = LocalStorage(self.directory)
+        self.data = {
+            "archive/test.mp3": os.urandom(1000),
+            "archive/test.png": os.urandom(100),
+            "archive/test.mp4": os.urandom(2500)
+        }
+        os.makedirs(os.path.join(self.directory, "archive"))
+        for filename, data in self.data.items():
+            with open(self.local_storage.path(filename), "wb") as f:
+                f.write(data)
+
+        stitched_stream = ArchiveStream(
+                filename="archive/test.mp3",
+                type=ArchiveStreamType.STITCHED_AUDIO_STREAM,
+                length=1000)
+        stitched_stream.waveform_filename = "archive/test.png"
+        video_stream = ArchiveStream(
+                filename="archive/test.mp4",
+                type=ArchiveStreamType.USERS_VIDEO_STREAM,
+                length=1000)
+        self.archive_streams = [stitched_stream, video_stream]
+
+    def tearDown(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    def _persister(self, public_storage, private_storage, segment_bytes,
+            container_index=None):
+        return DefaultPersister(
+                db_session_factory=None,
+                local_storage_pool=SimplePool(self.local_storage),
+                public_storage_pool=public_storage,
+                private_storage_pool=private_storage,
+                upload_threads=4,
+                segment_bytes=segment_bytes,
+                container_index=container_index)
+
+    def test_upload(self):
+        public_storage = ManifestStorage({"archive/test.png": b"existing"})
+        private_storage = ManifestStorage()
+        persister = self._persister(SimplePool(public_storage),
+                SimplePool(private_storage), 1024)
+        persister._upload_archive_streams(self.archive_streams)
+
+        #existing files are not uploaded again
+        self.assertEqual(public_storage.read("archive/test.png"), b"existing")
+        self.assertEqual(public_storage.read("archive/test.mp3"),
+                self.data["archive/test.mp3"])
+        self.assertEqual(public_storage.manifests, {})
+
+        #large files are uploaded in segments
+        self.assertEqual(private_storage.manifests["archive/test.mp4"],
+                ["archive/test.mp4/%08d" % i for i in range(3)])
+        self.assertEqual(private_storage.read("archive/test.mp4"),
+                self.data["archive/test.mp4"])
+
+    def test_upload_unsegmented(self):
+        public_storage = ManifestStorage()
+        private_storage = ManifestStorage()
+        persister = self._persister(SimplePool(public_storage),
+                SimplePool(private_storage), None)
+        persister._upload_archive_streams(self.archive_streams)
+
+        self.assertEqual(private_storage.manifests, {})
+        for filename in ["archive/test.mp3", "archive/test.png"]:
+            self.assertEqual(public_storage.read(filename), self.data[filename])
+        self.assertEqual(private_storage.read("archive/test.mp4"),
+                self.data["archive/test.mp4"])
+
+    def test_container_index(self):
+        public_storage = ListingStorage({"archive/test.png": b"existing"})
+        private_storage = ListingStorage()
+        public_storage_pool = SimplePool(public_storage)
+        private_storage_pool = SimplePool(private_storage)
+        container_index = ContainerIndex(ttl_seconds=60)
+        persister = self._persister(public_storage_pool, private_storage_pool,
+                None, container_index)
+        persister._upload_archive_streams(self.archive_streams)
+
+        #one listing of the job's prefix per container answers all
+        #existence checks
+        self.assertEqual(public_storage.requests,
+                [("list_prefix", "archive/test.")])
+        self.assertEqual(private_storage.requests,
+                [("list_prefix", "archive/test.")])
+        self.assertEqual(public_storage.read("archive/test.png"), b"existing")
+
+        #uploaded files are added to the shared index
+        persister = self._persister(public_storage_pool, private_storage_pool,
+                None, container_index)
+        persister._upload_archive_streams(self.archive_streams)
+        self.assertEqual(len(public_storage.requests), 1)
+        self.assertEqual(container_index.counters()["container_index_hits"], 4)
+
+    def test_etag(self):
+        data = self.data["archive/test.mp3"]
+        public_storage = EtagStorage({
+            "archive/test.mp3": data[:500],
+            "archive/test.png": self.data["archive/test.png"]
+        })
+        private_storage = EtagStorage()
+        persister = self._persister(SimplePool(public_storage),
+                SimplePool(private_storage), 1024)
+        persister._upload_archive_streams(self.archive_streams)
+
+        #truncated upload is replaced, matching upload is kept
+        self.assertIn(("save", "archive/test.mp3"), public_storage.requests)
+        self.assertNotIn(("save", "archive/test.png"), public_storage.requests)
+        self.assertEqual(public_storage.read("archive/test.mp3"), data)
+        self.assertEqual(self.archive_streams[0].content_hash,
+                hashlib.md5(data).hexdigest())
+
+    def test_integrity(self):
+        public_storage = EtagStorage()
+        private_storage = EtagStorage(corrupt=True)
+        persister = self._persister(SimplePool(public_storage),
+                SimplePool(private_storage), 1024)
+        self.assertRaises(ArchivePersisterException,
+                persister._upload_archive_streams, self.archive_streams)
+        self.assertEqual(private_storage.manifests, {})
+
+if __name__ == '__main__':
+    unittest.main()
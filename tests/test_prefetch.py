@@ -0,0 +1,105 @@
+import json
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+
+from prefetch import ArchivePrefetcher
+
+class FakeJob(object):
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.data = json.dumps({"chat_id": chat_id})
+
+
+class FakeQuery(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.count = None
+
+    def filter(self, *criteria):
+        return self
+
+    def order_by(self, *criteria):
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def all(self):
+        return self.jobs[:self.count]
+
+
+class FakeSession(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.closed = False
+
+    def query(self, model_class):
+        return FakeQuery(self.jobs)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeFetcher(object):
+    def __init__(self, used_bytes=0, failures=()):
+        self.used_bytes = used_bytes
+        self.failures = failures
+        self.prefetched = []
+
+    def prefetched_bytes(self, expire_seconds=None):
+        return self.used_bytes
+
+    def prefetch(self, chat_id, chat_session, max_bytes=None):
+        if chat_id in self.failures:
+            raise RuntimeError("download failed")
+        self.prefetched.append((chat_id, chat_session["chat_id"], max_bytes))
+        return 400
+
+
+class ArchivePrefetcherTest(unittest.TestCase):
+
+    def _prefetcher(self, fetcher, jobs, **kwargs):
+        prefetcher = ArchivePrefetcher(
+                db_session_factory=lambda: FakeSession(jobs),
+                fetcher_pool=SimplePool(fetcher),
+                **kwargs)
+        prefetcher.running = True
+        return prefetcher
+
+    def test_prefetch(self):
+        fetcher = FakeFetcher(failures=[2])
+        jobs = [FakeJob(chat_id) for chat_id in range(1, 6)]
+        prefetcher = self._prefetcher(fetcher, jobs, lookahead=3,
+                max_bytes=1000)
+
+        #failed prefetch is skipped, lookahead limits jobs
+        self.assertEqual(prefetcher.prefetch(), 800)
+        self.assertEqual(fetcher.prefetched, [(1, 1, 1000), (3, 3, 600)])
+
+    def test_budget(self):
+        fetcher = FakeFetcher(used_bytes=600)
+        jobs = [FakeJob(chat_id) for chat_id in range(1, 6)]
+        prefetcher = self._prefetcher(fetcher, jobs, max_bytes=1000)
+
+        #bytes already prefetched count against the budget
+        self.assertEqual(prefetcher.prefetch(), 400)
+        self.assertEqual(fetcher.prefetched, [(1, 1, 400)])
+
+    def test_stopped(self):
+        fetcher = FakeFetcher()
+        prefetcher = self._prefetcher(fetcher, [FakeJob(1)])
+        prefetcher.running = False
+        self.assertEqual(prefetcher.prefetch(), 0)
+        self.assertEqual(fetcher.prefetched, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from probe import FFProbe, MediaInfo
+
+class FakeFFProbe(FFProbe):
+    def __init__(self, output, warnings=""):
+        super(FakeFFProbe, self).__init__("ffprobe")
+        self.output = output
+        self.warnings = warnings
+
+    def _run(self, path):
+        return json.loads(json.dumps(self.output)), self.warnings
+
+
+class MediaInfoTest(unittest.TestCase):
+
+    def test_matches(self):
+        media_info = MediaInfo(audio_codec="mp3", sample_rate=44100,
+                channels=1)
+        self.assertTrue(media_info.matches("mp3", 44100))
+        self.assertTrue(media_info.matches("mp3", 44100, channels=1))
+        self.assertFalse(media_info.matches("mp3", 44100, channels=2))
+        self.assertFalse(media_info.matches("mp3", 8000))
+        self.assertFalse(media_info.matches("aac", 44100))
+
+        #unknown sample rate never matches
+        self.assertFalse(MediaInfo(audio_codec="mp3").matches("mp3", 44100))
+
+
+class FFProbeTest(unittest.TestCase):
+
+    def test_probe(self):
+        probe = FakeFFProbe({
+            "format": {"format_name": "mov,mp4,m4a", "duration": "12.5"},
+            "streams": [
+                {"codec_type": "video", "codec_name": "h264"},
+                {"codec_type": "audio", "codec_name": "aac",
+                    "sample_rate": "44100", "channels": 2,
+                    "channel_layout": "stereo", "duration": "12.4"},
+                {"codec_type": "audio", "codec_name": "mp3",
+                    "sample_rate": "8000", "channels": 1}
+            ]
+        })
+        media_info = probe.probe("test.mp4")
+        self.assertEqual(media_info.format_name, "mov,mp4,m4a")
+        self.assertTrue(media_info.has_video)
+
+        #first audio stream is used, container duration preferred
+        self.assertEqual(media_info.audio_codec, "aac")
+        self.assertEqual(media_info.sample_rate, 44100)
+        self.assertEqual(media_info.channels, 2)
+        self.assertEqual(media_info.channel_layout, "stereo")
+        self.assertEqual(media_info.duration, 12.5)
+        self.assertTrue(media_info.duration_reliable)
+        self.assertEqual(probe.duration("test.mp4"), 12.5)
+
+    def test_attached_pic(self):
+        probe = FakeFFProbe({
+            "format": {"format_name": "mp3", "duration": "3.0"},
+            "streams": [
+                {"codec_type": "audio", "codec_name": "mp3",
+                    "sample_rate": "44100", "channels": 1},
+                {"codec_type": "video", "codec_name": "mjpeg",
+                    "disposition": {"attached_pic": 1}}
+            ]
+        })
+        media_info = probe.probe("test.mp3")
+        self.assertFalse(media_info.has_video)
+        self.assertTrue(media_info.matches("mp3", 44100, channels=1))
+
+    def test_missing_sample_rate(self):
+        probe = FakeFFProbe({
+            "format": {"format_name": "wav"},
+            "streams": [
+                {"codec_type": "audio", "codec_name": "pcm_s16le",
+                    "duration": "2.0"}
+            ]
+        })
+        media_info = probe.probe("test.wav")
+        self.assertIsNone(media_info.sample_rate)
+        self.assertIsNone(media_info.channels)
+        self.assertFalse(media_info.matches("pcm_s16le", 44100))
+
+        #stream duration is used without a container duration
+        self.assertEqual(media_info.duration, 2.0)
+        self.assertTrue(media_info.duration_reliable)
+
+    def test_estimated_duration(self):
+        probe = FakeFFProbe({
+            "format": {"format_name": "ogg", "duration": "60.0"},
+            "streams": [
+                {"codec_type": "audio", "codec_name": "vorbis",
+                    "sample_rate": "44100"}
+            ]
+        }, warnings="Estimating duration from bitrate, this may be inaccurate")
+
+        #estimated durations are only trusted for CBR mp3
+        media_info = probe.probe("test.ogg")
+        self.assertEqual(media_info.duration, 60.0)
+        self.assertFalse(media_info.duration_reliable)
+        self.assertIsNone(probe.duration("test.ogg"))
+
+    def test_empty(self):
+        media_info = FakeFFProbe({}).probe("test")
+        self.assertIsNone(media_info.audio_codec)
+        self.assertFalse(media_info.has_video)
+        self.assertIsNone(media_info.duration)
+
+if __name__ == '__main__':
+    unittest.main()
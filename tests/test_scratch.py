@@ -0,0 +1,160 @@
+import os
+import shutil
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from scratch import ScratchSpace
+
+class FakeStorage(object):
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+
+class ScratchSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "scratch")
+        self.memory_directory = os.path.join(WORKING_DIRECTORY, "output", "shm")
+        self.storage_backend = FakeStorage(
+                os.path.join(WORKING_DIRECTORY, "output", "storage"))
+
+    def tearDown(self):
+        for directory in [self.directory, self.memory_directory]:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    def _scratch(self, **kwargs):
+        return ScratchSpace(self.directory,
+                memory_directory=self.memory_directory,
+                memory_bytes=1000,
+                **kwargs)
+
+    def _touch(self, path):
+        with open(path, "wb") as scratch_file:
+            scratch_file.write(b"data")
+
+    def test_spill(self):
+        scratch = self._scratch()
+        storage = scratch.job("archive/test.mp3").storage(self.storage_backend)
+
+        first = storage.scratch_path("archive/test-1.wav", 600)
+        second = storage.scratch_path("archive/test-2.wav", 600)
+        self.assertEqual(first, os.path.join(
+            self.memory_directory, "archive-test.mp3", "test-1.wav"))
+        #over budget, spilled to the job's disk directory
+        self.assertEqual(second, os.path.join(
+            self.directory, "archive-test.mp3", "test-2.wav"))
+        self.assertTrue(os.path.isdir(os.path.dirname(first)))
+        self.assertTrue(os.path.isdir(os.path.dirname(second)))
+
+        self.assertEqual(storage.path("archive/test-1.wav"), first)
+        self.assertEqual(storage.path("archive/test.mp3"),
+                self.storage_backend.path("archive/test.mp3"))
+        self.assertEqual(scratch.counters()["scratch_spills"], 1)
+
+    def test_commit(self):
+        scratch = self._scratch()
+        storage = scratch.job("archive/test.mp3").storage(self.storage_backend)
+
+        #smaller than estimated, the difference returns to the budget
+        first = storage.scratch_path("archive/test-1.wav", 400)
+        with open(first, "wb") as scratch_file:
+            scratch_file.write(b"x" * 100)
+        self.assertEqual(storage.commit("archive/test-1.wav"), first)
+        self.assertEqual(scratch.counters()["scratch_memory_bytes"], 100)
+
+        #larger than estimated, with budget left, stays in memory
+        second = storage.scratch_path("archive/test-2.wav", 100)
+        with open(second, "wb") as scratch_file:
+            scratch_file.write(b"x" * 300)
+        self.assertEqual(storage.commit("archive/test-2.wav"), second)
+        self.assertEqual(scratch.counters()["scratch_memory_bytes"], 400)
+
+        #larger than the budget left, moves to disk
+        third = storage.scratch_path("archive/test-3.wav", 100)
+        with open(third, "wb") as scratch_file:
+            scratch_file.write(b"x" * 900)
+        path = storage.commit("archive/test-3.wav")
+        self.assertEqual(path, os.path.join(
+            self.directory, "archive-test.mp3", "test-3.wav"))
+        self.assertFalse(os.path.exists(third))
+        self.assertEqual(os.path.getsize(path), 900)
+        self.assertEqual(storage.path("archive/test-3.wav"), path)
+        self.assertEqual(scratch.counters()["scratch_memory_bytes"], 400)
+
+        storage.release()
+        self.assertEqual(scratch.counters()["scratch_memory_bytes"], 0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_success(self):
+        scratch = self._scratch()
+        job = scratch.job("archive/test.mp3")
+        path = job.storage(self.storage_backend).scratch_path(
+                "archive/test-1.wav", 600)
+        self._touch(path)
+
+        scratch.finish("archive/test.mp3", True)
+        self.assertFalse(os.path.exists(job.directory))
+        self.assertFalse(os.path.exists(job.memory_directory))
+        self.assertEqual(scratch.memory_used_bytes, 0)
+        self.assertEqual(scratch.counters()["scratch_jobs"], 0)
+
+    def test_failure(self):
+        scratch = self._scratch(ttl_seconds=3600)
+        job = scratch.job("archive/test.mp3")
+        path = job.storage(self.storage_backend).scratch_path(
+                "archive/test-1.wav", None)
+        self._touch(path)
+        scratch.finish("archive/test.mp3", False)
+
+        #kept within ttl, and reused by the retry
+        self.assertEqual(scratch.collect(), 0)
+        storage = scratch.job("archive/test.mp3").storage(self.storage_backend)
+        self.assertEqual(storage.path("archive/test-1.wav"), path)
+        scratch.finish("archive/test.mp3", False)
+
+        scratch.ttl_seconds = 0
+        scratch.job("archive/test.mp3").failed = 1
+        self.assertEqual(scratch.collect(), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(scratch.counters()["scratch_collected_jobs"], 1)
+
+    def test_retry_key(self):
+        scratch = self._scratch(ttl_seconds=3600)
+        scratch.job("archive/abc-1.0", key="archive/abc")
+        storage = scratch.job("archive/abc-1.0").storage(self.storage_backend)
+        path = storage.scratch_path("archive/abc-1.0-norm.wav", 600)
+        self._touch(path)
+        scratch.finish("archive/abc-1.0", False)
+
+        #a retry with a new timestamp finds the failed attempt's files
+        scratch.job("archive/abc-2.0", key="archive/abc")
+        storage = scratch.job("archive/abc-2.0").storage(self.storage_backend)
+        self.assertEqual(storage.path("archive/abc-2.0-norm.wav"), path)
+        self.assertEqual(scratch.memory_used_bytes, 600)
+
+        scratch.finish("archive/abc-2.0", True)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(scratch.memory_used_bytes, 0)
+        self.assertEqual(scratch.job_keys, {})
+
+    def test_quota(self):
+        scratch = self._scratch(max_bytes=4)
+        for name in ["archive/first.mp3", "archive/second.mp3"]:
+            path = scratch.job(name).storage(self.storage_backend).scratch_path(
+                    "archive/test-1.wav", None)
+            self._touch(path)
+            scratch.finish(name, False)
+
+        #oldest failed job removed until under quota
+        scratch.jobs["archive-first.mp3"].failed -= 10
+        self.assertEqual(scratch.collect(), 1)
+        self.assertEqual(list(scratch.jobs.keys()), ["archive-second.mp3"])
+        self.assertEqual(scratch.counters()["scratch_disk_bytes"], 4)
+
+if __name__ == '__main__':
+    unittest.main()
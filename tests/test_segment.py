@@ -0,0 +1,84 @@
+import io
+import os
+import struct
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from fakevendor import synthetic_mp3
+
+from segment import MP3_FORMAT, SEGMENT_ALIGNMENT, Segment, SegmentedEncoder, \
+        iter_adts_frames, read_wav_info
+
+class SegmentedEncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output")
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.wav_path = os.path.join(self.directory, "segment.wav")
+
+    def tearDown(self):
+        if os.path.exists(self.wav_path):
+            os.remove(self.wav_path)
+
+    def _write_wav(self, frames, channels=2):
+        data_size = frames * channels * 2
+        with open(self.wav_path, "wb") as wav_file:
+            wav_file.write(struct.pack("<4sI4s", b"RIFF", 36 + data_size, b"WAVE"))
+            wav_file.write(struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, channels,
+                44100, 44100 * channels * 2, channels * 2, 16))
+            wav_file.write(struct.pack("<4sI", b"data", data_size))
+            wav_file.write(b"\x00" * data_size)
+
+    def test_read_wav_info(self):
+        self._write_wav(1000)
+        wav_info = read_wav_info(self.wav_path)
+        self.assertEqual(wav_info.sample_rate, 44100)
+        self.assertEqual(wav_info.channels, 2)
+        self.assertEqual(wav_info.frames, 1000)
+        self.assertEqual(wav_info.data_offset, 44)
+        self.assertEqual(wav_info.raw_format, "s16le")
+
+    def test_segments(self):
+        self._write_wav(SEGMENT_ALIGNMENT * 5 + 100)
+        encoder = SegmentedEncoder("ffmpeg", threads=2,
+                segment_seconds=2 * SEGMENT_ALIGNMENT / 44100.0)
+        segments = encoder.segments(read_wav_info(self.wav_path))
+
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(segments[0].start, 0)
+        self.assertEqual(segments[1].segment_start, 2 * SEGMENT_ALIGNMENT)
+        self.assertEqual(segments[1].start, SEGMENT_ALIGNMENT)
+        self.assertEqual(segments[1].end, 5 * SEGMENT_ALIGNMENT)
+        self.assertEqual(segments[2].segment_end, SEGMENT_ALIGNMENT * 5 + 100)
+        self.assertTrue(segments[2].last)
+        for segment in segments:
+            self.assertEqual(segment.segment_start % SEGMENT_ALIGNMENT, 0)
+
+    def test_append_segment(self):
+        #16 frames, encoded from one frame of preroll
+        data = synthetic_mp3(16 * 1152 / 44100.0)[:16 * 417]
+        segment_path = os.path.join(self.directory, "segment-seg-0.mp3")
+        with open(segment_path, "wb") as segment_file:
+            segment_file.write(data)
+
+        encoder = SegmentedEncoder("ffmpeg", threads=2)
+        segment = Segment(1, 0, 16 * 1152, 1152, 11 * 1152, False)
+        output = io.BytesIO()
+        encoder._append_segment(output, segment, MP3_FORMAT, segment_path)
+        os.remove(segment_path)
+        self.assertEqual(output.getvalue(), data[417:11 * 417])
+
+    def test_iter_adts_frames(self):
+        def adts_frame(size):
+            header = bytearray([0xFF, 0xF1, 0x50, 0x80, 0, 0, 0xFC])
+            header[3] |= (size >> 11) & 0x03
+            header[4] = (size >> 3) & 0xFF
+            header[5] = ((size & 0x07) << 5) | 0x1F
+            return bytes(header) + b"\x00" * (size - 7)
+
+        data = adts_frame(100) + adts_frame(200) + b"\x00"
+        self.assertEqual(list(iter_adts_frames(data)), [(0, 100), (100, 200)])
+
+if __name__ == '__main__':
+    unittest.main()
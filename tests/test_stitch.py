@@ -0,0 +1,220 @@
+import os
+import shutil
+import sys
+import unittest
+
+import numpy as np
+
+from testbase import WORKING_DIRECTORY
+from trpycore.pool.simple import SimplePool
+from trsvcscore.storage.filesystem import FileSystemStorage
+
+from audiostats import AudioStats
+from governor import ResourceAccount, ResourceGovernor, accounting
+from stitch import FFMpegSoxStitcher
+from stream import ArchiveStream, ArchiveStreamType
+
+class RecordingGovernor(ResourceGovernor):
+    """Governor recording commands instead of running them."""
+    def __init__(self):
+        super(RecordingGovernor, self).__init__()
+        self.commands = []
+
+    def check_output(self, arguments, timeout=None, **kwargs):
+        self.commands.append(list(arguments))
+        return b""
+
+class FakeStatsEngine(object):
+    def __init__(self, seconds=2.0):
+        self.seconds = seconds
+        self.paths = []
+
+    def stats(self, path):
+        self.paths.append(path)
+        return AudioStats(int(self.seconds * 44100 * 2), 44100, 2, 0.5, -0.5, 0.1)
+
+class StitchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "stitch")
+        os.makedirs(self.directory)
+        self.storage = FileSystemStorage(WORKING_DIRECTORY)
+        self.governor = RecordingGovernor()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _stitcher(self, sox_path="sox", **kwargs):
+        return FFMpegSoxStitcher(
+                ffmpeg_path="ffmpeg",
+                sox_path=sox_path,
+                storage_pool=SimplePool(self.storage),
+                working_directory=WORKING_DIRECTORY,
+                stats_engine=FakeStatsEngine(),
+                governor=self.governor,
+                **kwargs)
+
+    def _streams(self, count, codec=None):
+        return [ArchiveStream("output/stitch/%s.wav" % (index+1),
+            ArchiveStreamType.USER_AUDIO_STREAM, 2000, [index+1],
+            offset=index*1000, codec=codec) for index in range(count)]
+
+    def _assert_temporary(self, path, filename):
+        """Assert path is a temporary path for filename."""
+        directory, name = os.path.split(self.storage.path(filename))
+        base, extension = os.path.splitext(name)
+        self.assertEqual(os.path.dirname(path), directory)
+        self.assertTrue(os.path.basename(path).startswith(".%s." % base))
+        self.assertTrue(path.endswith(extension))
+
+    def test_mix_format(self):
+        stitcher = self._stitcher(intermediate_format="wav")
+        result = stitcher._stitch_audio_streams(
+                storage_backend=self.storage,
+                archive_streams=self._streams(2),
+                output_filename="output/stitch/mix.wav",
+                intermediate=True)
+
+        arguments = self.governor.commands[-1]
+        index = arguments.index("16") + 1
+        self.assertEqual(arguments[index-6:index],
+                ["-r", "44100", "-e", "signed-integer", "-b", "16"])
+        self._assert_temporary(arguments[index], "output/stitch/mix.wav")
+        self.assertEqual(result.codec, "pcm_s16le")
+        self.assertEqual(result.sample_rate, 44100)
+        self.assertEqual(result.length, 2000.0)
+
+    def test_single_format(self):
+        stitcher = self._stitcher()
+        result = stitcher._stitch_audio_streams(
+                storage_backend=self.storage,
+                archive_streams=self._streams(1),
+                output_filename="output/stitch/mix.mp3")
+
+        arguments = self.governor.commands[-1]
+        index = arguments.index("44100") + 1
+        self.assertEqual(arguments[index-2:index], ["-r", "44100"])
+        self._assert_temporary(arguments[index], "output/stitch/mix.mp3")
+        self.assertNotIn("-b", arguments)
+        self.assertEqual(result.codec, "mp3")
+        self.assertEqual(result.sample_rate, 44100)
+
+    def test_volume_format(self):
+        stitcher = self._stitcher(intermediate_format="wav")
+        stream = self._streams(1)[0]
+        result = stitcher._adjust_audio_stream_volume(
+                storage_backend=self.storage,
+                archive_stream=stream,
+                volume_factor=2.0,
+                output_filename="output/stitch/1-norm.wav")
+
+        arguments = self.governor.commands[-1]
+        self.assertEqual(arguments[2:8], ["-r", "44100", "-e", "signed-integer",
+            "-b", "16"])
+        self._assert_temporary(arguments[8], "output/stitch/1-norm.wav")
+        self.assertEqual(arguments[9:], ["vol", "2.0"])
+        self.assertEqual(result.codec, "pcm_s16le")
+        self.assertEqual(result.sample_rate, 44100)
+
+    def test_pipe_input(self):
+        stitcher = self._stitcher()
+        self.assertEqual(
+                stitcher._pipe_input(["ffmpeg", "-i", "a b.mp4"], ["sox", "-p", "-p"]),
+                "|ffmpeg -i 'a b.mp4' | sox -p -p")
+
+    def test_mix_peak(self):
+        stitcher = self._stitcher()
+        script = "import struct, sys; " \
+                "getattr(sys.stdout, 'buffer', sys.stdout).write(" \
+                "struct.pack('<4f', 0.1, -0.75, 0.5, 0.0))"
+        with accounting(ResourceAccount()) as account:
+            peak = stitcher._get_mix_peak([sys.executable, "-c", script])
+        self.assertAlmostEqual(peak, 0.75)
+        self.assertEqual(account.pipe_read_bytes, 16)
+
+    def test_stream_norm(self):
+        stitcher = self._stitcher(streaming=True, sox_path="/usr/bin/sox")
+        commands = []
+
+        def get_mix_peak(sox_arguments, length=None):
+            commands.append(sox_arguments)
+            return 0.5
+
+        def run_encode_pipeline(sox_arguments, channels, mp3_path, mp4_path, length=None):
+            commands.append(sox_arguments)
+            return (AudioStats(44100 * 2 * 3, 44100, 2, 0.5, -0.5, 0.1),
+                    np.zeros(10, dtype=np.float32))
+
+        stitcher._get_mix_peak = get_mix_peak
+        stitcher._run_encode_pipeline = run_encode_pipeline
+        streams = self._streams(2, codec="pcm_s16le")
+        streams[1].filename = "output/stitch/user 2.wav"
+        mp3_stream, mp4_stream = stitcher._stream_audio_streams(
+                storage_backend=self.storage,
+                archive_streams=streams,
+                output_filename="output/stitch/mix")
+
+        peak_arguments, encode_arguments = commands
+        self.assertNotIn("--norm", encode_arguments)
+        self.assertEqual(encode_arguments[0], "/usr/bin/sox")
+        self.assertIn("|/usr/bin/sox '%s' -p rate 44100 pad 1.0" \
+                % self.storage.path("output/stitch/user 2.wav"), encode_arguments)
+
+        #mix volumes are scaled by the measured peak's gain
+        volume = lambda arguments: [float(arguments[index+1]) \
+                for index, argument in enumerate(arguments) if argument == "-v"]
+        for before, after in zip(volume(peak_arguments), volume(encode_arguments)):
+            self.assertAlmostEqual(after, before * 0.999 / 0.5)
+        self.assertEqual(mp3_stream.length, 3000.0)
+
+    def test_groups(self):
+        stitcher = self._stitcher(mix_fan_in=3)
+        self.assertEqual(stitcher._groups(list(range(7))),
+                [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(stitcher._groups(list(range(3))), [[0, 1, 2]])
+
+    def test_reduce_through_files(self):
+        stitcher = self._stitcher(mix_fan_in=2)
+        inputs = [(0.2, "|input%s" % index) for index in range(5)]
+        reduced, paths = stitcher._reduce_mix_inputs_through_files(
+                storage_backend=self.storage,
+                inputs=inputs,
+                output_filename="output/stitch/mix.wav")
+
+        #5 inputs -> groups of 2, 2, 1 -> groups of 2, 1
+        self.assertEqual(len(self.governor.commands), 3)
+        self.assertEqual(len(reduced), 2)
+        self.assertEqual(len(paths), 3)
+        self.assertEqual(reduced, [(1.0, paths[2]), (0.2, "|input4")])
+        for arguments in self.governor.commands:
+            self.assertEqual(arguments.count("-v"), 2)
+            self.assertEqual(arguments[-5:-1],
+                    ["-e", "floating-point", "-b", "32"])
+            self.assertIn(arguments[-1], paths)
+
+    def test_stream_fan_in(self):
+        stitcher = self._stitcher(streaming=True, mix_fan_in=2)
+        commands = []
+        stitcher._get_mix_peak = lambda sox_arguments, length=None: 0.5
+
+        def run_encode_pipeline(sox_arguments, channels, mp3_path, mp4_path, length=None):
+            commands.append(sox_arguments)
+            return (AudioStats(44100 * 2 * 3, 44100, 2, 0.5, -0.5, 0.1),
+                    np.zeros(10, dtype=np.float32))
+        stitcher._run_encode_pipeline = run_encode_pipeline
+
+        stitcher._stream_audio_streams(
+                storage_backend=self.storage,
+                archive_streams=self._streams(5, codec="pcm_s16le"),
+                output_filename="output/stitch/mix")
+
+        #groups are mixed into files, no sox process mixes more
+        #than mix_fan_in inputs.
+        self.assertEqual(len(self.governor.commands), 3)
+        for arguments in self.governor.commands + commands:
+            self.assertTrue(arguments.count("-v") <= 2)
+        self.assertFalse(any([argument.startswith("|") and " -m " in argument \
+            for argument in commands[0]]))
+
+if __name__ == '__main__':
+    unittest.main()
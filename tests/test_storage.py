@@ -0,0 +1,151 @@
+import hashlib
+import socket
+import unittest
+
+from testbase import WORKING_DIRECTORY
+from trsvcscore.storage.exception import StorageException
+
+from elastic import CONNECTION_ERRORS, ElasticPool
+from storage import ManifestCloudfilesStorage, StorageConnectionException
+
+class FakeObject(object):
+    def __init__(self, name):
+        self.name = name
+        self.manifest = None
+        self.data = None
+        self.etag = None
+
+    def write(self, data):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+
+
+class FakeContainer(object):
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.listings = []
+
+    def create_object(self, name):
+        self.objects[name] = FakeObject(name)
+        return self.objects[name]
+
+    def get_object(self, name):
+        if name not in self.objects:
+            raise KeyError("no such object '%s'" % name)
+        return self.objects[name]
+
+    def list_objects(self, prefix=None, marker=None, limit=None):
+        self.listings.append(marker)
+        names = sorted([name for name in self.objects
+            if name.startswith(prefix) and (marker is None or name > marker)])
+        return names[:limit]
+
+
+class FakeCloudfilesClient(object):
+    def __init__(self):
+        self.containers = {}
+        self.error = None
+
+    def get_container(self, name):
+        if self.error is not None:
+            raise self.error
+        return self.containers.setdefault(name, FakeContainer(name))
+
+
+class StorageFactory(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create(self):
+        return self.storage
+
+
+class ManifestCloudfilesStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeCloudfilesClient()
+        self.storage = ManifestCloudfilesStorage(
+                cloudfiles_client=self.client,
+                container_name="trdev_public",
+                list_page_size=2)
+
+    def test_save_manifest(self):
+        self.storage.save_manifest("archive/test.mp3",
+                ["archive/test.mp3/00000000", "archive/test.mp3/00000001"])
+        manifest = self.client.containers["trdev_public"]\
+                .objects["archive/test.mp3"]
+        self.assertEqual(manifest.manifest, "trdev_public/archive/test.mp3/")
+        self.assertEqual(manifest.data, b"")
+
+    def test_invalid_segments(self):
+        self.assertRaises(StorageException, self.storage.save_manifest,
+                "archive/test.mp3", ["archive/test.mp4/00000000"])
+        self.assertRaises(StorageException, self.storage.save_manifest,
+                "archive/test.mp3",
+                ["archive/test.mp3/00000001", "archive/test.mp3/00000000"])
+        self.assertEqual(self.client.containers, {})
+
+    def test_list_prefix(self):
+        container = self.client.get_container("trdev_public")
+        for name in ["archive/abc-1.mp3", "archive/abc-1.mp4",
+                "archive/abc-1.png", "archive/abd-1.mp3"]:
+            container.create_object(name)
+
+        #listings larger than a page are read in pages
+        self.assertEqual(self.storage.list_prefix("archive/abc-"),
+                ["archive/abc-1.mp3", "archive/abc-1.mp4", "archive/abc-1.png"])
+        self.assertEqual(container.listings,
+                [None, "archive/abc-1.mp4"])
+
+    def test_segments(self):
+        self.storage.save_manifest("archive/test.mp3",
+                ["archive/test.mp3/00000000", "archive/test.mp3/00000001"])
+        container = self.client.get_container("trdev_public")
+        for name in ["archive/test.mp3/00000000", "archive/test.mp3/00000001",
+                "archive/test.mp4"]:
+            container.create_object(name).write(b"data")
+        self.assertEqual(self.storage.segments("archive/test.mp3"),
+                ["archive/test.mp3/00000000", "archive/test.mp3/00000001"])
+        self.assertIsNone(self.storage.segments("archive/test.mp4"))
+
+    def test_etag(self):
+        container = self.client.get_container("trdev_public")
+        container.create_object("archive/test.mp3").write(b"mp3")
+        self.assertEqual(self.storage.etag("archive/test.mp3"),
+                hashlib.md5(b"mp3").hexdigest())
+        self.assertRaises(StorageException, self.storage.etag,
+                "archive/missing.mp3")
+
+    def test_connection_error(self):
+        error = socket.error("connection reset")
+        self.client.error = error
+        try:
+            self.storage.etag("archive/test.mp3")
+            self.fail("expected StorageConnectionException")
+        except StorageConnectionException as exception:
+            self.assertIs(exception.cause, error)
+
+        #other errors aren't connection errors
+        self.client.error = None
+        try:
+            self.storage.etag("archive/missing.mp3")
+            self.fail("expected StorageException")
+        except StorageException as exception:
+            self.assertNotIsInstance(exception, StorageConnectionException)
+            self.assertIsInstance(exception.cause, KeyError)
+
+        #pools discard storage whose connection failed
+        self.client.error = error
+        pool = ElasticPool(
+                factory=StorageFactory(self.storage),
+                discard_errors=CONNECTION_ERRORS + (StorageConnectionException,))
+        try:
+            with pool.get() as storage:
+                storage.list_prefix("archive/")
+        except StorageConnectionException:
+            pass
+        self.assertEqual(pool.counters()["pool_discarded"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import json
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from stream import ArchiveStream, ArchiveStreamManifest, ArchiveStreamType
+
+class ArchiveStreamTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        stream = ArchiveStream(
+                filename="archive/test.mp3",
+                type=ArchiveStreamType.USERS_AUDIO_STREAM,
+                length=None,
+                codec="mp3",
+                sample_rate=44100,
+                channels=1,
+                size=1024,
+                stats={"Volume adjustment": 2.0})
+        manifest = ArchiveStreamManifest(archive_streams=[stream])
+
+        data = json.loads(json.dumps(manifest.to_dict()))
+        self.assertNotIn("content_hash", data["archive_streams"][0])
+
+        result = ArchiveStreamManifest.from_dict(data).archive_streams[0]
+        for field in ("filename", "type", "length", "offset") \
+                + ArchiveStream.METADATA_FIELDS:
+            self.assertEqual(getattr(result, field), getattr(stream, field))
+
+    def test_update_metadata(self):
+        stream = ArchiveStream("a.mp3", ArchiveStreamType.USERS_AUDIO_STREAM,
+                None, codec="mp3")
+        other = ArchiveStream("a.mp3", ArchiveStreamType.USERS_AUDIO_STREAM,
+                None, codec="aac", sample_rate=8000)
+        stream.update_metadata(other)
+        self.assertEqual(stream.codec, "mp3")
+        self.assertEqual(stream.sample_rate, 8000)
+
+    def test_metadata(self):
+        stream = ArchiveStream("a.mp3", ArchiveStreamType.USERS_AUDIO_STREAM,
+                1000, codec="mp3", size=10, waveform=[1, 2, 3])
+        self.assertEqual(stream.metadata(), {"codec": "mp3", "size": 10})
+
+if __name__ == '__main__':
+    unittest.main()
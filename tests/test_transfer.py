@@ -0,0 +1,122 @@
+import os
+import shutil
+import unittest
+
+from testbase import WORKING_DIRECTORY
+
+from trsvcscore.storage.exception import NotImplemented
+from transfer import HashingFile, atomic_outputs, copy_file, open_upload, \
+        transfer
+
+class LocalStorage(object):
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+
+class RemoteStorage(object):
+    def __init__(self):
+        self.files = {}
+
+    def path(self, name):
+        raise NotImplemented()
+
+    def save(self, name, file):
+        self.files[name] = file.read()
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "transfer")
+        self.source = LocalStorage(os.path.join(self.directory, "source"))
+        self.destination = LocalStorage(os.path.join(self.directory, "destination"))
+        self.filename = "archive/test.mp3"
+        self.data = os.urandom(256 * 1024)
+
+        path = self.source.path(self.filename)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_copy(self):
+        source_path = self.source.path(self.filename)
+        destination_path = self.destination.path(self.filename)
+        method = copy_file(source_path, destination_path)
+        self.assertIn(method, ["reflink", "copy_file_range", "sendfile", "copy"])
+        self.assertEqual(self._read(destination_path), self.data)
+        self.assertNotEqual(os.stat(source_path).st_ino,
+                os.stat(destination_path).st_ino)
+
+    def test_link(self):
+        method = transfer(self.source, self.destination, self.filename, link=True)
+        self.assertEqual(method, "link")
+        self.assertEqual(os.stat(self.source.path(self.filename)).st_ino,
+                os.stat(self.destination.path(self.filename)).st_ino)
+        self.assertEqual(os.listdir(os.path.dirname(
+            self.destination.path(self.filename))), ["test.mp3"])
+
+    def test_upload(self):
+        remote = RemoteStorage()
+        method = transfer(self.source, remote, self.filename)
+        self.assertEqual(method, "mmap")
+        self.assertEqual(remote.files[self.filename], self.data)
+
+    def test_hashing_file_length(self):
+        with HashingFile(open_upload(self.source.path(self.filename))) as body:
+            self.assertEqual(len(body), len(self.data))
+
+        #empty files are opened as regular files, which have no len()
+        path = self.source.path("archive/empty.mp3")
+        open(path, "wb").close()
+        with HashingFile(open_upload(path)) as body:
+            self.assertEqual(len(body), 0)
+            self.assertEqual(body.read(), b"")
+
+    def test_atomic_outputs(self):
+        mp3_path = self.destination.path("archive/out.mp3")
+        mp4_path = self.destination.path("archive/out.mp4")
+        with atomic_outputs(mp3_path, mp4_path) as (mp3_temp, mp4_temp):
+            self.assertTrue(mp3_temp.endswith(".mp3"))
+            self.assertEqual(os.path.dirname(mp4_temp), os.path.dirname(mp4_path))
+            for path in [mp3_temp, mp4_temp]:
+                with open(path, "wb") as f:
+                    f.write(b"data")
+            self.assertFalse(os.path.exists(mp3_path))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(mp3_path))),
+                ["out.mp3", "out.mp4"])
+
+        #outputs get the umask's mode, not mkstemp's owner only mode
+        umask = os.umask(0o022)
+        os.umask(umask)
+        self.assertEqual(os.stat(mp3_path).st_mode & 0o777, 0o666 & ~umask)
+        os.chmod(mp4_path, 0o640)
+        with atomic_outputs(mp4_path) as (mp4_temp,):
+            with open(mp4_temp, "wb") as f:
+                f.write(b"replaced")
+        self.assertEqual(os.stat(mp4_path).st_mode & 0o777, 0o640)
+
+        #failed outputs are removed, not left truncated
+        path = self.destination.path("archive/failed.wav")
+        try:
+            with atomic_outputs(path) as (temp_path,):
+                with open(temp_path, "wb") as f:
+                    f.write(b"partial")
+                raise IOError("killed")
+        except IOError:
+            pass
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(temp_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
 import logging
+import os
 import platform
+import shutil
+import struct
 import unittest
+import wave
+
+import numpy as np
 
 from testbase import WORKING_DIRECTORY
 from trpycore.pool.simple import SimplePool
 from trsvcscore.storage.filesystem import FileSystemStorage
 
-from waveform import FFMpegWaveformGenerator
+from waveform import FFMpegWaveformGenerator, WaveformReducer
 from stream import ArchiveStream, ArchiveStreamType
 
 if platform.system() == "Darwin":
@@ -37,5 +43,95 @@ class ArchivePersisterTest(unittest.TestCase):
         self.assertIsNotNone(stream.waveform)
         self.assertIsNotNone(stream.waveform_filename)
 
+class WaveformStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "output", "waveform")
+        os.makedirs(self.directory)
+        self.storage = FileSystemStorage(WORKING_DIRECTORY)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_source_stats(self):
+        wav_path = os.path.join(self.directory, "stitch.wav")
+        wav_file = wave.open(wav_path, "wb")
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(44100)
+        wav_file.writeframes(struct.pack("<2h", 16384, -16384) * 44100)
+        wav_file.close()
+
+        source_path = os.path.join(self.directory, "stitch.mp3")
+        with open(source_path, "wb") as f:
+            f.write(b"mp3")
+
+        generator = FFMpegWaveformGenerator(
+                ffmpeg_path=FFMPEG_PATH,
+                storage_pool=SimplePool(self.storage),
+                working_directory=WORKING_DIRECTORY)
+        data = generator._extract_waveform_data(
+                storage_backend=self.storage,
+                archive_stream=ArchiveStream("output/waveform/stitch.wav",
+                    ArchiveStreamType.USER_AUDIO_STREAM, None),
+                size=10,
+                source_path=source_path)
+        self.assertEqual(len(data), 10)
+
+        #stats are cached for the source, not the temporary wav
+        cache = generator.stats_engine.cache
+        self.assertIsNone(cache.get(wav_path))
+        stats = cache.get(source_path)
+        self.assertAlmostEqual(stats.length, 1.0)
+        self.assertAlmostEqual(stats.peak, 0.5, places=3)
+
+class WaveformReducerTest(unittest.TestCase):
+
+    def test_reduce(self):
+        samples = np.zeros(2 * 1000, dtype=np.float32)
+        samples[2 * 10 + 1] = -0.5
+        samples[2 * 999] = 0.25
+
+        reducer = WaveformReducer(channels=2, size=10, block_frames=16)
+        #feed unevenly sized chunks of whole frames
+        reducer.update(samples[:2 * 7])
+        reducer.update(samples[2 * 7:2 * 500])
+        reducer.update(samples[2 * 500:])
+
+        data = reducer.data()
+        self.assertEqual(len(data), 10)
+        self.assertAlmostEqual(data[0], 0.5)
+        self.assertAlmostEqual(data[-1], 0.25)
+        self.assertAlmostEqual(data[1:-1].max(), 0.0)
+
+    def test_short(self):
+        reducer = WaveformReducer(channels=1, size=10)
+        reducer.update(np.array([0.1, -0.2], dtype=np.float32))
+        data = reducer.data()
+        #values are spread over the full size, not padded
+        self.assertEqual(len(data), 10)
+        self.assertAlmostEqual(data[0], 0.1, places=6)
+        self.assertAlmostEqual(data[-1], 0.2, places=6)
+        self.assertAlmostEqual(data.min(), 0.1, places=6)
+
+    def test_short_blocks(self):
+        #fewer frames than size blocks of block_frames
+        samples = np.zeros(2 * 100, dtype=np.float32)
+        samples[2 * 99] = 0.25
+        samples[2 * 50] = 0.5
+        reducer = WaveformReducer(channels=2, size=10, block_frames=16)
+        reducer.update(samples[:2 * 30])
+        reducer.update(samples[2 * 30:])
+
+        data = reducer.data()
+        self.assertEqual(len(data), 10)
+        self.assertAlmostEqual(data[5], 0.5)
+        self.assertAlmostEqual(data[-1], 0.25)
+
+    def test_empty(self):
+        data = WaveformReducer(channels=2, size=10).data()
+        self.assertEqual(len(data), 10)
+        self.assertAlmostEqual(data.max(), 0.0)
+
 if __name__ == '__main__':
     unittest.main()